@@ -1,4 +1,5 @@
 from .filter import *
 from .simple_table_mixin import *
+from .list_column import *
 from .common_basic_table_mixin import *
 from .history_table import *
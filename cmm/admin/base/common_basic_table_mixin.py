@@ -1,13 +1,20 @@
-from django.utils import timezone
 from cmm.csv import CsvImportAdminMixin, ExportAdminMixin, CsvImportMixin
 
 from cmm.admin.base import SimpleTableAminMixin
+from cmm.admin.base.list_column import get_annotated_list_columns
 
 
 class CommonBaseTableAminMixin(SimpleTableAminMixin, ExportAdminMixin, CsvImportAdminMixin, CsvImportMixin):
     """Csv export, import可能なHistoryTableのAdminMixin"""
 
-    def pre_import_processing(self, *args, **kwargs):
-        # pylint: disable = protected-access
-        # 初回取込時のデフォルト基準日を指定
-        self.model._history_date = timezone.now()
+    def get_list_annotations(self, request) -> dict:
+        """list_displayに含まれるAnnotatedListColumnのannotate {別名: 式}"""
+        list_display = set(self.get_list_display(request))
+        return {column.annotation_name: column.get_expression(request)
+                    for name, column in get_annotated_list_columns(self).items() if name in list_display}
+
+    def get_queryset(self, request):
+        """AnnotatedListColumnの列をannotateする"""
+        queryset = super().get_queryset(request)
+        annotations = self.get_list_annotations(request)
+        return queryset.annotate(**annotations) if annotations else queryset
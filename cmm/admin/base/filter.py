@@ -92,15 +92,19 @@ class ValidAtFilter(CommonFilter):
                 ('future', _("Valid in the future")),
                ]
 
+    def get_reference_date(self, queryset) -> date:
+        """HistoryTableはModelの基準日、それ以外は当日"""
+        get_reference_date = getattr(queryset, 'get_reference_date', None)
+        return get_reference_date() if get_reference_date is not None else date.today()
+
     def queryset(self, request, queryset):
         if self.value() == 'all':
             return queryset
 
-        ref_date = date.today()
+        ref_date = self.get_reference_date(queryset)
         if self.value() == 'valid':
             return queryset.filter(valid_from__lte=ref_date, valid_through__gte=ref_date)
 
-        ref_date = date.today()
         if self.value() == 'expired':
             return queryset.filter(valid_through__lt=ref_date)
         
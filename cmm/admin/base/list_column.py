@@ -0,0 +1,45 @@
+from typing import Any, Callable, Dict, Union
+from django.db.models import Expression
+
+
+class AnnotatedListColumn:
+    """changelistの列をQuerySetのannotateで取得する、行ごとの検索(N+1)を避けるために使う
+
+        expression:     annotateする式(Subquery等)、requestを受け取って式を返す関数も指定できる
+        description:    列タイトル
+        ordering:       列タイトルで並び替えられるか
+        boolean:        True/Falseをアイコンで表示するか
+        ModelAdminのクラス属性として定義し、属性名をlist_displayに指定する
+    """
+    def __init__(self, expression: Union[Expression, Callable[[Any], Expression]], description: str = None,
+                 ordering: bool = True, boolean: bool = False):
+        self.expression = expression
+        self.short_description = description
+        self.ordering = ordering
+        self.boolean = boolean
+        self.name = None
+        self.annotation_name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+        # Modelの同名の属性(メソッド等)を上書きしないように別名でannotateする
+        self.annotation_name = f'{name}_annotated'
+        if self.short_description is None:
+            self.short_description = name.replace('_', ' ')
+
+    @property
+    def admin_order_field(self) -> str:
+        """並び替えに使う項目、並び替えできない場合はNone"""
+        return self.annotation_name if self.ordering else None
+
+    def get_expression(self, request) -> Expression:
+        """annotateする式"""
+        return self.expression(request) if callable(self.expression) else self.expression
+
+    def __call__(self, obj) -> Any:
+        return getattr(obj, self.annotation_name, None)
+
+def get_annotated_list_columns(modeladmin) -> Dict[str, AnnotatedListColumn]:
+    """ModelAdminに定義されたAnnotatedListColumn {属性名: 列}"""
+    return {name: column for klass in reversed(type(modeladmin).__mro__)
+                for name, column in vars(klass).items() if isinstance(column, AnnotatedListColumn)}
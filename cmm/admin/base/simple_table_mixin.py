@@ -3,6 +3,8 @@ from django.contrib import messages
 from django import forms
 from django.http import HttpResponseRedirect
 from django.utils import timezone
+from cmm.forms import CodeChoiceField
+from cmm.models.codes import Code
 
 
 class SimpleTableAminMixin():
@@ -15,6 +17,17 @@ class SimpleTableAminMixin():
         # Foreign keyのadd, change, delete, viewアイコンを非表示にする
         css = {"all": ("cmm/css/cmm.css",)}
 
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        """カテゴリで絞ったCodeへのForeign KeyはコードマスタのキャッシュからPull-downを作る"""
+        limit_choices_to = db_field.remote_field.limit_choices_to
+        if db_field.related_model is Code and isinstance(limit_choices_to, dict) \
+                and 'category__category' in limit_choices_to and 'form_class' not in kwargs \
+                and db_field.name not in self.get_autocomplete_fields(request) \
+                and db_field.name not in self.raw_id_fields:
+            kwargs['form_class'] = CodeChoiceField
+            kwargs['category'] = limit_choices_to['category__category']
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
+
     def get_readonly_fields(self, request, obj=None) -> Tuple[str]:
         """削除フラグを読み取り専用とする"""
         readonly_fields = ('creator', 'create_time', 'updater', 'update_time')
@@ -1,8 +1,9 @@
-from typing import Any, Dict, Tuple
+from typing import Tuple
 from django.contrib.admin import ModelAdmin, TabularInline
 from django.http.request import HttpRequest
 from django.utils.translation import gettext_lazy as _
 from cmm.admin.base import CommonBaseTableAminMixin, ValidFilter, CommonFilter
+from cmm.csv import CsvForeignKey
 from cmm.forms import SimpleModelForm
 from cmm.models import Category, Code
 
@@ -88,6 +89,10 @@ class CodeModelAdmin(CommonBaseTableAminMixin, ModelAdmin):
     list_filter = (CodeCategoryFilter, ValidFilter)
     ordering = ['category', 'display_order']
 
+    csv_foreign_keys = {
+        'category': CsvForeignKey(Category, 'category', csv_column='category__category'),
+    }
+
     def get_readonly_fields(self, request, obj=None) -> Tuple[str]:
         read_only = ('category', 'code')
         return super().get_readonly_fields(request, obj) + read_only if obj is not None else ()
@@ -102,11 +107,6 @@ class CodeModelAdmin(CommonBaseTableAminMixin, ModelAdmin):
     def get_model_fields(self) -> Tuple[str]:
         return ('category', 'code', 'name', 'abbr', 'display_order', 'valid_flag')
 
-    def csv2model(self, csv_dict: Dict[str, str], *args, **kwargs) -> Dict[str, Any]:
-        model_dict = super().csv2model(csv_dict, *args, **kwargs)
-        model_dict['category'] = Category.objects.filter(category=csv_dict['category__category']).first()
-        return model_dict
-
     # def has_delete_permission(self, request: HttpRequest, obj=None) -> bool:
     #     """InlineでCodeを表示しても削除時にはここで権限有無を確認する"""
     #     return False
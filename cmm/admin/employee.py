@@ -1,11 +1,12 @@
 from typing import Tuple
 from django.contrib import admin
 from django.core.exceptions import ValidationError
+from django.db.models import OuterRef, Subquery
 from django.forms.models import BaseInlineFormSet
 from django.utils.translation import gettext_lazy as _
-from cmm.admin.base import CommonFilter, CommonBaseTableAminMixin, ValidFilter
-from cmm.models import OrgMember, Employee, get_all_upper_organizations
-from cmm.utils.date import Period, flat_overlap
+from cmm.admin.base import AnnotatedListColumn, CommonFilter, CommonBaseTableAminMixin, ValidFilter
+from cmm.models import OrgMember, Employee, get_organization_tree
+from cmm.utils.date import Period, count_overlaps
 
 
 class AffiliationListFilter(CommonFilter):
@@ -16,9 +17,8 @@ class AffiliationListFilter(CommonFilter):
     parameter_name = 'affiliation_id'
 
     def lookups(self, request, model_admin):
-        """上位組織リスト"""
-        upper_organizations = list(get_all_upper_organizations())
-        return [(org.id, '|' + '-'*int(org.rank.code) + org.abbr) for org in upper_organizations]
+        """上位組織リスト、キャッシュした組織階層から作る"""
+        return get_organization_tree().get_upper_organization_choices()
 
     def queryset(self, request, queryset):
         """指定組織で絞る"""
@@ -37,21 +37,15 @@ class OrgMemberInlineFormSet(BaseInlineFormSet):
         
         # pylint: disable = not-callable
         default_valid_through = self.model().get_default_valid_through()
-        periods = []
+        periods, main_duties = [], []
         for form in self.forms:
             valid_from = form.cleaned_data.get('valid_from')
             valid_through = form.instance.valid_through or default_valid_through
             periods.append(Period(valid_from, valid_through))
-        
-        for period in flat_overlap(periods):
-            main_duty_count = 0
-            for form in self.forms:
-                valid_from = form.cleaned_data.get('valid_from')
-                valid_through = form.instance.valid_through or default_valid_through
-                if valid_from <= period.valid_through and valid_through >= period.valid_from:
-                    if form.cleaned_data.get('is_main_duty'):
-                        main_duty_count += 1
+            main_duties.append(1 if form.cleaned_data.get('is_main_duty') else 0)
 
+        # 区間ごとの本務数を一回の走査で数える
+        for period, _active_count, main_duty_count in count_overlaps(periods, main_duties):
             if main_duty_count == 0:
                 raise ValidationError(
                     _('You must specify one and only one main duty organization.'),
@@ -111,6 +105,12 @@ class EmployeeAdmin(CommonBaseTableAminMixin, admin.ModelAdmin):
 
     inlines = (OrgMemberInline,)
 
+    # 本務組織名をサブクエリで取得する、Employee.main_duty_organization()を行ごとに呼ばない
+    main_duty_organization = AnnotatedListColumn(
+        Subquery(OrgMember.objects.filter(employee_id=OuterRef('pk'), is_main_duty=True)
+                                  .order_by('organization_id').values('organization__name')[:1]),
+        _('main duty organization'))
+
     # ※参考
     # ManyToMany用選択元＆選択済リストを表示する、選択元は検索フィールド付き。ただし、throughの指定がない場合のみ利用可能
     # fields = [('name', 'code'), 'email', 'auth_user', 'organizations', ('valid_from', 'valid_through')]
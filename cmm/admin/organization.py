@@ -1,4 +1,5 @@
-from typing import Any, Dict, Tuple
+import itertools
+from typing import Any, List, Tuple
 from django.contrib import admin
 from django.http.request import HttpRequest
 from django.db.models.query import QuerySet, F
@@ -6,9 +7,11 @@ from django.urls import reverse
 from django.utils.html import format_html
 from django.utils.translation import gettext_lazy as _
 from cmm.admin.base import CommonBaseTableAminMixin, ValidFilter
+from cmm.const import ORG_RANK
+from cmm.csv import CsvCodeForeignKey, CsvForeignKey, CsvLog
 from cmm.forms import SimpleModelForm
-from cmm.models import Organization, Code, get_all_upper_organizations
-from cmm.models.organization_rel import OrganizationRel
+from cmm.models import Organization, get_organization_tree, organization_tree_cache
+from cmm.models.organization_rel import OrganizationRel, find_recursive_parenthood
 
 
 class ChildOrgForm(SimpleModelForm):
@@ -31,7 +34,8 @@ class ChildOrganizationInline(admin.TabularInline):
     def get_queryset(self, request):
         """所属に絞る"""
         organization_id = request.resolver_match.kwargs.get('object_id')
-        return OrganizationRel.objects.filter(parent_id=organization_id, valid_flag=True)
+        return OrganizationRel.objects.filter(parent_id=organization_id, valid_flag=True) \
+                                      .select_related('org__rank')
 
     @admin.display(description=_('organization code'))
     def code_link(self, instance):
@@ -55,9 +59,8 @@ class ParentOrganizationListFilter(admin.SimpleListFilter):
     parameter_name = 'parent_org_id'
 
     def lookups(self, request, model_admin):
-        """上位組織リスト"""
-        upper_organizations = get_all_upper_organizations()
-        return [(org.id, '|' + '-'*int(org.rank.code) + org.abbr) for org in upper_organizations]
+        """上位組織リスト、キャッシュした組織階層から作る"""
+        return get_organization_tree().get_upper_organization_choices()
 
     def queryset(self, request, queryset):
         """指定した上位組織で絞る"""
@@ -80,7 +83,11 @@ class OrganizationAdmin(CommonBaseTableAminMixin, admin.ModelAdmin):
     csv_skip_limit = 1000
 
     inlines = (ChildOrganizationInline,)
-    
+
+    csv_foreign_keys = {
+        'rank': CsvCodeForeignKey(ORG_RANK),
+    }
+
     def get_readonly_fields(self, request, obj=None) -> Tuple[str]:
         return (*super().get_readonly_fields(request, obj), 'code' if obj is not None else None)
 
@@ -94,11 +101,10 @@ class OrganizationAdmin(CommonBaseTableAminMixin, admin.ModelAdmin):
     def get_model_fields(self) -> Tuple[str]:
         return ('code', 'abbr', 'name', 'rank')
 
-    def csv2model(self, csv_dict: Dict[str, Any], *args, **kwargs) -> Dict[str, Any]:
-        model_dict = super().csv2model(csv_dict, *args, **kwargs)
-
-        model_dict['rank'] = Code.objects.filter(category__category='org_rank', code=csv_dict.get('rank')).first()
-        return model_dict
+    def post_import_processing(self, *args, **kwargs):
+        """組織階層キャッシュを無効化する"""
+        super().post_import_processing(*args, **kwargs)
+        organization_tree_cache.invalidate()
 
 class OrganizationRelListFilter(ParentOrganizationListFilter):
     """組織階層一覧画面の上位組織フィルター、上位組織一覧を階層的に表示する"""
@@ -116,16 +122,32 @@ class OrganizationRelAdmin(CommonBaseTableAminMixin, admin.ModelAdmin):
     list_filter = (OrganizationRelListFilter, ValidFilter)
     list_display_links = None
 
+    csv_foreign_keys = {
+        'parent': CsvForeignKey(Organization, 'code', csv_column='parent_code'),
+        'org': CsvForeignKey(Organization, 'code', csv_column='code'),
+    }
+
     def get_csv_columns(self) -> Tuple[str]:
         return ('code', 'abbr', 'parent_code', 'name', 'rank')
 
     def get_model_fields(self) -> Tuple[str]:
         return ('parent', 'org')
 
-    def csv2model(self, csv_dict: Dict[str, Any], *args, **kwargs) -> Dict[str, Any]:
-        model_dict = super().csv2model(csv_dict, *args, **kwargs)
-
-        parent, org = csv_dict['parent_code'], csv_dict['code']
-        model_dict['parent'] = Organization.objects.filter(code=parent).first()
-        model_dict['org'] = Organization.objects.filter(code=org).first()
-        return model_dict
+    def post_import_processing(self, *args, **kwargs):
+        """組織階層キャッシュを無効化する"""
+        super().post_import_processing(*args, **kwargs)
+        organization_tree_cache.invalidate()
+
+    def validate_chunk(self, rows: List[CsvLog]) -> None:
+        """既存の関連とchunkの関連をまとめて循環チェックし、循環している行をエラーにする"""
+        edges = [(row, (row.modelform.cleaned_data['parent'].id, row.modelform.cleaned_data['org'].id))
+                    for row in rows if row.modelform.cleaned_data.get('parent') is not None]
+        if not edges:
+            return
+
+        existing = OrganizationRel.objects.filter(parent__isnull=False).values_list('parent_id', 'org_id')
+        recursive = find_recursive_parenthood(itertools.chain(existing, (edge for _row, edge in edges)))
+        for row, edge in edges:
+            if edge in recursive:
+                row.log_level = CsvLog.ERROR
+                row.message = _('Recursive parenthood was detected.')
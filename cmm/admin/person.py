@@ -3,8 +3,8 @@ from django.contrib import admin
 from django.utils.translation import gettext_lazy as _
 from django.db import connection, transaction
 from cmm.admin.base import SimpleTableAminMixin, ValidFilter
-from cmm.csv import CsvBulkImportMixin, CsvImportAdminMixin, ExportAdminMixin
-from cmm.models import Employee, Code, ZipCode
+from cmm.csv import CsvBulkImportMixin, CsvImportAdminMixin, ExportAdminMixin, CsvForeignKey, CsvCodeForeignKey
+from cmm.models import Employee, ZipCode
 
 
 class EmployeeInline(admin.StackedInline):
@@ -23,6 +23,13 @@ class PersonAdmin(SimpleTableAminMixin, ExportAdminMixin, CsvImportAdminMixin, C
 
     # is_bulk_insert = True
 
+    csv_foreign_keys = {
+        # CSVにて性別の略称が設定されている場合の対応
+        'sex': CsvCodeForeignKey('sex', 'abbr'),
+        # CSVにて郵便番号が設定されている場合の対応
+        'zipcode': CsvForeignKey(ZipCode, 'zipcode', get_key=lambda csv_dict: csv_dict['zipcode'].replace('-', '')),
+    }
+
     def get_csv_columns(self) -> Tuple[str]:
         return ('last_name', 'first_name', 'last_name_kana', 'first_name_kana','年齢','birthday','sex','email',
                 'phone_number','mobile','zipcode','address','my_number')
@@ -33,11 +40,7 @@ class PersonAdmin(SimpleTableAminMixin, ExportAdminMixin, CsvImportAdminMixin, C
 
     def csv2model(self, csv_dict: dict, *args, **kwargs) -> dict:
         model_dict = super().csv2model(csv_dict, *args, **kwargs)
-        # CSVにて性別の略称が設定されている場合の対応
-        model_dict['sex'] = Code.objects.filter(category__category='sex', abbr=csv_dict.get('sex')).first()
-        # CSVにて郵便番号が設定されている場合の対応
-        zipcode = ZipCode.objects.filter(zipcode=csv_dict['zipcode'].replace('-', '')).first()
-        model_dict['zipcode'] = zipcode
+        zipcode = model_dict.get('zipcode')
         if zipcode is not None:
             model_dict['shikuchoson'] = zipcode.shikuchoson
         return model_dict
@@ -2,9 +2,10 @@ from typing import Tuple
 from django.contrib import admin
 from cmm.models import Shikuchoson
 from cmm.admin.base import CommonBaseTableAminMixin, ValidFilter
+from cmm.csv import CsvForeignKey, CsvBulkUpsertMixin
 
 
-class ZipCodeModelAdmin(CommonBaseTableAminMixin, admin.ModelAdmin):
+class ZipCodeModelAdmin(CsvBulkUpsertMixin, CommonBaseTableAminMixin, admin.ModelAdmin):
     """郵便番号をAdminSiteに表示する"""
     fields = ['zipcode', 'shikuchoson', 'machiikimei', 'machiikimei_kana', 'valid_flag']
     list_display = ('zipcode', 'shikuchoson', 'machiikimei', 'machiikimei_kana', 'valid_flag')
@@ -14,6 +15,10 @@ class ZipCodeModelAdmin(CommonBaseTableAminMixin, admin.ModelAdmin):
     # is_bulk_insert = True
     is_replace_existing = False
 
+    csv_foreign_keys = {
+        'shikuchoson': CsvForeignKey(Shikuchoson, 'code'),
+    }
+
     def get_readonly_fields(self, request, obj=None) -> Tuple[str]:
         return (*super().get_readonly_fields(request, obj), 'zipcode' if obj is not None else None)
 
@@ -23,13 +28,3 @@ class ZipCodeModelAdmin(CommonBaseTableAminMixin, admin.ModelAdmin):
 
     def get_model_fields(self) -> Tuple[str]:
         return ('zipcode', 'shikuchoson', 'machiikimei', 'machiikimei_kana')
-
-    def csv2model(self, csv_dict: dict, *args, **kwargs) -> dict:
-        model_dict = super().csv2model(csv_dict, *args, **kwargs)
-
-        # コードよりForeign Key取得
-        shikuchoson = Shikuchoson.objects.filter(code=csv_dict.get('shikuchoson')).first()
-        if shikuchoson is not None:
-            model_dict['shikuchoson'] = shikuchoson
-
-        return model_dict
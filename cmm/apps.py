@@ -15,3 +15,14 @@ class CmmConfig(AppConfig):
         from django_auth_ldap.backend import populate_user
         # Explicitly connect a signal handler.
         populate_user.connect(signals.ldap_auth_handler)
+
+        # マスタのキャッシュはプロセス間で無効化を共有するので、共有のキャッシュ・バックエンドが必要
+        from django.core import checks
+        from cmm.utils.cache import check_shared_cache
+        checks.register(check_shared_cache, checks.Tags.caches)
+
+        # ユニーク・キーは行ごとの保存、検索で使うので、Modelごとに一度だけ解決しておく
+        from cmm.models.base import UniqueConstraintMixin
+        for model in self.apps.get_models():
+            if issubclass(model, UniqueConstraintMixin):
+                model.cache_unique_key()
@@ -1,5 +1,10 @@
 from .csv_log import *
+from .export_plan import *
 from .export import *
+from .export_format import *
 from .export_admin import *
+from .csv_foreign_key import *
+from .csv_unique import *
 from .csv_import import *
+from .csv_import_job import *
 from .csv_import_admin import *
@@ -0,0 +1,186 @@
+import logging
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+from django.db import models
+from django.forms import ModelChoiceField
+
+
+_logger = logging.getLogger(__name__)
+
+class CsvForeignKey:
+    """CSVの自然キー（コード等）からForeign Keyを解決するための定義
+
+        model:          参照先Model
+        lookup_field:   参照先Modelの検索項目（自然キー）
+        csv_column:     自然キーを保持するCSV列名、省略時はModelの項目名と同じ
+        filters:        参照先を絞り込む追加条件（例: {'category__category': 'sex'}）
+        get_key:        CSV行から自然キーを算出する関数、複数列から組み立てる場合に指定する
+    """
+    def __init__(self, model: models.Model, lookup_field: str, csv_column: str = None,
+                 filters: Dict[str, Any] = None, get_key: Callable[[Dict[str, str]], Any] = None):
+        # pylint: disable = too-many-arguments
+        self.model = model
+        self.lookup_field = lookup_field
+        self.csv_column = csv_column
+        self.filters = filters or {}
+        self.get_key = get_key
+
+    @property
+    def cache_key(self) -> Tuple:
+        """キャッシュのキー、同一Modelでも検索条件が異なれば別物として扱う"""
+        # pylint: disable = protected-access
+        return (self.model._meta.label, self.lookup_field, tuple(sorted(self.filters.items())))
+
+    def get_natural_key(self, field_name: str, csv_dict: Dict[str, str]) -> Any:
+        """CSV行から自然キーを取得する、空の場合はNone"""
+        if self.get_key is not None:
+            key = self.get_key(csv_dict)
+        else:
+            key = csv_dict.get(self.csv_column or field_name)
+
+        return key if key not in (None, '') else None
+
+    def retrieve(self, keys: Iterable[Any]) -> Dict[Any, models.Model]:
+        """自然キーのリストで一括検索する、同一キーが複数件あれば最初の一件（Modelのordering順）を採用"""
+        result = {}
+        queryset = self.model.objects.filter(**self.filters, **{f'{self.lookup_field}__in': keys})
+        for obj in queryset:
+            result.setdefault(str(getattr(obj, self.lookup_field)), obj)
+        return result
+
+class CsvCodeForeignKey(CsvForeignKey):
+    """カテゴリ内のコード(略称等)からCodeへのForeign Keyを解決する、コードマスタのキャッシュを使う
+
+        category:       コードのカテゴリ
+        lookup_field:   Codeの検索項目、省略時はコード
+        キャッシュにないキーはDBを検索する
+    """
+    def __init__(self, category: str, lookup_field: str = 'code', csv_column: str = None,
+                 get_key: Callable[[Dict[str, str]], Any] = None):
+        # pylint: disable = import-outside-toplevel
+        from cmm.models.codes import Code
+        super().__init__(Code, lookup_field, csv_column=csv_column,
+                         filters={'category__category': category}, get_key=get_key)
+        self.category = category
+
+    def retrieve(self, keys: Iterable[Any]) -> Dict[Any, models.Model]:
+        # pylint: disable = import-outside-toplevel
+        from cmm.models.codes import get_code_registry
+
+        registry = get_code_registry()
+        result, missing = {}, []
+        for key in keys:
+            code = registry.find(self.category, self.lookup_field, key)
+            if code is not None:
+                result[str(key)] = code
+            else:
+                missing.append(key)
+        if missing:
+            result.update(super().retrieve(missing))
+        return result
+
+class ForeignKeyCache:
+    """(Model, 自然キー)をキーとする上限付きのキャッシュ、CSV import一回分の間だけ保持する
+
+        chunkごとに自然キーをまとめて一括検索(prefetch)し、行ごとの検索を不要にする。
+        modelを指定した場合、Foreign Keyのlimit_choices_toを満たすかもchunkごとに一括検索し、
+        満たさない参照先はpkで返す(ModelChoiceFieldが選択肢外のエラーとする)
+    """
+    in_clause_size = 1000           # Oracleの IN句の上限
+
+    def __init__(self, foreign_keys: Dict[str, CsvForeignKey], max_size: int = 100000, model: models.Model = None):
+        self.foreign_keys = foreign_keys
+        self.max_size = max_size
+        self.limit_choices_to = self.__get_limit_choices_to(model) if model is not None else {}
+        self.__cache = OrderedDict()
+        self.__choices = {}         # {Modelの項目名: {参照先のpk: limit_choices_toを満たすか}}
+
+    def __get_limit_choices_to(self, model: models.Model) -> Dict[str, Any]:
+        """参照先の選択肢が制限されたForeign Keyの {Modelの項目名: limit_choices_to}"""
+        # pylint: disable = protected-access
+        result = {}
+        for field_name in self.foreign_keys:
+            field = model._meta.get_field(field_name)
+            limit_choices_to = field.get_limit_choices_to() if hasattr(field, 'get_limit_choices_to') else None
+            if limit_choices_to:
+                result[field_name] = limit_choices_to
+        return result
+
+    def __get(self, spec: CsvForeignKey, key: Any):
+        cache_key = (spec.cache_key, str(key))
+        if cache_key not in self.__cache:
+            raise KeyError(cache_key)
+        self.__cache.move_to_end(cache_key)
+        return self.__cache[cache_key]
+
+    def __set(self, spec: CsvForeignKey, key: Any, obj: models.Model) -> None:
+        cache_key = (spec.cache_key, str(key))
+        self.__cache[cache_key] = obj
+        self.__cache.move_to_end(cache_key)
+        while len(self.__cache) > self.max_size:
+            self.__cache.popitem(last=False)
+
+    def __contains(self, spec: CsvForeignKey, key: Any) -> bool:
+        return (spec.cache_key, str(key)) in self.__cache
+
+    def __check_choices(self, field_name: str, spec: CsvForeignKey, objs: Iterable[models.Model]) -> None:
+        """未確認の参照先がlimit_choices_toを満たすかを一括検索して記録する"""
+        checked = self.__choices.setdefault(field_name, {})
+        pks = list({obj.pk for obj in objs if obj is not None and obj.pk not in checked})
+        for i in range(0, len(pks), self.in_clause_size):
+            batch = pks[i:i + self.in_clause_size]
+            allowed = set(spec.model._default_manager.complex_filter(self.limit_choices_to[field_name])
+                                                     .filter(pk__in=batch).values_list('pk', flat=True))
+            checked.update({pk: pk in allowed for pk in batch})
+
+    def __is_allowed(self, field_name: str, spec: CsvForeignKey, obj: models.Model) -> bool:
+        """参照先がlimit_choices_toを満たすか"""
+        if field_name not in self.limit_choices_to:
+            return True
+        self.__check_choices(field_name, spec, [obj])
+        return self.__choices[field_name][obj.pk]
+
+    def prefetch(self, csv_dicts: List[Dict[str, str]]) -> None:
+        """chunk内の自然キーをまとめて検索し、キャッシュに載せる。見つからないキーもNoneとして記録する"""
+        for field_name, spec in self.foreign_keys.items():
+            keys = {str(key) for key in (spec.get_natural_key(field_name, d) for d in csv_dicts) if key is not None}
+            missing = [key for key in keys if not self.__contains(spec, key)]
+            for i in range(0, len(missing), self.in_clause_size):
+                batch = missing[i:i + self.in_clause_size]
+                found = spec.retrieve(batch)
+                for key in batch:
+                    self.__set(spec, key, found.get(key))
+            if missing:
+                _logger.debug('Prefetched %s keys of %s for %s.', len(missing), spec.model.__name__, field_name)
+
+            if field_name in self.limit_choices_to:
+                self.__check_choices(field_name, spec, [self.__cache.get((spec.cache_key, key)) for key in keys])
+
+    def resolve(self, csv_dict: Dict[str, str]) -> Dict[str, models.Model]:
+        """CSV行のForeign Keyをすべて解決する、キャッシュにない場合は一件ずつ検索する"""
+        resolved = {}
+        for field_name, spec in self.foreign_keys.items():
+            key = spec.get_natural_key(field_name, csv_dict)
+            if key is None:
+                resolved[field_name] = None
+                continue
+
+            try:
+                obj = self.__get(spec, key)
+            except KeyError:
+                obj = spec.retrieve([str(key)]).get(str(key))
+                self.__set(spec, key, obj)
+
+            # limit_choices_toを満たさない参照先はpkを渡し、ModelChoiceFieldのquerysetで検証させる
+            resolved[field_name] = obj if obj is None or self.__is_allowed(field_name, spec, obj) else obj.pk
+
+        return resolved
+
+class CsvModelChoiceField(ModelChoiceField):
+    """解決済みのModelインスタンスを受け取った場合はDBへの再検索を行わないModelChoiceField
+        インスタンスはForeignKeyCacheでlimit_choices_to(self.querysetの条件)を確認済みのものに限る
+    """
+    def to_python(self, value):
+        if isinstance(value, self.queryset.model) and value.pk is not None:
+            return value
+        return super().to_python(value)
@@ -2,16 +2,18 @@ import csv
 import io
 import logging
 import math
-from typing import Any, Dict, List, Set, Tuple
+from typing import Any, Dict, Hashable, List, Set, Tuple
 from django.utils.translation import gettext_lazy as _
 from django.contrib.admin.utils import flatten
-from django.forms import modelform_factory
-from django.db import transaction
+from django.forms import ModelForm, modelform_factory
+from django.db import models, transaction
+from django.db.models import F
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 from cmm.const import UTF8
 from cmm.utils.modelform import get_modelform_non_unique_error_codes, get_modelform_error_messages
 from cmm.models.base import UniqueConstraintMixin, VersionedTable, HistoryTable
-from cmm.csv import CsvLog
+from cmm.csv import CsvLog, CsvForeignKey, ForeignKeyCache, CsvModelChoiceField, UniqueKeyResolver
 
 
 _logger = logging.getLogger(__name__)
@@ -27,6 +29,45 @@ class TooManyInvalidRowsError(Exception):
     def __str__(self):
         return self.message
 
+class CsvImportModelForm(ModelForm):
+    """CSV import用ModelFormのベースクラス
+        UniqueConstraintMixinを継承したModelは、ユニーク制約のチェックを行ごとではなくchunk単位で一括して行う
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if isinstance(self.instance, UniqueConstraintMixin):
+            self.instance.skip_unique_validation = True
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if isinstance(self.instance, UniqueConstraintMixin):
+            # pylint: disable = attribute-defined-outside-init
+            self._validate_unique = False
+        return cleaned_data
+
+    def _get_validation_exclusions(self):
+        """解決済みのForeign Keyは存在チェック(DB検索)を省く、limit_choices_toはForeignKeyCacheで確認済み"""
+        exclude = super()._get_validation_exclusions()
+        for name, field in self.fields.items():
+            value = self.cleaned_data.get(name)
+            if isinstance(field, CsvModelChoiceField) and isinstance(value, models.Model) and value.pk is not None:
+                exclude.add(name)
+        return exclude
+
+class CsvImportContext:
+    """CSV import一回分の間、行ごとに作り直す必要のない情報をまとめたもの"""
+    def __init__(self, modelform_class, model_fields: Tuple[str], default_values: Dict[str, Any],
+                 fk_cache: ForeignKeyCache, *, unique_key_resolver: UniqueKeyResolver = None,
+                 history_date=None, history_user=None):
+        # pylint: disable = too-many-arguments
+        self.modelform_class = modelform_class
+        self.model_fields = model_fields
+        self.default_values = default_values
+        self.fk_cache = fk_cache
+        self.unique_key_resolver = unique_key_resolver      # UniqueConstraintMixinを継承していないModelはNone
+        self.history_date = history_date or timezone.now()  # importロットの日時、変更履歴の日時とする
+        self.history_user = history_user    # 変更履歴のユーザー、Noneならsimple_historyがリクエストから取得する
+
 class CsvImportMixin:
     """CSV import処理にてカスタマイズ可能な共通属性とメソッドをまとめたもの
         # todo: language選択を可能にする
@@ -44,6 +85,12 @@ class CsvImportMixin:
     is_duplicate_available = False  # 重複容認ポリシー、ユニーク制限がある場合は無視される。
                                     # True: 重複行がインポートされる、False: 重複ポリシーに従う
     is_update_existing = True       # 重複処理ポリシー、True:取込データ優先、False:既存データ優先
+    is_replace_existing = True      # chunk内の重複行の処理ポリシー、True:後発優先、False:先発優先
+
+    is_bulk_history = True          # 変更履歴(simple_history)を行ごとではなくchunk単位で一括作成する
+
+    csv_foreign_keys = {}           # Foreign Keyの解決定義、{Modelの項目名: CsvForeignKey}
+    foreign_key_cache_size = 100000 # Foreign Keyキャッシュの上限件数
 
     def get_csv_columns(self) -> Tuple[str]:
         """CSVファイルの列名定義"""
@@ -53,10 +100,23 @@ class CsvImportMixin:
         """CSVと関連つけられるModelのfields"""
         return self.get_csv_columns()
         
+    def get_csv_foreign_keys(self) -> Dict[str, CsvForeignKey]:
+        """CSVの自然キーから解決するForeign Keyの定義"""
+        return self.csv_foreign_keys
+
     # pylint: disable = unused-argument
     def csv2model(self, csv_dict: Dict[str, str], *args, **kwargs) -> Dict[str, Any]:
-        """デフォルトでは同名項目を転送、必要に応じてOverride"""
-        return self.get_default_values() | {k:v for (k,v) in csv_dict.items() if k in self.get_model_fields()}
+        """デフォルトでは同名項目を転送、解決済みのForeign Keyがあれば上書きする。必要に応じてOverride
+            kwargs['foreign_keys']: {Modelの項目名: 解決済みのModelインスタンス}
+            kwargs['model_fields'], kwargs['default_values']: import開始時に取得済みの値、なければ都度取得する
+        """
+        model_fields = kwargs.get('model_fields') or self.get_model_fields()
+        default_values = kwargs.get('default_values')
+        if default_values is None:
+            default_values = self.get_default_values()
+
+        return default_values | {k:v for (k,v) in csv_dict.items() if k in model_fields} \
+                    | kwargs.get('foreign_keys', {})
 
     def get_skippable_errors(self, modelform, *args, **kwargs) -> Set[str]:
         """ModelForm.Clean()チェックのエラーのなかでスキップできるものを設定する（エラー行ではなくスキップ行としてマークする）"""
@@ -77,10 +137,56 @@ class CsvImportMixin:
     def post_import_processing(self, *args, **kwargs):
         """CSV importの後処理"""
 
-    def save_imported_data(self, chunk: List[CsvLog]) -> List[CsvLog]:
+    def validate_chunk(self, rows: List[CsvLog]) -> None:
+        """chunk全体での入力チェック、行ごとのチェックを通過した行が渡される。必要に応じてOverride
+            エラー行はlog_levelにCsvLog.ERROR、messageにエラー内容をセットする
+        """
+
+    def save_imported_data(self, chunk: List[CsvLog], context: CsvImportContext) -> List[CsvLog]:
         """ modelformのsave"""
+        is_bulk_history = self.is_bulk_history and self.get_history_manager() is not None
+        created, updated = [], []
         for csv_log in chunk:
-            self.model(**csv_log.modelform.cleaned_data).save()
+            obj = self.model(**csv_log.modelform.cleaned_data)
+            if hasattr(csv_log, 'existing_record'):
+                # chunk単位で検索済みの既存レコードを渡して、save時の再検索を省く
+                obj.set_unique_key_record(csv_log.existing_record)
+            if is_bulk_history:
+                # post_saveシグナルによる行ごとの変更履歴作成を抑止する
+                obj.skip_history_when_saving = True
+            else:
+                # pylint: disable = protected-access
+                obj._history_date = context.history_date
+                if context.history_user is not None:
+                    obj._history_user = context.history_user
+            obj.save()
+
+            # 変更がなく保存をスキップした行は_state.addingがTrueのまま
+            # pylint: disable = protected-access
+            if is_bulk_history and not obj._state.adding:
+                (updated if csv_log.edit_type == CsvLog.UPDATE else created).append(obj)
+
+        if is_bulk_history:
+            self.save_history(created, updated, context.history_date, context.history_user)
+
+    def get_history_manager(self):
+        """変更履歴(simple_history)のManager、変更履歴を持たないModelはNone"""
+        # pylint: disable = protected-access
+        manager_attribute = getattr(self.model._meta, 'simple_history_manager_attribute', None)
+        return getattr(self.model, manager_attribute) if manager_attribute else None
+
+    def save_history(self, created: List[models.Model], updated: List[models.Model],
+                     history_date=None, history_user=None) -> None:
+        """変更履歴をchunk単位で一括作成する、履歴日時はimportロットの日時(CsvImportContext.history_date)とする"""
+        history = self.get_history_manager()
+        if history is None:
+            return
+
+        history_date = history_date or timezone.now()
+        for objs, is_update in ((created, False), (updated, True)):
+            if objs:
+                history.bulk_history_create(objs, update=is_update, default_date=history_date,
+                                            default_user=history_user)
 
     def __is_resolve_duplicate(self):
         """重複チェックの実施有無。"""
@@ -92,20 +198,42 @@ class CsvImportMixin:
         
         return False             # 重複チェックなし、重複行はそのままインポートされる
 
-    def __get_modelform_class(self):
-        """Dynamically generate ModelForm class"""
+    def __get_modelform_class(self, model_fields: Tuple[str], default_values: Dict[str, Any]):
+        """Dynamically generate ModelForm class, import一回につき一度だけ生成する"""
         def disable_formfield(db_field, **kwargs):
+            if isinstance(db_field, models.ForeignKey):
+                # csv2modelで解決済みのインスタンスを再検索しない
+                kwargs['form_class'] = CsvModelChoiceField
             form_field = db_field.formfield(**kwargs)
             if form_field:
                 form_field.widget.attrs['disabled'] = 'true'
             return form_field
 
-        form_fields = list(set(self.get_model_fields() + tuple(k for k in self.get_default_values())))
-        return modelform_factory(self.model, fields = form_fields, formfield_callback = disable_formfield)
-
-    def __validate_by_modelform(self, csv_log: CsvLog):
+        form_fields = list(set(model_fields + tuple(k for k in default_values)))
+        return modelform_factory(self.model, form = CsvImportModelForm, fields = form_fields,
+                                 formfield_callback = disable_formfield)
+
+    def __get_import_context(self, history_date=None, history_user=None) -> CsvImportContext:
+        """import一回分の共通情報を用意する"""
+        model_fields = tuple(self.get_model_fields())
+        default_values = self.get_default_values()
+        return CsvImportContext(modelform_class = self.__get_modelform_class(model_fields, default_values),
+                                model_fields = model_fields,
+                                default_values = default_values,
+                                fk_cache = ForeignKeyCache(self.get_csv_foreign_keys(), self.foreign_key_cache_size,
+                                                           self.model),
+                                unique_key_resolver = UniqueKeyResolver(self.model) \
+                                    if issubclass(self.model, UniqueConstraintMixin) else None,
+                                history_date = history_date,
+                                history_user = history_user)
+
+    def __validate_by_modelform(self, csv_log: CsvLog, context: CsvImportContext):
         """ModelFormの入力チェックを実施"""
-        modelform = self.__get_modelform_class()(self.csv2model(csv_log.row_content))
+        model_dict = self.csv2model(csv_log.row_content,
+                                    foreign_keys = context.fk_cache.resolve(csv_log.row_content),
+                                    model_fields = context.model_fields,
+                                    default_values = context.default_values)
+        modelform = context.modelform_class(model_dict)
 
         if modelform.is_valid():
             csv_log.log_level = CsvLog.INFO
@@ -132,43 +260,60 @@ class CsvImportMixin:
         
         return csv_log
         
+    def __resolve_existing_rows(self, rows: List[CsvLog], resolver: UniqueKeyResolver) -> None:
+        """ユニーク・キーに一致する既存レコードをchunk単位で一括検索し、新規・更新・スキップを判定する"""
+        valid_rows = [csv_log for csv_log in rows if csv_log.log_level == CsvLog.INFO]
+        if not valid_rows:
+            return
+
+        existing = resolver.retrieve(csv_log.modelform.instance for csv_log in valid_rows)
+        for csv_log in valid_rows:
+            csv_log.existing_record = existing.get(resolver.get_key(csv_log.modelform.instance))
+            if csv_log.existing_record is None:
+                continue
+
+            if self.is_update_existing:
+                csv_log.edit_type = CsvLog.UPDATE
+                csv_log.message = _("Update existing row.")
+            else:
+                csv_log.log_level = CsvLog.WARN     # DBと重複したのでスキップする
+                csv_log.message = _('Duplicated with an existing row.')
+
     def __is_too_many_errors(self, error_cnt: int) -> bool:
         error_limit = math.floor(self.chunk_size * self.water_mark / 100)
         return error_cnt > error_limit
 
-    def __get_duplicated(self, csv_log: CsvLog, chunk: List[CsvLog]) -> CsvLog:
-        """chunk内での重複行を取得する"""
-        if issubclass(self.model, UniqueConstraintMixin) and hasattr(csv_log, 'model_form'):
-            obj = csv_log.modelform.instance
-            for row in chunk:
-                if all(getattr(row.modelform.instance, f, None) == getattr(obj, f, None) \
-                        for f in obj.get_unique_key()):
-                    return row
-            return None
-        
-        for row in chunk:
-            if csv_log.row_content == row.row_content:
-                return row
+    def __get_duplication_key(self, csv_log: CsvLog, context: CsvImportContext) -> Hashable:
+        """chunk内の重複判定に使うキー、ユニーク・キーがあればその値、なければ行の内容"""
+        if context.unique_key_resolver is not None and context.unique_key_resolver.unique_key:
+            return ('unique_key', context.unique_key_resolver.get_key(csv_log.modelform.instance))
 
-        return None
+        return ('row_content', tuple(csv_log.row_content.items()))
 
-    def __resolve_duplication(self, csv_log: CsvLog, chunk: List[CsvLog]) -> None:
-        """chunkに重複行がなければそのまま追加、あれば入れ替え。"""
-        duplicated = self.__get_duplicated(csv_log, chunk)
+    def __resolve_duplication(self, csv_log: CsvLog, index: Dict[Hashable, CsvLog],
+                              context: CsvImportContext) -> None:
+        """chunkに重複行がなければ索引に追加、あれば入れ替え。索引は重複判定キーごとのDB反映候補行"""
+        if csv_log.log_level != CsvLog.INFO:    # エラー行とスキップ行は重複判定の対象外
+            return
+
+        key = self.__get_duplication_key(csv_log, context)
+        duplicated = index.get(key)
         if duplicated is None:
+            index[key] = csv_log
             return
 
         if self.is_replace_existing:            # 後発優先の場合、元の行をスキップし、現在行をDB反映候補とする
             duplicated.log_level = CsvLog.WARN
             duplicated.message = _('Duplicated with another row.[row no: %(row_no)s.]') \
                                     % {"row_no": csv_log.row_no}
+            index[key] = csv_log
         else:                                   # 先発優先：現在行をスキップする
             csv_log.log_level = CsvLog.WARN
             csv_log.message = _('Duplicated with another row.[row no: %(row_no)s.]') \
                                     % {"row_no": duplicated.row_no}
 
     @transaction.atomic
-    def __save(self, chunk) -> None:
+    def __save(self, chunk, context: CsvImportContext) -> None:
         """DB保存処理"""
         imported_data = []
 
@@ -180,11 +325,13 @@ class CsvImportMixin:
                 csv_log.modelform.cleaned_data['update_time'] = update_time
                 csv_log.modelform.cleaned_data['create_time'] = update_time
                 if issubclass(self.model, VersionedTable):
-                    csv_log.modelform.cleaned_data['version'] = 1
+                    existing_record = getattr(csv_log, 'existing_record', None)
+                    csv_log.modelform.cleaned_data['version'] = existing_record.version \
+                                            if existing_record is not None and existing_record.version else 1
                 imported_data.append(csv_log)
 
         # 正常データをインポート先Tableに保存
-        self.save_imported_data(imported_data)
+        self.save_imported_data(imported_data, context)
         
         if self.is_save_log2database and imported_data:
             # 正常取り込みもlogテーブルに記録する
@@ -206,15 +353,21 @@ class CsvImportMixin:
         """インポートログ情報をDBに記録する"""
         CsvLog.objects.bulk_create([csv_log.convert_content2json() for csv_log in chunk])
     
-    def read_csv_file(self, csv_file, login_user_name: str, lot_number: str) -> int:
+    def read_csv_file(self, csv_file, login_user_name: str, lot_number: str,
+                      history_date=None, history_user=None) -> int:
         """CSVファイルの読み込み処理
             性能を考慮してchunkごとに読み込んでDBに保存する
+            Foreign Keyはchunkごとにまとめて検索し、importが終わるまでキャッシュする
+            history_date: 変更履歴の日時(importロットの日時)、省略時は読み込み開始日時
+            history_user: 変更履歴のユーザー、リクエストのないスレッドから呼ぶ場合は指定する
         """
         text_wrapper = io.TextIOWrapper(csv_file, encoding = self.encoding)
         csv_reader = csv.reader(text_wrapper, dialect = self.dialect)
+        context = self.__get_import_context(history_date, history_user)
+        csv_columns = self.get_csv_columns()
 
         row_no = 0
-        chunk = []              # list[CsvLog]
+        rows = []               # list[CsvLog], 未検証の読込行
         error_cnt = 0
         for row in csv_reader:
             row_no += 1
@@ -223,35 +376,124 @@ class CsvImportMixin:
             if row_no <= self.header_row_number or not row:
                 continue
 
-            csv_log = CsvLog(file_name = csv_file.name,
-                             row_no = row_no,
-                             row_content = dict(zip(self.get_csv_columns(), row)),
-                             creator = login_user_name,
-                             lot_number = lot_number)
-            
-            self.__validate_by_modelform(csv_log)
+            rows.append(CsvLog(file_name = csv_file.name,
+                               row_no = row_no,
+                               row_content = dict(zip(csv_columns, row)),
+                               creator = login_user_name,
+                               lot_number = lot_number))
+
+            if len(rows) >= self.chunk_size:
+                error_cnt = self.__import_chunk(rows, context, error_cnt)
+                if self.__is_too_many_errors(error_cnt):
+                    break
+                rows.clear()
+        else:
+            if rows:
+                self.__import_chunk(rows, context, error_cnt)
+
+        return row_no
+
+    def __import_chunk(self, rows: List[CsvLog], context: CsvImportContext, error_cnt: int) -> int:
+        """chunk単位で入力チェック、重複解消とDB保存を行う。累計エラー件数を返す"""
+        context.fk_cache.prefetch([csv_log.row_content for csv_log in rows])
+
+        for csv_log in rows:
+            self.__validate_by_modelform(csv_log, context)
+
+        if context.unique_key_resolver is not None:
+            self.__resolve_existing_rows(rows, context.unique_key_resolver)
+
+        self.validate_chunk([csv_log for csv_log in rows if csv_log.log_level == CsvLog.INFO])
+
+        chunk = []              # list[CsvLog]
+        duplication_index = {}  # {重複判定キー: CsvLog}
+        for csv_log in rows:
             if self.__is_resolve_duplicate():
-                self.__resolve_duplication(csv_log, chunk)
+                self.__resolve_duplication(csv_log, duplication_index, context)
             chunk.append(csv_log)
 
             if csv_log.log_level == CsvLog.ERROR:
                 error_cnt += 1
                 if self.__is_too_many_errors(error_cnt):
                     self.__save_csv_logs(chunk)
-                    break
-        
-            if len(chunk) >= self.chunk_size:
-                self.__save(chunk)
-                chunk.clear()
-        else:
-            if chunk:
-                self.__save(chunk)
+                    return error_cnt
 
-        return row_no
+        self.__save(chunk, context)
+        return error_cnt
 
 class CsvBulkImportMixin(CsvImportMixin):
-    """DBにbulk insertする、既存DBレコードの上書きは不可"""
+    """DBにbulk insertする、既存DBレコードの上書きは不可
+        HistoryTableはinsertしたキーのタイムラインの有効終了日をHistoryTable.rechain()で再計算する
+    """
     is_update_existing = False
     
-    def save_imported_data(self, chunk: List[CsvLog]) -> List[CsvLog]:
-        self.model.objects.bulk_create(self.model(**c.modelform.cleaned_data) for c in chunk)
+    def save_imported_data(self, chunk: List[CsvLog], context: CsvImportContext) -> List[CsvLog]:
+        objs = self.model.objects.bulk_create(self.model(**c.modelform.cleaned_data) for c in chunk)
+        if issubclass(self.model, HistoryTable):
+            self.model.rechain(objs)
+
+class CsvBulkUpsertMixin(CsvImportMixin):
+    """DBにbulk upsertする、既存DBレコードは上書きする
+        - 新規行をbulk_create、chunk単位で一括検索した既存行をpkでbulk_updateで保存する
+        - 既存行のバージョン番号はSQLで一括して+1する
+        - Model.save()を経由しないので、変更履歴(simple_history)はchunk単位で一括作成する
+        - HistoryTableはHistoryTable.apply_history()でタイムライン単位に有効期間を調整して一括保存する
+    """
+    is_update_existing = True
+    bulk_batch_size = 1000
+
+    def get_upsert_update_fields(self, unique_key: Tuple[str]) -> List[str]:
+        """既存レコードの上書き対象項目、ユニーク・キー、作成者、作成日時とバージョン番号は更新しない"""
+        # pylint: disable = protected-access
+        excluded = {*unique_key, 'creator', 'create_time', 'version'}
+        return [f.name for f in self.model._meta.concrete_fields if not f.primary_key and f.name not in excluded]
+
+    def save_imported_data(self, chunk: List[CsvLog], context: CsvImportContext) -> List[CsvLog]:
+        if issubclass(self.model, HistoryTable):
+            self.model.apply_history((self.model(**csv_log.modelform.cleaned_data) for csv_log in chunk),
+                                     batch_size=self.bulk_batch_size, history_date=context.history_date,
+                                     history_user=context.history_user)
+            return
+        if not issubclass(self.model, UniqueConstraintMixin):
+            super().save_imported_data(chunk, context)
+            return
+
+        resolver = UniqueKeyResolver(self.model)
+        if not resolver.unique_key:
+            super().save_imported_data(chunk, context)
+            return
+
+        created, updated = [], []
+        for csv_log in chunk:
+            obj = self.model(**csv_log.modelform.cleaned_data)
+            existing_record = getattr(csv_log, 'existing_record', None)
+            if existing_record is None:
+                created.append(obj)
+            elif hasattr(obj, 'has_same_contents') and obj.has_same_contents(existing_record):
+                _logger.debug("Skip to save the contents because no change was detected on %s.", obj)
+            else:
+                obj.pk = existing_record.pk
+                updated.append(obj)
+
+        updated_ids = [obj.pk for obj in updated]
+        self.__upsert(created, updated, resolver.unique_key)
+
+        if issubclass(self.model, VersionedTable):
+            for i in range(0, len(updated_ids), self.bulk_batch_size):
+                self.model.objects.filter(pk__in=updated_ids[i:i + self.bulk_batch_size]) \
+                                  .update(version=Coalesce(F('version'), 0) + 1)
+
+        if self.get_history_manager() is not None and (created or updated):
+            # Model.save()を経由しないので、保存後のレコードを読み直して変更履歴を一括作成する
+            saved = resolver.retrieve(created + updated)
+            self.save_history([saved[key] for key in map(resolver.get_key, created) if key in saved],
+                              [saved[key] for key in map(resolver.get_key, updated) if key in saved],
+                              context.history_date, context.history_user)
+
+    def __upsert(self, created: List[models.Model], updated: List[models.Model], unique_key: Tuple[str]) -> None:
+        """新規行はbulk_create、既存行は検索済みのpkでbulk_updateする
+            ユニーク・キーにNULLを許す項目がある場合、ON CONFLICTでは既存行と衝突しないのでupsertは使わない
+        """
+        self.model.objects.bulk_create(created, batch_size=self.bulk_batch_size)
+        self.model.objects.bulk_update(updated, self.get_upsert_update_fields(unique_key),
+                                       batch_size=self.bulk_batch_size)
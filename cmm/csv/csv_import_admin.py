@@ -1,16 +1,19 @@
 import logging
+from typing import Any, Dict
 
+from django.contrib import messages
 from django.core.exceptions import PermissionDenied
 from django.db import transaction
 from django.forms import FileField, Form
-from django.shortcuts import redirect
+from django.http import JsonResponse
+from django.shortcuts import get_object_or_404, redirect
 from django.template.response import TemplateResponse
-from django.urls import path, reverse_lazy
+from django.urls import path, reverse
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from cmm.const import IMPORT_CSV
 
-from cmm.csv import CsvLog
+from cmm.csv import CsvLog, CsvImportJob, spool_upload_file, submit_import_job
 
 
 _logger = logging.getLogger(__name__)
@@ -27,6 +30,10 @@ class CsvImportAdminMixin():
 
     # change_list_template = 'cmm/change_list_with_csv_import.html'
     import_template = 'cmm/csv_import.html'
+    import_progress_template = 'cmm/csv_import_progress.html'
+
+    is_background_import = True     # True: アップロードファイルをディスクに書き出し、バックグラウンドでimportする
+    import_poll_interval = 2000     # 進捗画面のポーリング間隔(ミリ秒)
 
     def has_import_csv_permission(self, request) -> bool:
         """CSV import権限有無のチェック"""
@@ -50,27 +57,55 @@ class CsvImportAdminMixin():
         import_url = [
             path('csv_import/', self.admin_site.admin_view(self.import_action),
                     name=f'{opts.app_label}_{opts.model_name}_csv_import'),
+            path('csv_import/<str:lot_number>/progress/', self.admin_site.admin_view(self.import_progress_view),
+                    name=f'{opts.app_label}_{opts.model_name}_csv_import_progress'),
+            path('csv_import/<str:lot_number>/status/', self.admin_site.admin_view(self.import_status_view),
+                    name=f'{opts.app_label}_{opts.model_name}_csv_import_status'),
+            path('csv_import/<str:lot_number>/result/', self.admin_site.admin_view(self.import_result_view),
+                    name=f'{opts.app_label}_{opts.model_name}_csv_import_result'),
         ]
         return import_url + super().get_urls()
 
-    @transaction.non_atomic_requests
-    def import_action(self, request):
-        """CSV import処理"""
-        if not self.has_import_csv_permission(request):
-            _logger.info('Trying to import CSV file without permission.')
-            raise PermissionDenied
-
+    def __get_context(self, request, title) -> Dict[str, Any]:
+        """CSV import画面の共通context"""
         # pylint: disable = protected-access
-        opts = self.model._meta
-        title = _('Import %(name)s') % {'name': opts.verbose_name}
-        context = {
+        return {
             **self.admin_site.each_context(request),
             'title': title,
             'app_list': self.admin_site.get_app_list(request),
-            'opts': opts,
+            'opts': self.model._meta,
             'has_view_permission': self.has_view_permission(request),
         }
 
+    def __check_import_csv_permission(self, request) -> None:
+        if not self.has_import_csv_permission(request):
+            _logger.info('Trying to import CSV file without permission.')
+            raise PermissionDenied
+
+    def __get_job(self, lot_number: str) -> CsvImportJob:
+        """このModelのCSV importジョブ、プロセスの再起動などで終了しないまま残ったジョブは失敗として終了する"""
+        # pylint: disable = protected-access
+        job = get_object_or_404(CsvImportJob, lot_number=lot_number, model_label=self.model._meta.label)
+        job.fail_if_stale()
+        return job
+
+    def __get_url(self, request, url_name: str, *args) -> str:
+        # pylint: disable = protected-access
+        opts = self.model._meta
+        return reverse(f'{request.resolver_match.namespace}:{opts.app_label}_{opts.model_name}_{url_name}',
+                       args=args)
+
+    @transaction.non_atomic_requests
+    def import_action(self, request):
+        """CSV import処理
+            is_background_importの場合はファイルをディスクに書き出してジョブを登録し、進捗画面に遷移する
+        """
+        self.__check_import_csv_permission(request)
+
+        # pylint: disable = protected-access
+        opts = self.model._meta
+        context = self.__get_context(request, _('Import %(name)s') % {'name': opts.verbose_name})
+
         # インポートファイルの選択画面表示
         if request.method == "GET":
             form = CsvImportForm()
@@ -82,39 +117,88 @@ class CsvImportAdminMixin():
                 csv_file = form.cleaned_data['import_file']     # django.core.files.uploadedfile.InMemoryUploadedFile
                 _logger.info('Importing CSV file %s into %s.', csv_file.name, opts.model_name)
 
+                lot_number = str(hash(csv_file.name + request.user.username + str(timezone.now())))
+
+                if self.is_background_import:
+                    spool_path, line_cnt = spool_upload_file(csv_file)
+                    job = CsvImportJob.objects.create(lot_number=lot_number,
+                                                      model_label=opts.label,
+                                                      file_name=csv_file.name,
+                                                      spool_path=spool_path,
+                                                      total_rows=max(line_cnt - self.header_row_number, 0),
+                                                      creator=request.user.username)
+                    submit_import_job(self, job)
+                    return redirect(self.__get_url(request, 'csv_import_progress', lot_number))
+
                 # インポートファイルを読み込む前の処理
                 self.pre_import_processing()
 
-                row_cnt = 0
-                lot_number = str(hash(csv_file.name + request.user.username + str(timezone.now())))
-
                 # インポートファイルの読み込み処理
-                row_cnt = self.read_csv_file(csv_file, request.user.username, lot_number)
+                row_cnt = self.read_csv_file(csv_file, request.user.username, lot_number,
+                                             history_user=request.user)
 
                 # インポートファイルを読み込みがすべて完了した後の処理
                 self.post_import_processing(lot_number=lot_number)
 
-                # ログ情報収集
-                queryset = CsvLog.objects.filter(lot_number=lot_number)
-                # 読み飛ばしたレコード
-                skipped = list(queryset.filter(log_level=CsvLog.WARN).order_by('row_no'))
-                # エラーで破棄したレコード
-                discarded = list(queryset.filter(log_level=CsvLog.ERROR).order_by('row_no'))
-                imported = row_cnt - self.header_row_number - len(skipped) - len(discarded)
-                info = _('Import result: imported %(imp)s rows, skipped %(skip)s rows and discardeded: %(dis)s rows.')%{
-                         'imp': imported, 'skip': len(skipped), 'dis': len(discarded)}
-                _logger.info(info)
-                
-                if discarded or skipped:
-                    context['title'] = _('%(name)s import errors')% {'name': opts.verbose_name}
-                    context['field_names'] = self.get_csv_columns()
-                    context['csv_logs'] = [csv_log.convert_content2values() for csv_log in discarded] \
-                                        + [csv_log.convert_content2values() for csv_log in skipped]
-                    context['info'] = info
-                    return TemplateResponse(request, 'cmm/csv_import_error.html', context)
-                
-                return redirect(reverse_lazy(
-                    f'{request.resolver_match.namespace}:{opts.app_label}_{opts.model_name}_changelist'))
+                return self.__get_import_result_response(request, lot_number, row_cnt)
 
         context['form'] = form
-        return TemplateResponse(request, 'cmm/csv_import.html', context)
+        return TemplateResponse(request, self.import_template, context)
+
+    def __get_import_result_response(self, request, lot_number: str, row_cnt: int):
+        """インポート結果、エラーがあれば一覧を表示し、なければ一覧画面に戻る"""
+        # pylint: disable = protected-access
+        opts = self.model._meta
+
+        # ログ情報収集
+        queryset = CsvLog.objects.filter(lot_number=lot_number)
+        # 読み飛ばしたレコード
+        skipped = list(queryset.filter(log_level=CsvLog.WARN).order_by('row_no'))
+        # エラーで破棄したレコード
+        discarded = list(queryset.filter(log_level=CsvLog.ERROR).order_by('row_no'))
+        imported = row_cnt - self.header_row_number - len(skipped) - len(discarded)
+        info = _('Import result: imported %(imp)s rows, skipped %(skip)s rows and discardeded: %(dis)s rows.')%{
+                 'imp': imported, 'skip': len(skipped), 'dis': len(discarded)}
+        _logger.info(info)
+
+        if discarded or skipped:
+            context = self.__get_context(request, _('%(name)s import errors')% {'name': opts.verbose_name})
+            context['field_names'] = self.get_csv_columns()
+            context['csv_logs'] = [csv_log.convert_content2values() for csv_log in discarded] \
+                                + [csv_log.convert_content2values() for csv_log in skipped]
+            context['info'] = info
+            return TemplateResponse(request, 'cmm/csv_import_error.html', context)
+
+        return redirect(self.__get_url(request, 'changelist'))
+
+    def import_progress_view(self, request, lot_number: str):
+        """バックグラウンドで実行中のCSV importの進捗画面、状況はimport_status_viewをポーリングして表示する"""
+        self.__check_import_csv_permission(request)
+        job = self.__get_job(lot_number)
+
+        # pylint: disable = protected-access
+        context = self.__get_context(request, _('Import %(name)s') % {'name': self.model._meta.verbose_name})
+        context['job'] = job
+        context['result_url'] = self.__get_url(request, 'csv_import_result', lot_number)
+        context['poll_config'] = {'status_url': self.__get_url(request, 'csv_import_status', lot_number),
+                                  'result_url': context['result_url'],
+                                  'interval': self.import_poll_interval}
+        return TemplateResponse(request, self.import_progress_template, context)
+
+    def import_status_view(self, request, lot_number: str):
+        """CSV importの進捗状況をJSONで返す"""
+        self.__check_import_csv_permission(request)
+        return JsonResponse(self.__get_job(lot_number).get_progress())
+
+    def import_result_view(self, request, lot_number: str):
+        """バックグラウンドで実行したCSV importの結果画面"""
+        self.__check_import_csv_permission(request)
+        job = self.__get_job(lot_number)
+        if not job.is_finished:
+            return redirect(self.__get_url(request, 'csv_import_progress', lot_number))
+
+        if job.status == CsvImportJob.FAILED:
+            messages.error(request, _('Failed to import %(file_name)s: %(message)s') % {
+                                'file_name': job.file_name, 'message': job.message})
+
+        return self.__get_import_result_response(request, lot_number, job.row_cnt or 0)
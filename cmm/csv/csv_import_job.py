@@ -0,0 +1,229 @@
+import io
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import close_old_connections, connection, models, transaction
+from django.db.models import Count
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+
+from cmm.csv.csv_log import CsvLog
+
+
+_logger = logging.getLogger(__name__)
+
+class CsvImportJob(models.Model):
+    """バックグラウンドで実行するCSV importのジョブ、進捗はlot_numberでCsvLogを集計する"""
+    QUEUED = 'queued'           # 実行待ち
+    RUNNING = 'running'         # 実行中
+    DONE = 'done'               # 正常終了
+    FAILED = 'failed'           # 異常終了
+
+    STATUS_CHOICES = [
+        (QUEUED, _('Queued')),
+        (RUNNING, _('Running')),
+        (DONE, _('Done')),
+        (FAILED, _('Failed')),
+    ]
+
+    lot_number = models.CharField(max_length=64, unique=True, verbose_name=_('lot number'))
+    model_label = models.CharField(max_length=120, verbose_name=_('model label'))
+    file_name = models.CharField(max_length=120, blank=True, null=True, verbose_name=_('file name'))
+    spool_path = models.CharField(max_length=512, blank=True, null=True, verbose_name=_('spool path'))
+    status = models.CharField(max_length=12, choices=STATUS_CHOICES, default=QUEUED, verbose_name=_('job status'))
+    total_rows = models.IntegerField(default=0, verbose_name=_('total rows'))     # アップロード時の概算行数
+    row_cnt = models.IntegerField(blank=True, null=True, verbose_name=_('read rows'))  # 読込済み行数、終了時に確定
+    message = models.CharField(max_length=2048, blank=True, null=True, verbose_name=_('message'))
+    creator = models.CharField(max_length=120, blank=True, null=True, verbose_name=_('creator'))
+    create_time = models.DateTimeField(default=timezone.now, verbose_name=_('create time'))
+    start_time = models.DateTimeField(blank=True, null=True, verbose_name=_('start time'))
+    end_time = models.DateTimeField(blank=True, null=True, verbose_name=_('end time'))
+
+    class Meta:
+        db_table = 'cmm_csv_import_job'
+        verbose_name = _('csv import job')
+        verbose_name_plural = _('csv import jobs')
+        default_permissions = []
+
+        ordering = ['-create_time']
+
+    @property
+    def is_finished(self) -> bool:
+        """終了済みか"""
+        return self.status in (self.DONE, self.FAILED)
+
+    @property
+    def is_stale(self) -> bool:
+        """プロセスの再起動などで終了しないまま残ったジョブか、実行待ちまたは実行開始からタイムアウトを過ぎたもの"""
+        return not self.is_finished and (self.start_time or self.create_time) < get_stale_time()
+
+    def fail_if_stale(self) -> bool:
+        """残ったジョブを失敗として終了し、ディスクに書き出したファイルを削除する。終了した場合はTrue"""
+        if not self.is_stale:
+            return False
+
+        # 他のスレッドで終了した場合は更新しない
+        end_time = timezone.now()
+        message = str(_('The import job was interrupted.'))
+        if not CsvImportJob.objects.filter(pk=self.pk, status=self.status) \
+                                   .update(status=self.FAILED, message=message, end_time=end_time):
+            self.refresh_from_db()
+            return False
+
+        _logger.warning('Import job was interrupted. [lot: %s, status: %s]', self.lot_number, self.status)
+        self.status, self.message, self.end_time = self.FAILED, message, end_time
+        remove_spool_file(self.spool_path)
+        return True
+
+    def get_log_counts(self) -> Dict[str, int]:
+        """ログレベルごとのCsvLog件数"""
+        counts = CsvLog.objects.filter(lot_number=self.lot_number) \
+                               .values('log_level').annotate(cnt=Count('id')).order_by()
+        return {CsvLog.INFO: 0, CsvLog.WARN: 0, CsvLog.ERROR: 0} | {c['log_level']: c['cnt'] for c in counts}
+
+    def get_progress(self) -> Dict:
+        """進捗状況、JSONでそのまま返せる形にする
+            is_save_log2database = Falseの場合、正常行はCsvLogに記録されないので件数に含まれない
+        """
+        counts = self.get_log_counts()
+        return {
+            'lot_number': self.lot_number,
+            'status': self.status,
+            'finished': self.is_finished,
+            'total': self.total_rows,
+            'processed': sum(counts.values()),
+            'imported': counts[CsvLog.INFO],
+            'skipped': counts[CsvLog.WARN],
+            'discarded': counts[CsvLog.ERROR],
+            'message': self.message or '',
+        }
+
+def get_stale_time() -> datetime:
+    """これより前に登録・開始して終了していないジョブは残ったものとみなす
+        settings.CSV_IMPORT_JOB_TIMEOUT(秒)で変更可能、最も長いimportより長くすること
+    """
+    return timezone.now() - timedelta(seconds=getattr(settings, 'CSV_IMPORT_JOB_TIMEOUT', 6 * 60 * 60))
+
+def fail_stale_jobs() -> int:
+    """残ったジョブを失敗として終了し、どのジョブからも参照されない古いファイルを削除する。終了したジョブの件数を返す"""
+    stale_time = get_stale_time()
+    unfinished = CsvImportJob.objects.filter(status__in=[CsvImportJob.QUEUED, CsvImportJob.RUNNING])
+    failed = sum(job.fail_if_stale() for job in unfinished.filter(create_time__lt=stale_time))
+
+    spool_dir = get_spool_dir()
+    active_paths = set(unfinished.values_list('spool_path', flat=True))
+    for entry in os.scandir(spool_dir):
+        if entry.is_file() and entry.path not in active_paths \
+                and entry.stat().st_mtime < stale_time.timestamp():
+            remove_spool_file(entry.path)
+    return failed
+
+def get_spool_dir() -> str:
+    """アップロードファイルの一時保存先、settings.CSV_IMPORT_SPOOL_DIRで変更可能"""
+    spool_dir = getattr(settings, 'CSV_IMPORT_SPOOL_DIR', None) \
+                    or os.path.join(tempfile.gettempdir(), 'cmm_csv_import')
+    os.makedirs(spool_dir, exist_ok=True)
+    return spool_dir
+
+def spool_upload_file(upload_file) -> tuple[str, int]:
+    """アップロードファイルをディスクに書き出す。保存先のパスと概算の行数(改行数)を返す"""
+    line_cnt = 0
+    last_byte = b'\n'
+    with tempfile.NamedTemporaryFile(dir=get_spool_dir(), suffix='.csv', delete=False) as spool_file:
+        for chunk in upload_file.chunks():
+            spool_file.write(chunk)
+            line_cnt += chunk.count(b'\n')
+            last_byte = chunk[-1:] or last_byte
+
+    if last_byte != b'\n':
+        line_cnt += 1
+    return spool_file.name, line_cnt
+
+def remove_spool_file(spool_path: str) -> None:
+    """ディスクに書き出したファイルを削除する"""
+    if not spool_path:
+        return
+    try:
+        os.remove(spool_path)
+    except FileNotFoundError:
+        pass
+    except OSError:
+        _logger.warning('Could not remove spooled file %s.', spool_path)
+
+def open_spooled_file(spool_path: str, file_name: str) -> io.BufferedReader:
+    """ディスクに書き出したCSVファイルを開く、nameはアップロード時のファイル名とする"""
+    raw = io.FileIO(spool_path, 'rb')
+    raw.name = file_name
+    return io.BufferedReader(raw)
+
+_executor = None       # pylint: disable = invalid-name
+_executor_lock = threading.Lock()
+
+def get_import_executor() -> ThreadPoolExecutor:
+    """CSV importを実行するプロセス内のスレッドプール、settings.CSV_IMPORT_MAX_WORKERSで同時実行数を指定する
+        プロセスで最初に作成する時に、前回のプロセスが終了させずに残したジョブとファイルを片付ける
+    """
+    global _executor       # pylint: disable = global-statement
+    with _executor_lock:
+        if _executor is None:
+            fail_stale_jobs()
+            _executor = ThreadPoolExecutor(max_workers=getattr(settings, 'CSV_IMPORT_MAX_WORKERS', 2),
+                                            thread_name_prefix='csv_import')
+    return _executor
+
+def get_history_user(job: CsvImportJob):
+    """変更履歴のユーザー、ワーカースレッドにはリクエストがないのでジョブの登録者から取得する"""
+    user_model = get_user_model()
+    return user_model.objects.filter(**{user_model.USERNAME_FIELD: job.creator}).first() if job.creator else None
+
+def run_import_job(modeladmin, job_id: int) -> None:
+    """CSV importジョブを実行する、終了時にディスクに書き出したファイルを削除する
+        変更履歴の日時はジョブの開始日時、ユーザーはジョブの登録者とする
+    """
+    job = CsvImportJob.objects.get(pk=job_id)
+    start_time = timezone.now()
+    # 実行待ちの間に失敗として終了したジョブ(fail_if_stale)は実行しない
+    if not CsvImportJob.objects.filter(pk=job.pk, status=CsvImportJob.QUEUED) \
+                               .update(status=CsvImportJob.RUNNING, start_time=start_time):
+        _logger.warning('Import job is not queued any more. [lot: %s, status: %s]', job.lot_number, job.status)
+        return
+    job.status, job.start_time = CsvImportJob.RUNNING, start_time
+    _logger.info('Start importing CSV file %s into %s. [lot: %s]', job.file_name, job.model_label, job.lot_number)
+
+    try:
+        with open_spooled_file(job.spool_path, job.file_name) as csv_file:
+            modeladmin.pre_import_processing()
+            job.row_cnt = modeladmin.read_csv_file(csv_file, job.creator, job.lot_number,
+                                                   history_date=job.start_time, history_user=get_history_user(job))
+            modeladmin.post_import_processing(lot_number=job.lot_number)
+        job.status = CsvImportJob.DONE
+    except Exception as e:      # pylint: disable = broad-exception-caught
+        _logger.exception('Failed to import CSV file %s. [lot: %s]', job.file_name, job.lot_number)
+        job.status = CsvImportJob.FAILED
+        job.message = str(e)[:2048]
+    finally:
+        job.end_time = timezone.now()
+        # 実行中に失敗として終了したジョブ(fail_if_stale)の状態は上書きしない
+        if not CsvImportJob.objects.filter(pk=job.pk, status=CsvImportJob.RUNNING) \
+                                   .update(status=job.status, row_cnt=job.row_cnt, message=job.message,
+                                           end_time=job.end_time):
+            _logger.warning('Import job was finished by another thread. [lot: %s]', job.lot_number)
+        remove_spool_file(job.spool_path)
+
+def _run_in_worker(modeladmin, job_id: int) -> None:
+    """スレッドプールから呼ばれる、DB接続はスレッドごとに開閉する"""
+    close_old_connections()
+    try:
+        run_import_job(modeladmin, job_id)
+    finally:
+        connection.close()
+
+def submit_import_job(modeladmin, job: CsvImportJob) -> None:
+    """ジョブをスレッドプールに投入する。ジョブ登録のトランザクションが確定してから実行する"""
+    transaction.on_commit(lambda: get_import_executor().submit(_run_in_worker, modeladmin, job.pk))
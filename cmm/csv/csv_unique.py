@@ -0,0 +1,30 @@
+from typing import Dict, Iterable, Tuple
+from django.db import models
+
+
+class UniqueKeyResolver:
+    """chunk内のユニーク・キーに一致する既存レコードを一回の検索でまとめて取得する
+        検索はUniqueConstraintMixin.retrieve_many_by_unique_key()に委譲し、ユニーク・キーはModelで解決済みのものを使う
+
+        model: UniqueConstraintMixinを継承したModel
+    """
+    def __init__(self, model: models.Model):
+        self.model = model
+        self.unique_key = model.get_unique_key_fields()
+        self.attnames = model.unique_key_attnames
+
+    @property
+    def in_clause_size(self) -> int:
+        return self.model.in_clause_size
+
+    @property
+    def or_clause_size(self) -> int:
+        return self.model.or_clause_size
+
+    def get_key(self, obj: models.Model) -> Tuple:
+        """ユニーク・キーの値、Foreign Keyはidで比較する"""
+        return tuple(getattr(obj, attname) for attname in self.attnames)
+
+    def retrieve(self, instances: Iterable[models.Model]) -> Dict[Tuple, models.Model]:
+        """既存レコードを{ユニーク・キーの値: レコード}の形で取得する"""
+        return self.model.retrieve_many_by_unique_key(instances)
@@ -1,21 +1,50 @@
 import csv
+import io
 import logging
+import tempfile
 from urllib.parse import quote
-from datetime import date
+from typing import Any, Iterator, List
 from xlsxwriter.workbook import Workbook
 
-from django.http import HttpResponse
+from django.http import FileResponse, HttpResponse, HttpResponseBase, StreamingHttpResponse
 from django.contrib import admin
 from django.utils.translation import gettext_lazy as _
 
 from cmm.const import UTF8
+from cmm.csv.export_format import iter_value_batches
 
 
 _logger = logging.getLogger(__name__)
 
+def iter_csv_batches(modeladmin, queryset) -> Iterator[List[List[Any]]]:
+    """CSV出力行をchunkごとにまとめて返す、最初のchunkはタイトル行
+        queryset.iterator()でchunkごとに取得するので、件数に関わらずメモリ使用量は一定(PostgreSQLはサーバサイドカーソル)
+        列の変換（日付の出力フォーマット等）はexport開始時に作成した計画でchunk単位に行う
+    """
+    if modeladmin.get_export_titles():
+        yield [modeladmin.get_export_titles()]
+
+    plan = modeladmin.get_export_column_plan()
+    for batch in iter_value_batches(modeladmin, queryset, plan.fields):
+        yield plan.format_rows(batch)
+
+def stream_csv(modeladmin, queryset, file_name: str) -> Iterator[str]:
+    """CSVをchunkごとに文字列に変換して返す"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, modeladmin.dialect)
+    for rows in iter_csv_batches(modeladmin, queryset):
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+    _logger.info('CSV file %s is exported successfully.', file_name)
+
 @admin.display(description=_('export csv'))
-def export_csv(modeladmin, request, queryset) -> HttpResponse:
-    """CSV export処理"""
+def export_csv(modeladmin, request, queryset) -> HttpResponseBase:
+    """CSV export処理
+        modeladmin.csv_streamingの場合、StreamingHttpResponseで一行ずつ出力し、全件をメモリに保持しない
+    """
     # pylint: disable = unused-argument
     file_encoding = modeladmin.csv_encoding or UTF8
     file_name = modeladmin.model._meta.verbose_name_plural + modeladmin.csv_file_extension
@@ -23,53 +52,63 @@ def export_csv(modeladmin, request, queryset) -> HttpResponse:
 
     _logger.info('Start to exporting %s', file_name)
 
-    response = HttpResponse(content_type=f'text/csv; charset={file_encoding}')
+    content_type = f'text/csv; charset={file_encoding}'
+    if modeladmin.csv_streaming:
+        response = StreamingHttpResponse(stream_csv(modeladmin, queryset, file_name), content_type=content_type)
+    else:
+        response = HttpResponse(content_type=content_type)
+        writer = csv.writer(response, modeladmin.dialect)
+        for rows in iter_csv_batches(modeladmin, queryset):
+            writer.writerows(rows)
+        _logger.info('CSV file %s is exported successfully.', file_name)
+
     # quote()を使わないとファイル名がセットされない
     response['Content-Disposition'] = f'attachment; filename={quote(file_name)}'
-    writer = csv.writer(response, modeladmin.dialect)
-
-    if modeladmin.get_export_titles():
-        writer.writerow(modeladmin.get_export_titles())
-
-    for row_dict in queryset.values(*modeladmin.get_model_fields()):
-        # 日付型の出力フォーマットをセットする
-        values = [v.strftime(modeladmin.date_format) if isinstance(v, date) else v \
-                    for (k,v) in modeladmin.model2csv(row_dict).items()]
-        writer.writerow(values)
-
-    _logger.info('CSV file %s is exported successfully.', file_name)
     return response
 
 @admin.display(description=_('export excel'))
-def export_excel(modeladmin, request, queryset):
-    """Excel export処理"""
+def export_excel(modeladmin, request, queryset) -> HttpResponseBase:
+    """Excel export処理
+        modeladmin.excel_constant_memoryの場合、xlsxwriterのconstant_memoryモードで一時ファイルに書き出し、
+        FileResponseで返す。件数に関わらずメモリ使用量は一定
+    """
     # pylint: disable = unused-argument
     file_name = modeladmin.model._meta.verbose_name_plural + modeladmin.excel_file_extension
     
     _logger.info('Start to exporting %s', file_name)
 
-    response = HttpResponse(content_type='application/vnd.ms-excel')
-    # quote()を使わないと日本語ファイル名がセットされない
-    response['Content-Disposition'] = f'attachment; filename={quote(file_name)}'
-    
-    workbook = Workbook(response, {'in_memory': True})
+    if modeladmin.excel_constant_memory:
+        # closeされると削除される
+        spool_file = tempfile.TemporaryFile()   # pylint: disable = consider-using-with
+        workbook = Workbook(spool_file, {'constant_memory': True})
+        rows = queryset.values_list(*modeladmin.get_model_fields()).iterator(chunk_size=modeladmin.export_chunk_size)
+    else:
+        response = HttpResponse(content_type='application/vnd.ms-excel')
+        # quote()を使わないと日本語ファイル名がセットされない
+        response['Content-Disposition'] = f'attachment; filename={quote(file_name)}'
+        workbook = Workbook(response, {'in_memory': True})
+        rows = queryset.values_list(*modeladmin.get_model_fields())
+
     worksheet = workbook.add_worksheet(modeladmin.model._meta.model_name)
 
     row_num = 0
 
     # ヘッダー行の出力
     if modeladmin.get_export_titles():
-        for col_num, value in enumerate(modeladmin.get_export_titles()):
-            worksheet.write(row_num, col_num, value)
+        worksheet.write_row(row_num, 0, modeladmin.get_export_titles())
         row_num += 1
 
-    # 内容出力
-    for row in queryset.values_list(*modeladmin.get_model_fields()):
-        for col_num, value in enumerate(row):
-            worksheet.write(row_num, col_num, value)
+    # 内容出力、constant_memoryモードでは行順に書き込む必要がある
+    for row in rows:
+        worksheet.write_row(row_num, 0, row)
         row_num += 1
     
     workbook.close()
 
+    if modeladmin.excel_constant_memory:
+        spool_file.seek(0)
+        response = FileResponse(spool_file, as_attachment=True, filename=file_name,
+                                content_type='application/vnd.ms-excel')
+
     _logger.info('CSV file %s is exported successfully.', file_name)
     return response
@@ -1,6 +1,8 @@
 import logging
-from typing import Any, Dict, Tuple
+from typing import Any, Callable, Dict, List, Tuple
 from cmm.const import EXPORT_CSV, EXCEL_FILE_EXT, EXPORT_EXCEL, UTF8, CSV_FILE_EXT
+from cmm.csv.export_format import ExportFormat, export_format_registry
+from cmm.csv.export_plan import ExportColumnPlan
 
 
 _logger = logging.getLogger(__name__)
@@ -11,9 +13,17 @@ class ExportAdminMixin:
     csv_export = True
     csv_encoding = UTF8
     csv_file_extension = CSV_FILE_EXT
-    
+    csv_streaming = True            # True: StreamingHttpResponseで一行ずつ出力する
+    export_chunk_size = 2000        # queryset.iterator()で一回に取得する件数
+
     excel_export = True
     excel_file_extension = EXCEL_FILE_EXT
+    excel_constant_memory = True    # True: xlsxwriterのconstant_memoryモードで一時ファイルに書き出す
+
+    export_transforms = {}          # 列の変換関数、{Modelの項目名: 関数}。Noneの値には適用しない
+
+    # 追加のexport形式、register_export_formatで登録した名前を指定する。必要なライブラリがなければ表示しない
+    export_formats = ('export_jsonl', 'export_csv_gzip', 'export_parquet')
     
     def get_export_titles(self) -> Tuple[str]:
         """CSVファイルのタイトル行（第一行）を出力する"""
@@ -25,6 +35,20 @@ class ExportAdminMixin:
         """デフォルトでは同名項目を転送"""
         return {k:v for (k,v) in model.items() if k in self.get_csv_columns()}
 
+    def get_export_transforms(self) -> Dict[str, Callable[[Any], Any]]:
+        """export時の列の変換関数、日付型の列はdate_formatでの変換に代わって適用する"""
+        return self.export_transforms
+
+    def get_export_column_plan(self) -> ExportColumnPlan:
+        """export一回分の列の変換計画、model2csvをOverrideしている場合は行ごとにmodel2csvで変換する"""
+        return ExportColumnPlan.compile(self, is_row_conversion=type(self).model2csv is not ExportAdminMixin.model2csv)
+
+    def get_export_formats(self) -> List[ExportFormat]:
+        """利用可能な追加のexport形式"""
+        return [export_format_registry[name] for name in self.export_formats
+                    if name in export_format_registry and export_format_registry[name].is_available()
+                        and export_format_registry[name].is_enabled(self)]
+
     def get_actions(self, request):
         """Django admin list viewのアクションリストを取得する（アクションのプルダウンリスト）"""
         actions = super().get_actions(request)
@@ -40,4 +64,7 @@ class ExportAdminMixin:
             elif not self.excel_export and EXPORT_EXCEL in actions:
                 del actions[EXPORT_EXCEL]
 
+            for export_format in self.get_export_formats():
+                actions[export_format.name] = (export_format, export_format.name, export_format.description)
+
         return actions
@@ -0,0 +1,226 @@
+import csv
+import io
+import json
+import logging
+import zlib
+from typing import Dict, Iterator, List, Tuple
+from urllib.parse import quote
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models
+from django.http import HttpResponseBase, StreamingHttpResponse
+from django.utils.translation import gettext_lazy as _
+
+from cmm.const import UTF8
+from cmm.csv.export_plan import resolve_export_field
+
+try:
+    import pyarrow
+    from pyarrow import parquet
+except ImportError:
+    pyarrow = None                  # pylint: disable = invalid-name
+
+
+_logger = logging.getLogger(__name__)
+
+def iter_value_batches(modeladmin, queryset, fields: Tuple[str] = None) -> Iterator[List[Tuple]]:
+    """values_listのタプルをexport_chunk_size件ずつまとめて返す、サーバサイドカーソルで取得する
+        fields: 取得する項目、省略時はget_model_fields()
+    """
+    fields = fields or modeladmin.get_model_fields()
+    batch = []
+    for row in queryset.values_list(*fields).iterator(chunk_size=modeladmin.export_chunk_size):
+        batch.append(row)
+        if len(batch) >= modeladmin.export_chunk_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+class ParquetStreamSink(io.RawIOBase):
+    """ParquetWriterの書き込み先、書き込まれたバイト列を溜めてchunkごとに取り出す
+        row groupの位置をフッターに記録するため、tell()は取り出し済みを含む累計の書き込み位置を返す
+    """
+    def __init__(self):
+        super().__init__()
+        self.__chunks = []
+        self.__position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self.__chunks.append(bytes(b))
+        self.__position += len(b)
+        return len(b)
+
+    def tell(self) -> int:
+        return self.__position
+
+    def pop(self) -> bytes:
+        """前回の取り出し以後に書き込まれたバイト列"""
+        data = b''.join(self.__chunks)
+        self.__chunks.clear()
+        return data
+
+class ExportFormat:
+    """Export形式の定義、Admin actionとして呼び出せる
+
+        name:           action名、register_export_formatで登録する時のキー
+        description:    actionのプルダウンに表示する名前
+        file_extension: 出力ファイルの拡張子
+        content_type:   出力ファイルのContent-Type
+        model2csvは使わず、values_listのタプルをchunk単位で出力する
+    """
+    name = None
+    description = None
+    file_extension = None
+    content_type = 'application/octet-stream'
+
+    def is_available(self) -> bool:
+        """必要なライブラリがインストールされているか"""
+        return True
+
+    def is_enabled(self, modeladmin) -> bool:
+        """ModelAdminの設定でこの形式を使えるか"""
+        # pylint: disable = unused-argument
+        return True
+
+    def get_file_name(self, modeladmin) -> str:
+        """出力ファイル名"""
+        # pylint: disable = protected-access
+        return modeladmin.model._meta.verbose_name_plural + self.file_extension
+
+    def iter_content(self, modeladmin, batches: Iterator[List[Tuple]]) -> Iterator[bytes]:
+        """出力内容をchunkごとに返す、サブクラスで実装する"""
+        raise NotImplementedError
+
+    def export(self, modeladmin, request, queryset) -> HttpResponseBase:
+        """StreamingHttpResponseで出力する"""
+        # pylint: disable = unused-argument
+        file_name = self.get_file_name(modeladmin)
+        _logger.info('Start to exporting %s', file_name)
+
+        response = StreamingHttpResponse(self.iter_content(modeladmin, iter_value_batches(modeladmin, queryset)),
+                                         content_type=self.content_type)
+        # quote()を使わないとファイル名がセットされない
+        response['Content-Disposition'] = f'attachment; filename={quote(file_name)}'
+        return response
+
+    def __call__(self, modeladmin, request, queryset) -> HttpResponseBase:
+        return self.export(modeladmin, request, queryset)
+
+class JsonLinesExportFormat(ExportFormat):
+    """JSON Lines、一行に一レコードのJSONオブジェクト"""
+    name = 'export_jsonl'
+    description = _('export json lines')
+    file_extension = '.jsonl'
+    content_type = 'application/jsonl; charset=utf-8'
+
+    def iter_content(self, modeladmin, batches: Iterator[List[Tuple]]) -> Iterator[bytes]:
+        fields = modeladmin.get_model_fields()
+        for batch in batches:
+            yield ''.join(json.dumps(dict(zip(fields, row)), cls=DjangoJSONEncoder, ensure_ascii=False) + '\n'
+                          for row in batch).encode(UTF8)
+
+class GzipCsvExportFormat(ExportFormat):
+    """gzip圧縮したCSV、列の変換はCSV exportと同じ計画を使う"""
+    name = 'export_csv_gzip'
+    description = _('export gzip csv')
+    file_extension = '.csv.gz'
+    content_type = 'application/gzip'
+    compress_level = 6
+
+    def is_enabled(self, modeladmin) -> bool:
+        """CSV exportを無効にしたModelAdminでは使わない"""
+        return modeladmin.csv_export
+
+    def iter_content(self, modeladmin, batches: Iterator[List[Tuple]]) -> Iterator[bytes]:
+        encoding = modeladmin.csv_encoding or UTF8
+        compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED, zlib.MAX_WBITS | 16)   # gzip形式
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, modeladmin.dialect)
+
+        if modeladmin.get_export_titles():
+            writer.writerow(modeladmin.get_export_titles())
+        plan = modeladmin.get_export_column_plan()
+        for batch in batches:
+            writer.writerows(plan.format_rows(batch))
+            yield compressor.compress(buffer.getvalue().encode(encoding))
+            buffer.seek(0)
+            buffer.truncate()
+
+        yield compressor.compress(buffer.getvalue().encode(encoding)) + compressor.flush()
+
+class ParquetExportFormat(ExportFormat):
+    """Parquet(列指向)、pyarrowがインストールされている場合のみ使える
+        chunkごとにrow groupとして書き出し、書き出したバイト列をそのまま出力する
+    """
+    name = 'export_parquet'
+    description = _('export parquet')
+    file_extension = '.parquet'
+    content_type = 'application/vnd.apache.parquet'
+
+    def is_available(self) -> bool:
+        return pyarrow is not None
+
+    def get_arrow_type(self, field: models.Field):
+        """Django Fieldに対応するArrowの型、対応がなければ文字列として出力する"""
+        if field.is_relation:
+            field = field.target_field
+        return {
+            'AutoField': pyarrow.int64(),
+            'BigAutoField': pyarrow.int64(),
+            'SmallAutoField': pyarrow.int64(),
+            'IntegerField': pyarrow.int64(),
+            'BigIntegerField': pyarrow.int64(),
+            'SmallIntegerField': pyarrow.int64(),
+            'PositiveIntegerField': pyarrow.int64(),
+            'PositiveBigIntegerField': pyarrow.int64(),
+            'PositiveSmallIntegerField': pyarrow.int64(),
+            'FloatField': pyarrow.float64(),
+            'BooleanField': pyarrow.bool_(),
+            'DateField': pyarrow.date32(),
+            'DateTimeField': pyarrow.timestamp('us', tz='UTC'),
+        }.get(field.get_internal_type(), pyarrow.string())
+
+    def get_schema(self, modeladmin):
+        """export項目のスキーマ、関連先の項目(category__category等)はたどって解決する"""
+        arrow_fields = []
+        for field_name in modeladmin.get_model_fields():
+            field = resolve_export_field(modeladmin.model, field_name)
+            arrow_type = self.get_arrow_type(field) if field is not None else pyarrow.string()
+            arrow_fields.append(pyarrow.field(field_name, arrow_type))
+        return pyarrow.schema(arrow_fields)
+
+    def to_record_batch(self, batch: List[Tuple], schema):
+        """values_listのタプルを列ごとの配列に変換する"""
+        columns = list(zip(*batch))
+        arrays = []
+        for values, arrow_field in zip(columns, schema):
+            if pyarrow.types.is_string(arrow_field.type):
+                values = [None if v is None else str(v) for v in values]
+            arrays.append(pyarrow.array(values, type=arrow_field.type))
+        return pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+    def iter_content(self, modeladmin, batches: Iterator[List[Tuple]]) -> Iterator[bytes]:
+        schema = self.get_schema(modeladmin)
+        sink = ParquetStreamSink()
+        with parquet.ParquetWriter(sink, schema) as writer:
+            for batch in batches:
+                writer.write_batch(self.to_record_batch(batch, schema))
+                yield sink.pop()
+
+        # フッター
+        yield sink.pop()
+
+export_format_registry: Dict[str, ExportFormat] = {}
+
+def register_export_format(export_format: ExportFormat) -> ExportFormat:
+    """Export形式を登録する、ExportAdminMixin.export_formatsに名前を指定すると使える"""
+    export_format_registry[export_format.name] = export_format
+    return export_format
+
+register_export_format(JsonLinesExportFormat())
+register_export_format(GzipCsvExportFormat())
+register_export_format(ParquetExportFormat())
@@ -0,0 +1,114 @@
+import logging
+from datetime import date
+from operator import itemgetter
+from typing import Any, Callable, Dict, List, Tuple
+from django.core.exceptions import FieldDoesNotExist
+from django.db import models
+
+
+_logger = logging.getLogger(__name__)
+
+def resolve_export_field(model: models.Model, field_name: str) -> models.Field:
+    """export項目に対応するModelのField、関連先の項目(category__category等)はたどって解決する。解決できなければNone"""
+    # pylint: disable = protected-access
+    field = None
+    try:
+        for name in field_name.split('__'):
+            if model is None:
+                return None
+            field = model._meta.get_field(name)
+            model = field.related_model
+    except FieldDoesNotExist:
+        return None
+    return field
+
+def format_date_value(value: Any, date_format: str) -> Any:
+    """日付型ならdate_formatの文字列に変換する"""
+    return value.strftime(date_format) if isinstance(value, date) else value
+
+class ExportColumnPlan:
+    """export一回分の列の変換計画、export開始時に一度だけ作成して全行に適用する
+
+        fields:         values_listで取得する項目
+        indexes:        出力する列のfields内の位置
+        transforms:     {出力列の位置: 変換関数}、Noneには適用しない
+        row2values:     行ごとの変換関数、model2csvをOverrideしている場合に使う（この場合、indexesとtransformsは使わない）
+    """
+    def __init__(self, fields: Tuple[str], indexes: Tuple[int], transforms: Dict[int, Callable[[Any], Any]],
+                 row2values: Callable[[Tuple], List[Any]] = None):
+        self.fields = fields
+        self.indexes = indexes
+        self.transforms = tuple(transforms.items())
+        self.row2values = row2values
+        if len(indexes) == 1:
+            index = indexes[0]
+            self.__getter = lambda row: (row[index],)
+        else:
+            self.__getter = itemgetter(*indexes) if indexes else lambda row: ()
+
+    @classmethod
+    def compile(cls, modeladmin, is_row_conversion: bool = False) -> 'ExportColumnPlan':
+        """modeladminのexport定義から計画を作る
+            出力列はget_model_fieldsのうちget_csv_columnsに含まれるもの(model2csvのデフォルトと同じ)
+            日付型の列はdate_formatで変換する。get_export_transforms()で指定した列はその関数で変換する
+            is_row_conversion: model2csvで行ごとに変換する
+        """
+        fields = tuple(modeladmin.get_model_fields())
+        date_format = modeladmin.date_format
+
+        if is_row_conversion:
+            _logger.debug('%s overrides model2csv, rows are converted one by one.', type(modeladmin).__name__)
+            return cls(fields, (), {}, row2values=lambda row: [format_date_value(v, date_format) \
+                            for v in modeladmin.model2csv(dict(zip(fields, row))).values()])
+
+        csv_columns = set(modeladmin.get_csv_columns())
+        indexes = tuple(i for i, f in enumerate(fields) if f in csv_columns)
+        export_transforms = modeladmin.get_export_transforms()
+
+        transforms = {}
+        for position, index in enumerate(indexes):
+            field_name = fields[index]
+            if field_name in export_transforms:
+                transforms[position] = export_transforms[field_name]
+                continue
+
+            field = resolve_export_field(modeladmin.model, field_name)
+            if field is None:
+                # 型が分からない項目は値で判定する
+                transforms[position] = lambda v, f=date_format: format_date_value(v, f)
+            elif field.get_internal_type() == 'DateField':
+                transforms[position] = cls.get_date_formatter(date_format)
+            elif field.get_internal_type() == 'DateTimeField':
+                transforms[position] = lambda v, f=date_format: v.strftime(f)
+
+        return cls(fields, indexes, transforms)
+
+    @staticmethod
+    def get_date_formatter(date_format: str) -> Callable[[date], str]:
+        """日付の変換関数、同じ日付の変換結果は使いまわす（日時は種類が多いので対象外）"""
+        formatted = {}
+        def format_date(value: date) -> str:
+            try:
+                return formatted[value]
+            except KeyError:
+                formatted[value] = value.strftime(date_format)
+                return formatted[value]
+        return format_date
+
+    def format_rows(self, rows: List[Tuple]) -> List[List[Any]]:
+        """values_listのタプルをまとめて出力行に変換する"""
+        if self.row2values is not None:
+            return [self.row2values(row) for row in rows]
+
+        getter = self.__getter
+        if not self.transforms:
+            return [getter(row) for row in rows]
+
+        formatted_rows = []
+        for row in rows:
+            values = list(getter(row))
+            for position, transform in self.transforms:
+                if values[position] is not None:
+                    values[position] = transform(values[position])
+            formatted_rows.append(values)
+        return formatted_rows
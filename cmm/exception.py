@@ -4,3 +4,18 @@ class RecursiveParenthoodError(Exception):
     """
     def __str__(self):
         return 'Recursive parenthood was detected.'
+
+
+class QueryBudgetExceededError(Exception):
+    """
+    Raised when a view issued more SQL queries than its budget.
+    """
+    def __init__(self, view_name, query_count, budget, slowest=()):
+        super().__init__(view_name, query_count, budget)
+        self.view_name = view_name
+        self.query_count = query_count
+        self.budget = budget
+        self.slowest = slowest
+
+    def __str__(self):
+        return f'{self.view_name} issued {self.query_count} queries, over the budget of {self.budget}.'
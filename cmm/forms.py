@@ -1,4 +1,5 @@
-from django.forms import ModelChoiceField, ModelForm
+from django.forms import ChoiceField, ModelChoiceField, ModelForm
+from django.forms.fields import CallableChoiceIterator
 
 
 class SimpleModelForm(ModelForm):
@@ -14,3 +15,46 @@ class SimpleModelForm(ModelForm):
                     _field.disabled = True
                 else:
                     self.fields[_field_name].widget.attrs.update({'readonly': 'readonly'})
+
+
+class CodeChoiceField(ModelChoiceField):
+    """コードマスタのキャッシュから選択肢を作るModelChoiceField、フォーム表示・入力チェックでcmm_codeを検索しない
+
+        category:   コードのカテゴリ（limit_choices_toの category__category と同じ）
+    """
+    def __init__(self, queryset, *args, category: str = None, **kwargs):
+        self.category = category
+        super().__init__(queryset, *args, **kwargs)
+
+    def _get_choices(self):
+        # pylint: disable = import-outside-toplevel
+        from cmm.models.codes import get_code_registry
+
+        if hasattr(self, '_choices'):
+            return self._choices
+
+        def iter_choices():
+            if self.empty_label is not None:
+                yield ('', self.empty_label)
+            for code in get_code_registry().get_codes(self.category):
+                yield (self.prepare_value(code), self.label_from_instance(code))
+        # 表示のたびにキャッシュから作る
+        return CallableChoiceIterator(iter_choices)
+
+    choices = property(_get_choices, ChoiceField._set_choices)
+
+    def to_python(self, value):
+        # pylint: disable = import-outside-toplevel
+        from cmm.models.codes import get_code_registry
+
+        if value in self.empty_values:
+            return None
+        if self.to_field_name in (None, 'id'):
+            try:
+                code = get_code_registry().get_by_id(int(value.pk if hasattr(value, 'pk') else value))
+            except (TypeError, ValueError):
+                code = None
+            if code is not None and code.category.category == self.category:
+                return code
+        # キャッシュにない(更新直後等)場合はDBで確認する
+        return super().to_python(value)
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+from cmm.utils.benchmark import BENCHMARK_TARGETS, COMPARISONS, format_results, run_benchmark, run_comparison
+
+
+class Command(BaseCommand):
+    """CSV import/exportのベンチマーク、合成データでrows/sec、SQL実行回数とピーク時のメモリ使用量を計測する
+        DBはsettings.DATABASESのdefault、SQLiteとPostgreSQLを比較する場合はsettingsを切り替えて実行する
+        --compareで改善前後の処理方法(ModelFormクラスの作成単位、exportの変換方法)を同じ件数で比較する
+    """
+    help = 'Benchmark CSV import and export of cmm models with synthetic rows.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--models', nargs='+', default=list(BENCHMARK_TARGETS),
+                            help='models to benchmark: ' + ', '.join(BENCHMARK_TARGETS))
+        parser.add_argument('--rows', nargs='+', type=int, default=[10000, 100000, 1000000],
+                            help='numbers of synthetic rows')
+        parser.add_argument('--compare', nargs='*', choices=list(COMPARISONS), default=None,
+                            help='also compare per-row processing with the current one, all comparisons by default')
+        parser.add_argument('--no-memory', action='store_true',
+                            help='do not trace peak memory, tracemalloc slows the benchmark down')
+
+    def handle(self, *args, **options):
+        unknown = set(options['models']) - set(BENCHMARK_TARGETS)
+        if unknown:
+            raise CommandError(f'Unknown models: {", ".join(sorted(unknown))}')
+
+        results = []
+        for rows in options['rows']:
+            for model_name in options['models']:
+                self.stderr.write(f'Benchmarking {model_name} with {rows:,} rows...')
+                results.extend(run_benchmark(model_name, rows, trace_memory=not options['no_memory']))
+            if options['compare'] is not None:
+                for name in options['compare'] or COMPARISONS:
+                    self.stderr.write(f'Comparing {name} with {rows:,} rows...')
+                    results.extend(run_comparison(name, rows, trace_memory=not options['no_memory']))
+        self.stdout.write(format_results(results))
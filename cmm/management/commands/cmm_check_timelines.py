@@ -0,0 +1,54 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from cmm.utils.timeline import get_history_models, iter_timeline_issues, repair_timelines
+
+
+class Command(BaseCommand):
+    """HistoryTableのタイムライン(広義的ユニーク・キーごとの版の並び)の空白と重複を検査する
+        テーブルごとにキーと有効開始日の順で一回だけ走査するので、夜間バッチで大きなテーブルにも実行できる
+    """
+    help = 'Check valid_from/valid_through chains of HistoryTable models for gaps and overlaps.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--models', nargs='+', default=None,
+                            help='app_label.ModelName of HistoryTable models, all of them by default')
+        parser.add_argument('--repair', action='store_true',
+                            help='set valid_through to the day before the next valid_from')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='rows fetched at a time')
+        parser.add_argument('--fail', action='store_true',
+                            help='exit with an error if unrepaired issues remain')
+
+    def get_models(self, labels):
+        """検査対象のModel"""
+        history_models = get_history_models()
+        if labels is None:
+            return history_models
+
+        models = []
+        for label in labels:
+            try:
+                model = apps.get_model(label)
+            except (LookupError, ValueError) as e:
+                raise CommandError(f'Unknown model: {label}') from e
+            if model not in history_models:
+                raise CommandError(f'{label} is not a HistoryTable model.')
+            models.append(model)
+        return models
+
+    def handle(self, *args, **options):
+        remaining = 0
+        for model in self.get_models(options['models']):
+            issues = list(iter_timeline_issues(model, options['chunk_size']))
+            self.stdout.write(f'{model._meta.label}: {len(issues):,} issues')
+            if options['verbosity'] > 1:
+                for issue in issues:
+                    self.stdout.write(f'  {issue.kind:<9}{issue.key} {issue.valid_from} - {issue.valid_through}'
+                                      f' (expected {issue.expected})')
+
+            repaired = repair_timelines(model, issues) if options['repair'] and issues else 0
+            if repaired:
+                self.stdout.write(f'{model._meta.label}: {repaired:,} repaired')
+            remaining += len(issues) - repaired
+
+        if options['fail'] and remaining:
+            raise CommandError(f'{remaining:,} timeline issues remain.')
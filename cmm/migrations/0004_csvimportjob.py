@@ -0,0 +1,39 @@
+# Generated by Django 4.2 on 2026-10-18 10:00
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cmm', '0003_remove_person_cmm_person_unique_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CsvImportJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('lot_number', models.CharField(max_length=64, unique=True, verbose_name='lot number')),
+                ('model_label', models.CharField(max_length=120, verbose_name='model label')),
+                ('file_name', models.CharField(blank=True, max_length=120, null=True, verbose_name='file name')),
+                ('spool_path', models.CharField(blank=True, max_length=512, null=True, verbose_name='spool path')),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=12, verbose_name='job status')),
+                ('total_rows', models.IntegerField(default=0, verbose_name='total rows')),
+                ('row_cnt', models.IntegerField(blank=True, null=True, verbose_name='read rows')),
+                ('message', models.CharField(blank=True, max_length=2048, null=True, verbose_name='message')),
+                ('creator', models.CharField(blank=True, max_length=120, null=True, verbose_name='creator')),
+                ('create_time', models.DateTimeField(default=django.utils.timezone.now, verbose_name='create time')),
+                ('start_time', models.DateTimeField(blank=True, null=True, verbose_name='start time')),
+                ('end_time', models.DateTimeField(blank=True, null=True, verbose_name='end time')),
+            ],
+            options={
+                'verbose_name': 'csv import job',
+                'verbose_name_plural': 'csv import jobs',
+                'db_table': 'cmm_csv_import_job',
+                'ordering': ['-create_time'],
+                'default_permissions': [],
+            },
+        ),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 4.2 on 2026-10-18 10:47
+
+from collections import defaultdict, deque
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def compute_organization_closure(edges):
+    """(上位組織id, 組織id)のリストから閉包{(ancestor_id, descendant_id): 最短の階層差}を計算する
+        この時点の計算方法で固定するため、cmm.models.organization_relから複製している
+    """
+    parents = defaultdict(set)
+    for parent_id, org_id in edges:
+        if parent_id is not None:
+            parents[org_id].add(parent_id)
+
+    closure = {}
+    for descendant_id in parents:
+        # 上位方向への幅優先探索、最初に到達した階層差が最短
+        depths = {descendant_id: 0}
+        queue = deque([descendant_id])
+        while queue:
+            current = queue.popleft()
+            for parent_id in parents.get(current, ()):
+                if parent_id not in depths:
+                    depths[parent_id] = depths[current] + 1
+                    queue.append(parent_id)
+        closure.update({(ancestor_id, descendant_id): depth for ancestor_id, depth in depths.items() if depth})
+    return closure
+
+def build_organization_closure(apps, schema_editor):
+    """既存のOrganizationRelから閉包テーブルを作成する"""
+    # pylint: disable = unused-argument
+    organization_rel = apps.get_model('cmm', 'OrganizationRel')
+    organization_closure = apps.get_model('cmm', 'OrganizationClosure')
+    closure = compute_organization_closure(organization_rel.objects.values_list('parent_id', 'org_id'))
+    organization_closure.objects.bulk_create((organization_closure(ancestor_id=a, descendant_id=d, depth=depth)
+                                              for (a, d), depth in closure.items()), batch_size=1000)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cmm', '0004_csvimportjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrganizationClosure',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveIntegerField(verbose_name='depth')),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='cmm.organization', verbose_name='ancestor organization')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='cmm.organization', verbose_name='descendant organization')),
+            ],
+            options={
+                'verbose_name': 'organization closure',
+                'verbose_name_plural': 'organization closure',
+                'db_table': 'cmm_organization_closure',
+                'default_permissions': [],
+                'indexes': [models.Index(fields=['descendant', 'ancestor'], name='cmm_org_closure_descendant')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='organizationclosure',
+            constraint=models.UniqueConstraint(fields=('ancestor', 'descendant'), name='cmm_organization_closure_unique'),
+        ),
+        migrations.RunPython(build_organization_closure, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2 on 2026-10-18 11:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cmm', '0005_organizationclosure'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='city',
+            index=models.Index(fields=['code', 'valid_from', 'valid_through'], name='cmm_tst_city_valid'),
+        ),
+    ]
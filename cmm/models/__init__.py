@@ -4,5 +4,6 @@ from .shikuchoson import *
 from .zipcode import *
 from .organization import *
 from .organization_rel import *
+from .organization_tree import *
 from .employee import *
 from .person import *
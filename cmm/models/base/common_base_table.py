@@ -1,6 +1,5 @@
 import logging
 import itertools
-from django.utils import timezone
 from simple_history.models import HistoricalRecords
 from cmm.models.base import SimpleTable, VersionedTable
 
@@ -10,7 +9,6 @@ _logger = logging.getLogger(__name__)
 class CommonBaseTable(SimpleTable):
     """共通ベーステーブル"""
     history = HistoricalRecords(inherit=True, )
-    __history_date = timezone.now()
 
     class Meta:
         abstract = True
@@ -22,12 +20,18 @@ class CommonBaseTable(SimpleTable):
         exclude_fields = ['id'] + [f.name for f in inherited_fields]
         # 有効フラグが変更されたら、変更ありとみなす
         exclude_fields.remove('valid_flag')
-        return all(getattr(self, f.name, None) == getattr(obj, f.name, None) \
+        # Foreign Keyは関連レコードを読み込まずにidで比較する
+        return all(getattr(self, f.attname, None) == getattr(obj, f.attname, None) \
                     for f in self._meta.fields if f.name not in exclude_fields)
 
     def save(self, *args, **kwargs):
         """CSV import処理より呼び出された場合は、変更有無の判定が必要。ModelAdmin継承画面なら不要。"""
         # self._history_date = timezone.now()
+        if not self._state.adding and self.pk is not None:
+            # DBから読み込んだレコードの更新は検索せず、VersionedTableの条件付きUPDATEで競合を検出する
+            super().save(*args, **kwargs)
+            return
+
         same_record = self.retrieve_by_unique_key()
 
         # pylint: disable = attribute-defined-outside-init, invalid-name
@@ -45,11 +49,3 @@ class CommonBaseTable(SimpleTable):
     def delete(self, *args, **kwargs) -> None:
         # self._history_date = timezone.now()
         super().delete(*args, **kwargs)
-
-    @property
-    def _history_date(self):
-        return self.__history_date
-
-    @_history_date.setter
-    def _history_date(self, value):
-        self.__history_date = value
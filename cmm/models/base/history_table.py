@@ -1,7 +1,12 @@
 import logging
-from typing import Any
+import operator
+from collections import defaultdict
+from functools import reduce
+from typing import Any, Dict, Iterable, List, Set, Tuple
 from datetime import date, timedelta
-from django.db import models
+from django.core import checks
+from django.db import connections, models, router, transaction
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django.core.exceptions import ValidationError
 from django.db.models import Q, Min, Max
@@ -15,6 +20,48 @@ _logger = logging.getLogger(__name__)
 
 DEFAULT_valid_from = date(2000, 1, 1)
 DEFAULT_valid_through = date(2222, 12, 31)
+ONE_DAY = timedelta(days=1)
+
+def history_index(db_table: str, *broadly_unique_key: str) -> models.Index:
+    """有効期間検索用の複合インデックス (広義的ユニーク・キー, 有効開始日, 有効終了日)、Meta.indexesに指定する
+        インデックス名はOracleの上限(30文字)に収まるように(db_table)_validとする
+    """
+    return models.Index(fields=[*broadly_unique_key, 'valid_from', 'valid_through'], name=f'{db_table}_valid')
+
+class HistoryTableQuerySet(models.QuerySet):
+    """有効期間で絞り込むQuerySet
+        有効期間の項目に関数をかけない単純な範囲条件とし、history_index()のインデックスで検索できるようにする
+    """
+    def get_reference_date(self) -> date:
+        """Modelの基準日"""
+        # pylint: disable = not-callable
+        return self.model().get_reference_date()
+
+    def as_of(self, ref_date: date) -> 'HistoryTableQuerySet':
+        """指定日付時点に有効なレコード"""
+        return self.filter(valid_from__lte=ref_date, valid_through__gte=ref_date)
+
+    def between(self, valid_from: date, valid_through: date) -> 'HistoryTableQuerySet':
+        """指定期間と有効期間が重なるレコード"""
+        return self.filter(valid_from__lte=valid_through, valid_through__gte=valid_from)
+
+    def current(self) -> 'HistoryTableQuerySet':
+        """基準日時点に有効なレコード"""
+        return self.as_of(self.get_reference_date())
+
+    def expired(self, ref_date: date = None) -> 'HistoryTableQuerySet':
+        """指定日付(省略時は基準日)より前に失効したレコード"""
+        return self.filter(valid_through__lt=ref_date or self.get_reference_date())
+
+    def future(self, ref_date: date = None) -> 'HistoryTableQuerySet':
+        """指定日付(省略時は基準日)より後に有効となるレコード"""
+        return self.filter(valid_from__gt=ref_date or self.get_reference_date())
+
+    def not_expired(self, ref_date: date = None) -> 'HistoryTableQuerySet':
+        """指定日付(省略時は基準日)以後に有効なレコード(有効と未来)"""
+        return self.filter(valid_through__gte=ref_date or self.get_reference_date())
+
+HistoryTableManager = models.Manager.from_queryset(HistoryTableQuerySet)
 
 class HistoryTable(SimpleTable, models.Model):
     """
@@ -32,9 +79,29 @@ class HistoryTable(SimpleTable, models.Model):
     valid_from = models.DateField(blank=False, default=date.today, verbose_name=_("valid from"))
     valid_through = models.DateField(blank=True, null=True, verbose_name=_("valid through"))
 
+    objects = HistoryTableManager()
+
     class Meta:
         abstract = True
 
+    @classmethod
+    def check(cls, **kwargs):
+        return [*super().check(**kwargs), *cls.__check_history_index()]
+
+    @classmethod
+    def __check_history_index(cls):
+        """有効期間検索用の複合インデックスがない場合は警告する"""
+        # pylint: disable = protected-access, not-callable
+        fields = [*cls().get_broadly_unique_key(), 'valid_from', 'valid_through']
+        if any(list(index.fields) == fields for index in cls._meta.indexes):
+            return []
+        return [checks.Warning(
+            f'{cls.__name__} has no index on {", ".join(fields)}.',
+            hint=f"Add history_index('{cls._meta.db_table}', ...) to Meta.indexes.",
+            obj=cls,
+            id='cmm.W001',
+        )]
+
     def get_reference_date(self) -> date:
         """基準日"""
         return date.today()
@@ -47,11 +114,20 @@ class HistoryTable(SimpleTable, models.Model):
         """デフォルトの有効終了日"""
         return DEFAULT_valid_through
 
+    @classmethod
+    def cache_unique_key(cls) -> None:
+        """ユニーク・キーと広義的ユニーク・キーを解決してクラス属性にセットする"""
+        # pylint: disable = protected-access
+        super().cache_unique_key()
+        cls.broadly_unique_key_fields = tuple(f for f in cls.unique_key_fields or () if f != "valid_from")
+        cls.broadly_unique_key_attnames = tuple(cls._meta.get_field(f).attname for f in cls.broadly_unique_key_fields)
+
     def get_broadly_unique_key(self) -> tuple[str]:
         """
         ユニーク・キーから有効開始日を外した広義的（業務的）ユニーク・キー
         """
-        return tuple(f for f in self.get_unique_key() if f != "valid_from")
+        self.get_unique_key_fields()
+        return self.broadly_unique_key_fields
 
     def retrieve_by_broadly_unique_key(self) -> models.QuerySet:
         """Instance作成時にUnique keyとなる項目が不十分の場合は想定したより多い件数が取得されることがある"""
@@ -119,6 +195,269 @@ class HistoryTable(SimpleTable, models.Model):
                 self._state.adding = True
                 super().save(*args, **kwargs)
 
+    @classmethod
+    def apply_history(cls, objs: Iterable['HistoryTable'], batch_size: int = 1000, history_date=None,
+                      history_user=None) \
+            -> Tuple[List['HistoryTable'], List['HistoryTable']]:
+        """新しい版をまとめて保存する、行ごとのsave()と同じ規則で有効期間を調整する
+            1. 対象の広義的ユニーク・キーの全レコード(タイムライン)を一回の検索で取得する
+            2. 版の追加・更新をメモリ上で行い、キーごとに有効開始日順に並べて有効終了日をつなぎ直す
+            3. 変更したレコードをbulk_update、新しいレコードをbulk_createで保存する
+            変更履歴(simple_history)を持つModelはhistory_date(省略時は現在日時)とhistory_userで一括作成する
+            戻り値: (作成したレコード, 更新したレコード)、有効終了日だけを変更したレコードは更新に含まない
+        """
+        objs = list(objs)
+        if not objs:
+            return [], []
+
+        timelines = cls.__load_timelines(objs, batch_size)
+        changed = {}            # {id(record): record}、内容を変更した既存レコード
+        touched = cls.__apply_to_timelines(objs, timelines, changed)
+        rechained = cls.__rechain_timelines(timelines, touched, changed)
+
+        created = [r for key in touched for r in timelines[key].values() if r.pk is None]
+        updated = list(changed.values())
+        # pylint: disable = protected-access
+        update_fields = [f.name for f in cls._meta.concrete_fields if not f.primary_key]
+        with transaction.atomic():
+            cls.objects.bulk_update(updated, update_fields, batch_size=batch_size)
+            cls.objects.bulk_update(list(rechained.values()), ['valid_through', 'version'], batch_size=batch_size)
+            cls.objects.bulk_create(created, batch_size=batch_size)
+            cls.__bulk_history_create(created, updated + list(rechained.values()), history_date, history_user)
+
+        _logger.debug('Applied history of %s: %s created, %s updated and %s rechained.',
+                      cls.__name__, len(created), len(updated), len(rechained))
+        return created, updated
+
+    @classmethod
+    def __apply_to_timelines(cls, objs: List['HistoryTable'], timelines: Dict[Tuple, Dict[date, Any]],
+                             changed: Dict[int, Any]) -> Set[Tuple]:
+        """版をタイムラインに追加・更新する、変更のあったタイムラインのキーを返す"""
+        # pylint: disable = protected-access
+        touched = set()
+        update_time = timezone.now()
+        for obj in objs:
+            key = obj._get_timeline_key()
+            if obj._apply_to_timeline(timelines[key], changed, update_time):
+                touched.add(key)
+        return touched
+
+    @classmethod
+    def __rechain_timelines(cls, timelines: Dict[Tuple, Dict[date, Any]], touched: Set[Tuple],
+                            changed: Dict[int, Any]) -> Dict[int, Any]:
+        """変更のあったタイムラインの有効終了日をつなぎ直す
+            有効終了日だけを変更した既存レコード {id(record): record} を返す
+        """
+        rechained = {}
+        for key in touched:
+            for record in cls.__rechain(timelines[key]):
+                if record.pk is not None and id(record) not in changed:
+                    record.version = (record.version or 0) + 1
+                    rechained[id(record)] = record
+        return rechained
+
+    def _get_timeline_key(self) -> Tuple:
+        """タイムラインのキー、広義的ユニーク・キーの値(Foreign Keyはid)"""
+        self.get_unique_key_fields()
+        return tuple(getattr(self, attname) for attname in self.broadly_unique_key_attnames)
+
+    @classmethod
+    def __load_timelines(cls, objs: List['HistoryTable'], batch_size: int) -> Dict[Tuple, Dict[date, Any]]:
+        """対象キーのタイムライン {キー: {有効開始日: レコード}} を取得する"""
+        # pylint: disable = protected-access
+        keys = list({obj._get_timeline_key() for obj in objs})
+
+        timelines = defaultdict(dict)
+        conditions = cls.__get_key_conditions(cls.broadly_unique_key_attnames, keys, batch_size)
+        for condition in conditions:
+            for record in cls.objects.filter(condition):
+                timelines[record._get_timeline_key()][record.valid_from] = record
+        return timelines
+
+    @staticmethod
+    def __get_key_conditions(attnames: List[str], keys: List[Tuple], batch_size: int) -> List[models.Q]:
+        """キーの一覧を検索条件に分割する、キーがない(全件が一つのタイムライン)場合は条件なし"""
+        if not attnames:
+            return [models.Q()]
+        if len(attnames) == 1:
+            return [models.Q(**{f'{attnames[0]}__in': [key[0] for key in keys[i:i + batch_size]]})
+                    for i in range(0, len(keys), batch_size)]
+        # キーごとのORはSQLiteの式の深さの上限(1000)を超えないように分割する
+        or_size = min(batch_size, 500)
+        return [reduce(operator.or_, (models.Q(**dict(zip(attnames, key))) for key in keys[i:i + or_size]))
+                for i in range(0, len(keys), or_size)]
+
+    def _apply_to_timeline(self, timeline: Dict[date, Any], changed: Dict[int, Any], update_time) -> bool:
+        """save()と同じ規則でタイムラインに版を追加・更新する、変更がなければFalse"""
+        # pylint: disable = attribute-defined-outside-init
+        if not self.valid_through:
+            self.valid_through = self.get_default_valid_through()
+        if self.update_time is None:
+            self.update_time = update_time
+        if not self.creator:
+            self.creator = self.updater
+        if self.create_time is None:
+            self.create_time = self.update_time
+
+        same_record = timeline.get(self.valid_from)
+        if same_record is not None and self.has_same_contents(same_record):
+            _logger.debug("Skip to save the contents because no change was detected on %s.", self)
+            return False
+
+        reference_date = self.get_reference_date()
+        if same_record is not None and same_record.valid_from <= reference_date:
+            # 基準日までの版は変更せず、基準日の翌日から新しい版とする
+            self.creator = same_record.creator
+            self.create_time = same_record.create_time
+            self.valid_from = reference_date + ONE_DAY
+            same_record = timeline.get(self.valid_from)
+
+        if same_record is None:
+            self.pk = None
+            self.version = 1
+        else:
+            # 未来発効レコードは上書きする
+            if same_record.pk is not None:
+                if self.version and same_record.version and self.version != same_record.version:
+                    raise ValidationError(
+                        _('Race condition was detected. Confirm the content and try again later.'),
+                        code='race_condition',
+                        params = None
+                    )
+                self.pk = same_record.pk
+                self.version = (same_record.version or 0) + 1
+                changed.pop(id(same_record), None)
+                changed[id(self)] = self
+            self.creator = same_record.creator
+            self.create_time = same_record.create_time
+        timeline[self.valid_from] = self
+        return True
+
+    @staticmethod
+    def __rechain(timeline: Dict[date, Any]) -> List['HistoryTable']:
+        """有効開始日順に並べて、有効終了日を次の版の有効開始日の前日にする。変更したレコードを返す"""
+        records = [timeline[valid_from] for valid_from in sorted(timeline)]
+        rechained = []
+        for record, next_record in zip(records, records[1:]):
+            valid_through = next_record.valid_from - ONE_DAY
+            if record.valid_through != valid_through:
+                record.valid_through = valid_through
+                rechained.append(record)
+        return rechained
+
+    @classmethod
+    def __bulk_history_create(cls, created: List[Any], updated: List[Any], history_date, history_user) -> None:
+        """変更履歴(simple_history)を持つModelはbulk保存分の履歴を一括作成する"""
+        # pylint: disable = protected-access
+        manager_attribute = getattr(cls._meta, 'simple_history_manager_attribute', None)
+        if not manager_attribute:
+            return
+        history = getattr(cls, manager_attribute)
+        for objs, is_update in ((created, False), (updated, True)):
+            if objs:
+                history.bulk_history_create(objs, update=is_update, default_date=history_date,
+                                            default_user=history_user)
+
+    @classmethod
+    def rechain(cls, objs: Iterable['HistoryTable'] = None, batch_size: int = 500) -> int:
+        """有効終了日を次の版の有効開始日の前日(最後の版はデフォルトの有効終了日)に再計算する
+            objsを指定した場合はそのキーのタイムラインのみ、省略した場合は全件を対象とする
+            PostgreSQLとOracleはLEAD()を使った一つのSQL(キーbatch_size件ごと)で更新し、
+            その他のDB(SQLite等)はキー順に読み込んでbulk_updateする。更新した件数を返す
+        """
+        # pylint: disable = protected-access, not-callable
+        key_fields = [cls._meta.get_field(f) for f in cls().get_broadly_unique_key()]
+        if objs is None:
+            key_batches = [None]
+        else:
+            keys = list({obj._get_timeline_key() for obj in objs})
+            if not keys:
+                return 0
+            key_batches = [keys[i:i + batch_size] for i in range(0, len(keys), batch_size)]
+
+        connection = connections[router.db_for_write(cls)]
+        rechain = cls.__rechain_by_sql if connection.vendor in ('postgresql', 'oracle') else cls.__rechain_in_python
+        with transaction.atomic(using=connection.alias):
+            rechained = sum(rechain(connection, key_fields, keys, batch_size) for keys in key_batches)
+        _logger.debug('Rechained %s records of %s.', rechained, cls.__name__)
+        return rechained
+
+    @classmethod
+    def __rechain_by_sql(cls, connection, key_fields: List[models.Field], keys: List[Tuple], _batch_size) -> int:
+        """LEAD()で次の版の有効開始日を求め、有効終了日が異なるレコードのみ更新する"""
+        # pylint: disable = protected-access
+        table = connection.ops.quote_name(cls._meta.db_table)
+        pk, valid_through, version = cls.__quote_columns(connection, cls._meta.pk.name, 'valid_through', 'version')
+        chain, params = cls.__get_chain_sql(connection, key_fields, keys)
+
+        if connection.vendor == 'oracle':
+            sql = (f'MERGE INTO {table} t USING ({chain}) c ON (t.{pk} = c.chain_id) '
+                   f'WHEN MATCHED THEN UPDATE SET t.{valid_through} = c.expected, '
+                   f't.{version} = COALESCE(t.{version}, 0) + 1 '
+                   f'WHERE t.{valid_through} IS NULL OR t.{valid_through} <> c.expected')
+        else:
+            sql = (f'UPDATE {table} SET {valid_through} = c.expected, '
+                   f'{version} = COALESCE({table}.{version}, 0) + 1 '
+                   f'FROM ({chain}) c WHERE {table}.{pk} = c.chain_id '
+                   f'AND ({table}.{valid_through} IS NULL OR {table}.{valid_through} <> c.expected)')
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.rowcount
+
+    @classmethod
+    def __quote_columns(cls, connection, *field_names: str) -> List[str]:
+        """フィールド名をSQLのカラム名(引用符付き)に変換する"""
+        # pylint: disable = protected-access
+        return [connection.ops.quote_name(cls._meta.get_field(f).column) for f in field_names]
+
+    @classmethod
+    def __get_chain_sql(cls, connection, key_fields: List[models.Field], keys: List[Tuple]) -> Tuple[str, List]:
+        """レコードごとにあるべき有効終了日(chain_id, expected)を求めるSQLとパラメータ"""
+        # pylint: disable = protected-access, not-callable
+        table = connection.ops.quote_name(cls._meta.db_table)
+        pk, valid_from = cls.__quote_columns(connection, cls._meta.pk.name, 'valid_from')
+        columns = cls.__quote_columns(connection, *(f.name for f in key_fields))
+
+        params = [cls().get_default_valid_through()]
+        where = ''
+        if keys is not None and columns:
+            placeholder = '%s' if len(columns) == 1 else f'({", ".join(["%s"] * len(columns))})'
+            where = f'WHERE ({", ".join(columns)}) IN ({", ".join([placeholder] * len(keys))})'
+            params += [value for key in keys for value in key]
+        partition = f'PARTITION BY {", ".join(columns)} ' if columns else ''
+        chain = (f'SELECT {pk} AS chain_id, '
+                 f'COALESCE(LEAD({valid_from}) OVER ({partition}ORDER BY {valid_from}) - 1, %s) AS expected '
+                 f'FROM {table} {where}')
+        return chain, params
+
+    @classmethod
+    def __rechain_in_python(cls, connection, key_fields: List[models.Field], keys: List[Tuple], batch_size) -> int:
+        """キーと有効開始日の順に読み込んで有効終了日を再計算し、bulk_updateする"""
+        # pylint: disable = protected-access, not-callable
+        attnames = [f.attname for f in key_fields]
+        conditions = [models.Q()] if keys is None else cls.__get_key_conditions(attnames, keys, batch_size)
+        default_valid_through = cls().get_default_valid_through()
+
+        rechained = []
+        for condition in conditions:
+            rows = cls._base_manager.using(connection.alias).filter(condition).order_by(*attnames, 'valid_from') \
+                        .values_list('pk', *attnames, 'valid_from', 'valid_through', 'version')
+            previous = None
+            for row in rows.iterator():
+                if previous is not None:
+                    same_key = previous[1:len(attnames) + 1] == row[1:len(attnames) + 1]
+                    expected = row[-3] - ONE_DAY if same_key else default_valid_through
+                    if previous[-2] != expected:
+                        rechained.append(cls(pk=previous[0], valid_through=expected, version=(previous[-1] or 0) + 1))
+                previous = row
+            if previous is not None and previous[-2] != default_valid_through:
+                rechained.append(cls(pk=previous[0], valid_through=default_valid_through,
+                                     version=(previous[-1] or 0) + 1))
+
+        cls._base_manager.using(connection.alias).bulk_update(rechained, ['valid_through', 'version'],
+                                                               batch_size=batch_size)
+        return len(rechained)
+
     def delete(self, *args, **kwargs) -> None:
         same_record = self.retrieve_by_unique_key()
 
@@ -165,8 +504,7 @@ class HistoryTable(SimpleTable, models.Model):
    
     def get_at(self, ref_date: date) -> Any:
         """指定日付時点に有効なレコードを取得する"""
-        obj = self.retrieve_by_broadly_unique_key().filter(valid_from__lte=ref_date, valid_through__gte=ref_date).first()
-        return obj
+        return self.retrieve_by_broadly_unique_key().as_of(ref_date).first()
 
     def validate_valid_from(self):
         """自身の開始日より新しいレコードが存在する場合、開始日 <= 基準日のレコードを新規作成することはできない"""
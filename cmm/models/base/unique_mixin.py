@@ -1,5 +1,9 @@
 import logging
+import operator
+from functools import reduce
+from typing import Dict, Iterable, Tuple
 from django.db import models
+from django.db.models import Q
 
 
 _logger = logging.getLogger(__name__)
@@ -9,11 +13,22 @@ class UniqueConstraintMixin():
     This mixin should be mixed with models.Model, 
     which defined a models.UniqueConstraint named as (meta.db_table)_unique.
     """
-    def get_unique_key(self) -> tuple[str]:
+    # Trueの場合、full_clean()でユニーク制約のチェック(DB検索)を行わない。CSV importでchunk単位に一括チェックする場合に使う
+    skip_unique_validation = False
+
+    # ユニーク・キーの項目名と列名(Foreign Keyは_id)、CmmConfig.ready()でModelごとに一度だけ解決してセットする
+    unique_key_fields: Tuple[str] = None
+    unique_key_attnames: Tuple[str] = None
+
+    in_clause_size = 1000           # Oracleの IN句の上限
+    or_clause_size = 500            # 複数項目のキーをORでつなぐ上限、SQLiteの式の深さの上限(1000)を超えないようにする
+
+    @classmethod
+    def resolve_unique_key(cls) -> tuple[str]:
         """
         return columns of the unique constraint.
         """
-        meta = self._meta
+        meta = cls._meta
         if meta.total_unique_constraints:
 
             unique_constraint_name = f'{meta.db_table}_unique'
@@ -25,9 +40,91 @@ class UniqueConstraintMixin():
 
             _logger.debug("Unique constraint of %(table)s is %(fields)s.", \
                             {'table': meta.db_table, 'fields': unique_constraint_fields})
-            return unique_constraint_fields
+            return tuple(unique_constraint_fields)
         return ()
 
+    @classmethod
+    def cache_unique_key(cls) -> None:
+        """ユニーク・キーを解決してクラス属性にセットする"""
+        # pylint: disable = protected-access
+        cls.unique_key_fields = cls.resolve_unique_key()
+        cls.unique_key_attnames = tuple(cls._meta.get_field(f).attname for f in cls.unique_key_fields)
+
+    @classmethod
+    def get_unique_key_fields(cls) -> tuple[str]:
+        """解決済みのユニーク・キー、ready()の後に定義されたModelは初回に解決する"""
+        if 'unique_key_fields' not in cls.__dict__:
+            cls.cache_unique_key()
+        return cls.unique_key_fields
+
+    def get_unique_key(self) -> tuple[str]:
+        """
+        return columns of the unique constraint.
+        """
+        return self.get_unique_key_fields()
+
+    def get_unique_key_values(self) -> tuple:
+        """ユニーク・キーの値、Foreign Keyはidを使う"""
+        self.get_unique_key_fields()
+        return tuple(getattr(self, attname) for attname in self.unique_key_attnames)
+
+    def set_unique_key_record(self, record: models.Model) -> None:
+        """一括検索済みのユニーク・キー検索結果(なければNone)をセットし、save時の再検索を省く
+            現在のユニーク・キーの値と一致する間だけ有効、save完了時にクリアされる
+        """
+        # pylint: disable = attribute-defined-outside-init
+        self._unique_key_record = (self.get_unique_key_values(), record)
+
+    def clear_unique_key_record(self) -> None:
+        """一括検索済みのユニーク・キー検索結果をクリアする"""
+        self.__dict__.pop('_unique_key_record', None)
+
     def retrieve_by_unique_key(self) -> models.Model:
         """Uniqueキーで検索した結果"""
+        retrieved = self.__dict__.get('_unique_key_record')
+        if retrieved is not None and retrieved[0] == self.get_unique_key_values():
+            return retrieved[1]
+
         return self.__class__.objects.filter(**{k: getattr(self, k) for k in self.get_unique_key()}).first()
+
+    @classmethod
+    def retrieve_many_by_unique_key(cls, instances: Iterable[models.Model]) -> Dict[Tuple, models.Model]:
+        """複数インスタンスのユニーク・キーに一致する既存レコードを{ユニーク・キーの値: レコード}の形で一括取得する
+            単一項目のキーはin_clause_size件、複数項目のキーはor_clause_size件ごとに検索する
+        """
+        cls.get_unique_key_fields()
+        attnames = cls.unique_key_attnames
+        if not attnames:
+            return {}
+
+        keys = list({obj.get_unique_key_values() for obj in instances})
+        batch_size = cls.in_clause_size if len(attnames) == 1 else cls.or_clause_size
+        existing = {}
+        for i in range(0, len(keys), batch_size):
+            for obj in cls.objects.filter(cls.__get_key_condition(attnames, keys[i:i + batch_size])):
+                existing.setdefault(obj.get_unique_key_values(), obj)
+
+        _logger.debug('Found %s existing rows of %s for %s keys.', len(existing), cls.__name__, len(keys))
+        return existing
+
+    @staticmethod
+    def __get_key_condition(attnames: Tuple[str], keys: Iterable[Tuple]) -> Q:
+        """ユニーク・キーのリストを検索条件に変換する"""
+        if len(attnames) == 1:
+            attname = attnames[0]
+            values = [key[0] for key in keys]
+            condition = Q(**{f'{attname}__in': [v for v in values if v is not None]})
+            if None in values:
+                condition |= Q(**{f'{attname}__isnull': True})
+            return condition
+
+        return reduce(operator.or_, (Q(**dict(zip(attnames, key))) for key in keys))
+
+    def get_constraints(self):
+        """skip_unique_validationの場合、full_clean()の制約チェックからユニーク制約を外す"""
+        constraints = super().get_constraints()
+        if not self.skip_unique_validation:
+            return constraints
+
+        return [(model_class, [c for c in model_constraints if not isinstance(c, models.UniqueConstraint)])
+                for model_class, model_constraints in constraints]
@@ -1,17 +1,57 @@
-from django.db import models
+import operator
+from functools import reduce
+from typing import Iterable, List
+from django.db import models, router, transaction
+from django.db.models import Case, F, Q, Value, When
+from django.db.models.functions import Coalesce
 from django.utils.translation import gettext_lazy as _
 from django.core.exceptions import ValidationError
 from cmm.models.base import UniqueConstraintMixin
 
 
+def get_race_condition_error() -> ValidationError:
+    """楽観的排他で競合を検出した場合のエラー"""
+    return ValidationError(
+        _('Race condition was detected. Confirm the content and try again later.'),
+        code='race_condition',
+        params = None
+    )
+
 class VersionedTable(UniqueConstraintMixin, models.Model):
-    """楽観的排他用のversionカラムを持つテーブル"""
+    """楽観的排他用のversionカラムを持つテーブル
+        既存レコード(pkとversionあり)は UPDATE ... SET version = version + 1 WHERE id = %s AND version = %s で更新し、
+        更新件数が0件なら競合とする。検索と更新の間に競合が入り込む余地がなく、SQLも一回で済む
+        競合エラーはModel.save()の中で発生するので、atomicブロック内では呼び出し元のトランザクションがロールバック対象になる
+    """
     version = models.IntegerField(blank=True, null=True, verbose_name=_("version"))
 
     class Meta:
         abstract = True
 
     def save(self, *args, **kwargs):
+        try:
+            self.__save(*args, **kwargs)
+        finally:
+            # 一括検索済みのユニーク・キー検索結果は保存後に古くなるので破棄する
+            self.clear_unique_key_record()
+            self.__dict__.pop('_expected_version', None)
+
+    def __save(self, *args, **kwargs):
+        if self.pk is not None and self.version:
+            # 比較と更新を一つのUPDATE文で行う(_do_update)
+            # pylint: disable = attribute-defined-outside-init
+            self._expected_version = self.version
+            self.version += 1
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'version'}
+            try:
+                super().save(*args, **kwargs)
+            except ValidationError:
+                self.version = self._expected_version
+                raise
+            return
+
         current_db_record = self.retrieve_by_unique_key()
         if current_db_record and current_db_record.version and self.version:
             # current_db_record.refresh_from_db()
@@ -19,11 +59,55 @@ class VersionedTable(UniqueConstraintMixin, models.Model):
                 self.version += 1
                 super().save(*args, **kwargs)
             else:
-                raise ValidationError(
-                    _('Race condition was detected. Confirm the content and try again later.'),
-                    code='race_condition',
-                    params = None
-                )
+                raise get_race_condition_error()
         else:
             self.version = 1
             super().save(*args, **kwargs)
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        """保存前のversionが一致するレコードのみ更新する、versionが未設定の既存レコードは更新可とする"""
+        # pylint: disable = too-many-arguments
+        expected_version = self.__dict__.get('_expected_version')
+        if expected_version is None:
+            return super()._do_update(base_qs, using, pk_val, values, update_fields, forced_update)
+
+        base_qs = base_qs.filter(Q(version=expected_version) | Q(version__isnull=True))
+        if super()._do_update(base_qs, using, pk_val, values, update_fields, True):
+            return True
+        # pkが一致するレコードがない場合もINSERTせず、他のユーザーによる変更・削除として扱う
+        raise get_race_condition_error()
+
+    @classmethod
+    def bulk_update_versioned(cls, objs: Iterable['VersionedTable'], fields: List[str],
+                              batch_size: int = None) -> int:
+        """楽観的排他付きの一括更新、保存前のversionが一致するレコードのみ更新してversionを+1する
+            batch_size件(省略時はor_clause_size件)ごとに一つのUPDATE文とし、いずれかの更新件数が不足した場合は
+            全件をロールバックして競合エラーとする。更新した件数を返す
+        """
+        # pylint: disable = protected-access
+        objs = list(objs)
+        if not objs:
+            return 0
+        if any(obj.pk is None for obj in objs):
+            raise ValueError('All objects must have a primary key.')
+
+        batch_size = min(batch_size or cls.or_clause_size, cls.or_clause_size)
+        model_fields = [cls._meta.get_field(name) for name in fields if name != 'version']
+        updated = 0
+        with transaction.atomic(using=router.db_for_write(cls)):
+            for i in range(0, len(objs), batch_size):
+                batch = objs[i:i + batch_size]
+                values = {field.attname: Case(*[When(pk=obj.pk, then=Value(getattr(obj, field.attname),
+                                                                            output_field=field))
+                                                for obj in batch], output_field=field)
+                          for field in model_fields}
+                condition = reduce(operator.or_, (Q(pk=obj.pk, version=obj.version) if obj.version
+                                                  else Q(pk=obj.pk, version__isnull=True) for obj in batch))
+                count = cls._base_manager.filter(condition).update(**values, version=Coalesce(F('version'), 0) + 1)
+                if count != len(batch):
+                    raise get_race_condition_error()
+                updated += count
+
+        for obj in objs:
+            obj.version = (obj.version or 0) + 1
+        return updated
@@ -1,7 +1,7 @@
 from django.db import models
 from django.utils.translation import gettext_lazy as _
 from cmm.const import EXPORT_CSV, IMPORT_CSV
-from cmm.models.base import HistoryTable, SimpleTable
+from cmm.models.base import HistoryTable, SimpleTable, history_index
 
 
 class City(HistoryTable, SimpleTable, models.Model):
@@ -23,6 +23,7 @@ class City(HistoryTable, SimpleTable, models.Model):
         constraints = [
             models.UniqueConstraint(name = db_table + '_unique', fields = ['code', 'valid_from']),
         ]
+        indexes = [history_index(db_table, 'code')]
         ordering = ['code', ]
 
     def __str__(self) -> str:
@@ -1,7 +1,12 @@
 import logging
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils.translation import gettext_lazy as _
 from cmm.models.base import CommonBaseTable
+from cmm.utils.cache import VersionedLocalCache
 
 _logger = logging.getLogger(__name__)
 
@@ -44,3 +49,74 @@ class Code(CommonBaseTable):
 
     def __str__(self) -> str:
         return self.name or self.code
+
+class CodeRegistry:
+    """CategoryとCodeのスナップショット、カテゴリ別の辞書でDBを検索せずに引く
+        保持するインスタンスはプロセス内で共有するので、変更しないこと
+    """
+    def __init__(self, categories: Iterable[Category], codes: Iterable[Code]):
+        self.categories: Dict[str, Category] = {c.category: c for c in categories}
+        self.__codes: Dict[str, List[Code]] = defaultdict(list)    # {カテゴリ: 表示順のCodeのリスト}
+        self.__code_map: Dict[Tuple[str, str], Code] = {}          # {(カテゴリ, コード): Code}
+        self.__id_map: Dict[int, Code] = {}                         # {id: Code}
+        for code in codes:
+            self.__codes[code.category.category].append(code)
+            self.__code_map[(code.category.category, code.code)] = code
+            self.__id_map[code.pk] = code
+        for category_codes in self.__codes.values():
+            category_codes.sort(key=lambda c: (c.display_order is None, c.display_order or 0, c.code))
+
+    @classmethod
+    def load(cls) -> 'CodeRegistry':
+        """DBから読み込む、CategoryとCode(カテゴリ付き)の二回の検索"""
+        categories = list(Category.objects.all())
+        codes = list(Code.objects.select_related('category'))
+        _logger.debug('Loaded code registry of %s categories and %s codes.', len(categories), len(codes))
+        return cls(categories, codes)
+
+    def get_category(self, category: str) -> Optional[Category]:
+        """カテゴリコードに対応するCategory"""
+        return self.categories.get(category)
+
+    def get_codes(self, category: str, valid_only: bool = False) -> List[Code]:
+        """カテゴリのCodeを表示順に返す"""
+        codes = self.__codes.get(category, [])
+        return [c for c in codes if c.valid_flag] if valid_only else list(codes)
+
+    def get_code(self, category: str, code: str) -> Optional[Code]:
+        """カテゴリとコードに対応するCode"""
+        return self.__code_map.get((category, code))
+
+    def get_by_id(self, code_id: int) -> Optional[Code]:
+        """idに対応するCode"""
+        return self.__id_map.get(code_id)
+
+    def find(self, category: str, field_name: str, value: Any) -> Optional[Code]:
+        """カテゴリ内で指定項目(略称等)が一致する最初のCode"""
+        if field_name == 'code':
+            return self.get_code(category, str(value))
+        return next((c for c in self.__codes.get(category, ()) if str(getattr(c, field_name)) == str(value)), None)
+
+    def get_choices(self, category: str, valid_only: bool = False) -> List[Tuple[int, str]]:
+        """選択肢(id, 表示名)のリスト"""
+        return [(c.pk, str(c)) for c in self.get_codes(category, valid_only)]
+
+    def get_name(self, category: str, code: str, default: str = '') -> str:
+        """コードの表示名、見つからなければdefault"""
+        code_obj = self.get_code(category, code)
+        return str(code_obj) if code_obj is not None else default
+
+code_registry_cache = VersionedLocalCache('code_registry', CodeRegistry.load)
+
+def get_code_registry() -> CodeRegistry:
+    """キャッシュしたコードマスタ、Category・Codeが更新されたら読み込み直す"""
+    return code_registry_cache.get()
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Code)
+@receiver(post_delete, sender=Code)
+def invalidate_code_registry(sender, **kwargs):
+    """コードマスタのキャッシュを無効化する"""
+    # pylint: disable = unused-argument
+    code_registry_cache.invalidate()
@@ -1,8 +1,14 @@
-from django.db import models
+from collections import defaultdict, deque
+from typing import Dict, Iterable, List, Set, Tuple
+from django.db import models, transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.utils.translation import gettext_lazy as _
 from cmm.const import EXPORT_CSV, IMPORT_CSV
 from cmm.exception import RecursiveParenthoodError
 from cmm.models.base import CommonBaseTable
+from cmm.models.organization import Organization
 
 
 class OrganizationRel(CommonBaseTable):
@@ -29,30 +35,202 @@ class OrganizationRel(CommonBaseTable):
 
     def save(self, *args, **kwargs):
         # check circulated parenthood
-        if self.parent:
-            descendants = [desc.org.id for desc in get_descendants(self.parent.id)]
-            if self.parent.id in descendants:
-                raise RecursiveParenthoodError
-        super().save(*args, **kwargs)
+        if self.parent_id is not None and is_recursive_parenthood(self.parent_id, self.org_id):
+            raise RecursiveParenthoodError
 
-def get_descendants(org_id):
+        current_edge = None
+        if self.pk is not None:
+            current_edge = OrganizationRel.objects.filter(pk=self.pk).values_list('parent_id', 'org_id').first()
+
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
+            # 閉包テーブルを更新する
+            if current_edge != (self.parent_id, self.org_id):
+                if current_edge is not None and current_edge[0] is not None:
+                    remove_organization_closure(*current_edge)
+                if self.parent_id is not None:
+                    add_organization_closure(self.parent_id, self.org_id)
+
+class OrganizationClosure(models.Model):
+    """組織階層の閉包テーブル、OrganizationRelから導出して保存時に更新する（自分自身の行は持たない）"""
+    ancestor = models.ForeignKey('Organization', on_delete=models.CASCADE, related_name='+',
+                                 verbose_name=_('ancestor organization'))
+    descendant = models.ForeignKey('Organization', on_delete=models.CASCADE, related_name='+',
+                                   verbose_name=_('descendant organization'))
+    depth = models.PositiveIntegerField(verbose_name=_('depth'))       # 最短の階層差、直下は1
+
+    class Meta:
+        db_table = 'cmm_organization_closure'
+        verbose_name = _('organization closure')
+        verbose_name_plural = _('organization closure')
+        default_permissions = []
+
+        constraints = [
+            models.UniqueConstraint(name = db_table + '_unique', fields = ['ancestor', 'descendant']),
+        ]
+        indexes = [
+            models.Index(name = 'cmm_org_closure_descendant', fields = ['descendant', 'ancestor']),
+        ]
+
+def compute_organization_closure(edges: Iterable[Tuple[int, int]],
+                                 org_ids: Iterable[int] = None) -> Dict[Tuple[int, int], int]:
+    """(上位組織id, 組織id)のリストから閉包{(ancestor_id, descendant_id): 最短の階層差}を計算する
+        org_ids: 指定した組織を下位とする行だけを計算する、省略時は全組織
+    """
+    parents = defaultdict(set)
+    for parent_id, org_id in edges:
+        if parent_id is not None:
+            parents[org_id].add(parent_id)
+
+    closure = {}
+    for descendant_id in (parents.keys() if org_ids is None else org_ids):
+        # 上位方向への幅優先探索、最初に到達した階層差が最短
+        depths = {descendant_id: 0}
+        queue = deque([descendant_id])
+        while queue:
+            current = queue.popleft()
+            for parent_id in parents.get(current, ()):
+                if parent_id not in depths:
+                    depths[parent_id] = depths[current] + 1
+                    queue.append(parent_id)
+        closure.update({(ancestor_id, descendant_id): depth for ancestor_id, depth in depths.items() if depth})
+    return closure
+
+def find_recursive_parenthood(edges: Iterable[Tuple[int, int]]) -> Set[Tuple[int, int]]:
+    """(上位組織id, 組織id)のリストから循環している関連をすべて探す
+        トポロジカルソートで循環に関わらない組織を取り除き、残った組織を強連結成分に分けて、同じ成分内の関連を循環とする
+    """
+    edges = {(parent_id, org_id) for parent_id, org_id in edges if parent_id is not None}
+    children = defaultdict(set)
+    in_degrees = defaultdict(int)
+    for parent_id, org_id in edges:
+        children[parent_id].add(org_id)
+        in_degrees[org_id] += 1
+
+    # 上位組織のない組織から順に取り除く
+    queue = deque(org_id for org_id in children if not in_degrees[org_id])
+    while queue:
+        for child_id in children[queue.popleft()]:
+            in_degrees[child_id] -= 1
+            if not in_degrees[child_id]:
+                queue.append(child_id)
+
+    remaining = {org_id for org_id, in_degree in in_degrees.items() if in_degree}
+    if not remaining:
+        return set()
+
+    components = _get_strong_components(remaining, children)
+    return {(parent_id, org_id) for parent_id, org_id in edges
+                if parent_id in remaining and org_id in remaining and components[parent_id] == components[org_id]}
+
+def _get_strong_components(nodes: Set[int], children: Dict[int, Set[int]]) -> Dict[int, int]:
+    """強連結成分{組織id: 成分の代表の組織id}、再帰を使わないTarjanのアルゴリズム"""
+    # pylint: disable = too-many-locals
+    indexes, low_links, components = {}, {}, {}
+    stack, on_stack = [], set()
+
+    def visit(node):
+        indexes[node] = low_links[node] = len(indexes)
+        stack.append(node)
+        on_stack.add(node)
+        return (node, iter(children.get(node, set()) & nodes))
+
+    for root in nodes:
+        if root in indexes:
+            continue
+        work = [visit(root)]
+        while work:
+            node, child_iter = work[-1]
+            for child in child_iter:
+                if child not in indexes:
+                    work.append(visit(child))
+                    break
+                if child in on_stack:
+                    low_links[node] = min(low_links[node], indexes[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low_links[parent] = min(low_links[parent], low_links[node])
+                if low_links[node] == indexes[node]:
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        components[member] = node
+                        if member == node:
+                            break
+    return components
+
+def add_organization_closure(parent_id: int, org_id: int) -> None:
+    """上位組織と組織の関連を閉包テーブルに追加する
+        上位組織の全上位組織(自分自身を含む) × 組織の全下位組織(自分自身を含む)の組み合わせを追加、既存なら短い方の階層差を残す
+    """
+    ancestors = {parent_id: 0} | dict(OrganizationClosure.objects.filter(descendant_id=parent_id)
+                                                         .values_list('ancestor_id', 'depth'))
+    descendants = {org_id: 0} | dict(OrganizationClosure.objects.filter(ancestor_id=org_id)
+                                                        .values_list('descendant_id', 'depth'))
+    depths = {(a, d): a_depth + 1 + d_depth for a, a_depth in ancestors.items() for d, d_depth in descendants.items()}
+
+    existing = OrganizationClosure.objects.filter(ancestor_id__in=ancestors, descendant_id__in=descendants)
+    updated = []
+    for closure in existing:
+        depth = depths.pop((closure.ancestor_id, closure.descendant_id))
+        if depth < closure.depth:
+            closure.depth = depth
+            updated.append(closure)
+
+    OrganizationClosure.objects.bulk_update(updated, ['depth'])
+    OrganizationClosure.objects.bulk_create(OrganizationClosure(ancestor_id=a, descendant_id=d, depth=depth)
+                                            for (a, d), depth in depths.items())
+
+def remove_organization_closure(parent_id: int, org_id: int) -> None:
+    """上位組織と組織の関連を閉包テーブルから外す
+        別経路で上位組織が残る場合があるので、組織と全下位組織を下位とする行をOrganizationRelから計算し直す
+    """
+    # pylint: disable = unused-argument
+    affected_ids = {org_id} | set(OrganizationClosure.objects.filter(ancestor_id=org_id)
+                                                     .values_list('descendant_id', flat=True))
+    closure = compute_organization_closure(OrganizationRel.objects.values_list('parent_id', 'org_id'), affected_ids)
+
+    OrganizationClosure.objects.filter(descendant_id__in=affected_ids).delete()
+    OrganizationClosure.objects.bulk_create(OrganizationClosure(ancestor_id=a, descendant_id=d, depth=depth)
+                                            for (a, d), depth in closure.items())
+
+@transaction.atomic
+def rebuild_organization_closure() -> None:
+    """閉包テーブルをOrganizationRelから作り直す"""
+    closure = compute_organization_closure(OrganizationRel.objects.values_list('parent_id', 'org_id'))
+    OrganizationClosure.objects.all().delete()
+    OrganizationClosure.objects.bulk_create((OrganizationClosure(ancestor_id=a, descendant_id=d, depth=depth)
+                                             for (a, d), depth in closure.items()), batch_size=1000)
+
+@receiver(post_delete, sender=OrganizationRel)
+def organization_rel_deleted(sender, instance, **kwargs):
+    """関連の削除(QuerySet.delete()を含む)を閉包テーブルに反映する"""
+    # pylint: disable = unused-argument
+    if instance.parent_id is not None:
+        remove_organization_closure(instance.parent_id, instance.org_id)
+
+def is_recursive_parenthood(parent_id: int, org_id: int) -> bool:
+    """上位組織が組織自身またはその下位組織か"""
+    return parent_id == org_id or \
+            OrganizationClosure.objects.filter(ancestor_id=org_id, descendant_id=parent_id).exists()
+
+def get_descendant_ids(org_id: int) -> Set[int]:
+    """指定組織の全下位組織のid(自分自身は含まない)"""
+    return set(OrganizationClosure.objects.filter(ancestor_id=org_id).values_list('descendant_id', flat=True))
+
+def get_ancestor_ids(org_id: int) -> Set[int]:
+    """指定組織の全上位組織のid(自分自身は含まない)"""
+    return set(OrganizationClosure.objects.filter(descendant_id=org_id).values_list('ancestor_id', flat=True))
+
+def get_descendants(org_id) -> List[OrganizationRel]:
     """指定組織の全下部組織を取得する(自分自身は含まない)"""
-    orgs = OrganizationRel.objects.raw("""
-        with RECURSIVE org_rel(id, org_id) as (
-            select id
-                  ,org_id
-              from cmm_organization_rel
-             where parent_id = %(org_id)s
-             union all
-            select c.id
-                  ,c.org_id
-              from org_rel p
-             inner join cmm_organization_rel c
-                on p.org_id = c.parent_id
-        )
-        select id
-              ,org_id
-          from org_rel rel
-    """, {'org_id': org_id})
-    
-    return list(orgs)
+    subtree = OrganizationClosure.objects.filter(ancestor_id=org_id).values('descendant_id')
+    return list(OrganizationRel.objects.filter(Q(parent_id=org_id) | Q(parent_id__in=subtree)))
+
+def get_ancestors(org_id) -> List[Organization]:
+    """指定組織の全上位組織を近い順に取得する(自分自身は含まない)"""
+    depths = dict(OrganizationClosure.objects.filter(descendant_id=org_id).values_list('ancestor_id', 'depth'))
+    return sorted(Organization.objects.filter(pk__in=depths), key=lambda org: depths[org.pk])
@@ -0,0 +1,73 @@
+import logging
+from collections import defaultdict
+from typing import Dict, List, NamedTuple, Set, Tuple
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from cmm.models.codes import Code
+from cmm.models.organization import Organization
+from cmm.models.organization_rel import OrganizationRel
+from cmm.utils.cache import VersionedLocalCache
+
+
+_logger = logging.getLogger(__name__)
+
+class OrganizationNode(NamedTuple):
+    """組織階層キャッシュの組織"""
+    id: int
+    code: str
+    name: str
+    abbr: str
+    rank_code: str
+
+class OrganizationTree:
+    """組織と組織階層のスナップショット、admin画面のフィルター等でDBを検索せずに使う"""
+    def __init__(self, orgs: Dict[int, OrganizationNode], edges: List[Tuple[int, int]]):
+        self.orgs = orgs
+        self.parents: Dict[int, Set[int]] = defaultdict(set)       # {組織id: 上位組織idのset}
+        self.children: Dict[int, Set[int]] = defaultdict(set)      # {組織id: 下位組織idのset}
+        for parent_id, org_id in edges:
+            if parent_id is not None:
+                self.parents[org_id].add(parent_id)
+                self.children[parent_id].add(org_id)
+
+    @classmethod
+    def load(cls) -> 'OrganizationTree':
+        """DBから読み込む、組織(ランク付き)と組織階層の二回の検索"""
+        orgs = {row[0]: OrganizationNode(*row)
+                    for row in Organization.objects.values_list('id', 'code', 'name', 'abbr', 'rank__code')}
+        edges = list(OrganizationRel.objects.values_list('parent_id', 'org_id'))
+        _logger.debug('Loaded organization tree of %s organizations and %s relations.', len(orgs), len(edges))
+        return cls(orgs, edges)
+
+    def get_rank_code(self, org_id: int) -> str:
+        """組織のランクコード"""
+        org = self.orgs.get(org_id)
+        return org.rank_code if org is not None else None
+
+    def get_upper_organizations(self) -> List[OrganizationNode]:
+        """上位組織リスト、get_all_upper_organizations()と同じ条件（ランク0～4で下位組織を持つ、コード順）"""
+        return sorted((org for org in self.orgs.values()
+                        if org.rank_code is not None and '0' <= org.rank_code <= '4' and self.children.get(org.id)),
+                      key=lambda org: org.code)
+
+    def get_upper_organization_choices(self) -> List[Tuple[int, str]]:
+        """フィルター用の上位組織リスト、ランクに応じて字下げする"""
+        return [(org.id, '|' + '-'*int(org.rank_code) + (org.abbr or org.name))
+                    for org in self.get_upper_organizations()]
+
+organization_tree_cache = VersionedLocalCache('organization_tree', OrganizationTree.load)
+
+def get_organization_tree() -> OrganizationTree:
+    """キャッシュした組織階層、組織・組織階層・コードが更新されたら読み込み直す"""
+    return organization_tree_cache.get()
+
+@receiver(post_save, sender=Organization)
+@receiver(post_delete, sender=Organization)
+@receiver(post_save, sender=OrganizationRel)
+@receiver(post_delete, sender=OrganizationRel)
+@receiver(post_save, sender=Code)
+@receiver(post_delete, sender=Code)
+def invalidate_organization_tree(sender, **kwargs):
+    """組織階層キャッシュを無効化する、CSV importの行ごとの保存でも呼ばれる"""
+    # pylint: disable = unused-argument
+    organization_tree_cache.invalidate()
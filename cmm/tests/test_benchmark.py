@@ -0,0 +1,32 @@
+import pytest
+from django.core.management import call_command
+from cmm.models import Person
+from cmm.utils.benchmark import BENCHMARK_TARGETS, COMPARISONS, run_benchmark, run_comparison
+
+
+@pytest.mark.django_db()
+@pytest.mark.parametrize('model_name', BENCHMARK_TARGETS)
+def test_run_benchmark(model_name):
+    """少量の合成データでimport、exportが全件処理され、DBに残らないこと"""
+    model = BENCHMARK_TARGETS[model_name][0]
+    results = run_benchmark(model_name, 20)
+    assert [r.operation for r in results] == ['import', 'export']
+    assert all(r.rows == 20 and r.queries > 0 and r.peak_memory > 0 for r in results)
+    assert not model.objects.exists()
+
+@pytest.mark.django_db()
+@pytest.mark.parametrize('name', COMPARISONS)
+def test_run_comparison(name):
+    """改善前後の処理方法をそれぞれ同じ件数で計測し、DBに残らないこと"""
+    results = run_comparison(name, 20, trace_memory=False)
+    assert [r.operation for r in results] == [operation for operation, _ in COMPARISONS[name][2]]
+    assert all(r.rows == 20 for r in results)
+    assert not Person.objects.exists()
+
+@pytest.mark.django_db()
+def test_benchmark_command(capsys):
+    """管理コマンドで結果の表を出力する"""
+    call_command('cmm_benchmark', '--models', 'Code', '--rows', '10', '--no-memory', '--compare', 'modelform')
+    out = capsys.readouterr().out
+    assert 'rows/sec' in out
+    assert 'validate/lot' in out
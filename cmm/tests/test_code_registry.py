@@ -0,0 +1,77 @@
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from cmm.csv import CsvCodeForeignKey, ForeignKeyCache
+from cmm.forms import CodeChoiceField
+from cmm.models import Category, Code, get_code_registry
+from cmm.utils.cache import VersionedLocalCache, check_shared_cache
+
+
+def test_check_shared_cache(tmp_path):
+    """プロセス間で共有されないキャッシュ・バックエンドは警告する"""
+    with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+        assert [e.id for e in check_shared_cache(None)] == ['cmm.W002']
+    with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                                               'LOCATION': str(tmp_path)}}):
+        assert not check_shared_cache(None)
+
+
+def test_evicted_version():
+    """バージョン番号がキャッシュから消えても、消える前の番号を再利用しない"""
+    loaded = []
+    local_cache = VersionedLocalCache('test_evicted_version', lambda: loaded.append(1) or len(loaded))
+    assert local_cache.get() == 1
+    cache.delete(local_cache.version_key)
+    assert local_cache.get() == 2
+    cache.delete(local_cache.version_key)
+
+
+class CodeRegistryTestCase(TestCase):
+    """コードマスタのキャッシュ"""
+    def setUp(self) -> None:
+        with self.captureOnCommitCallbacks(execute=True):
+            self.category = Category.objects.create(category='sex', name='sex')
+            self.male = Code.objects.create(category=self.category, code='1', name='男性', abbr='M', display_order=2)
+            self.female = Code.objects.create(category=self.category, code='2', name='女性', abbr='F', display_order=1)
+
+    def test_lookup_without_query(self):
+        """二回目以降はDBを検索しない"""
+        get_code_registry()
+        with self.assertNumQueries(0):
+            registry = get_code_registry()
+            self.assertEqual(registry.get_category('sex'), self.category)
+            self.assertEqual(registry.get_codes('sex'), [self.female, self.male])
+            self.assertEqual(registry.get_code('sex', '1'), self.male)
+            self.assertEqual(registry.get_by_id(self.female.pk), self.female)
+            self.assertEqual(registry.find('sex', 'abbr', 'M'), self.male)
+            self.assertEqual(registry.get_choices('sex'), [(self.female.pk, '女性'), (self.male.pk, '男性')])
+            self.assertEqual(registry.get_name('sex', '9', '-'), '-')
+            self.assertEqual(registry.get_codes('unknown'), [])
+
+    def test_invalidate(self):
+        """Category、Codeが更新されたら読み込み直す"""
+        get_code_registry()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.male.valid_flag = False
+            self.male.save()
+        with self.assertNumQueries(2):
+            registry = get_code_registry()
+        self.assertEqual(registry.get_codes('sex', valid_only=True), [self.female])
+
+    def test_choice_field(self):
+        """選択肢の作成と入力チェックでDBを検索しない"""
+        get_code_registry()
+        with self.assertNumQueries(0):
+            field = CodeChoiceField(Code.objects.all(), category='sex', to_field_name='id')
+            self.assertEqual([label for _, label in field.choices], ['---------', '女性', '男性'])
+            self.assertEqual(field.clean(str(self.male.pk)), self.male)
+
+    def test_csv_foreign_key(self):
+        """キャッシュにあるコードは検索せず、ないコードだけDBを検索する"""
+        get_code_registry()
+        fk_cache = ForeignKeyCache({'sex': CsvCodeForeignKey('sex', 'abbr')})
+        with self.assertNumQueries(0):
+            fk_cache.prefetch([{'sex': 'M'}, {'sex': 'F'}])
+            self.assertEqual(fk_cache.resolve({'sex': 'F'})['sex'], self.female)
+        with self.assertNumQueries(1):
+            self.assertIsNone(fk_cache.resolve({'sex': 'X'})['sex'])
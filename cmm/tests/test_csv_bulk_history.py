@@ -0,0 +1,55 @@
+import io
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from cmm.admin.site import cmmSite
+from cmm.models import Shikuchoson
+
+
+class CsvFile(io.BytesIO):
+    """アップロードファイルの代わり"""
+    name = 'shikuchoson.csv'
+
+def make_csv_file(name: str, row_cnt: int = 5) -> CsvFile:
+    """市区町村コードのCSVファイル"""
+    lines = ['code,pref_name,name,pref_name_kana,name_kana']
+    lines += [f'{i:05d}0,北海道,{name}{i},ﾎｯｶｲﾄﾞｳ,ｼ' for i in range(row_cnt)]
+    return CsvFile('\n'.join(lines).encode('utf-8'))
+
+class CsvBulkHistoryTestCase(TestCase):
+    """CSV import時の変更履歴の一括作成"""
+    def setUp(self) -> None:
+        self.modeladmin = cmmSite._registry[Shikuchoson]
+        self.modeladmin.pre_import_processing()
+
+    def history_inserts(self, queries) -> int:
+        """変更履歴テーブルへのinsert文の件数"""
+        table = Shikuchoson.history.model._meta.db_table
+        return len([q for q in queries if q['sql'].startswith(f'INSERT INTO "{table}"')])
+
+    def test_bulk_history(self):
+        """行ごとのpost_saveシグナルではなく、chunkごとに一回のinsertで変更履歴を作成する"""
+        lot_date = timezone.now()
+        with CaptureQueriesContext(connection) as context:
+            self.modeladmin.read_csv_file(make_csv_file('市'), 'importer', 'lot1', lot_date)
+        self.assertEqual(self.history_inserts(context.captured_queries), 1)
+        self.assertEqual(Shikuchoson.history.filter(history_type='+').count(), 5)
+        # 履歴日時はimportロットの日時
+        self.assertEqual(set(Shikuchoson.history.values_list('history_date', flat=True)), {lot_date})
+
+        with CaptureQueriesContext(connection) as context:
+            self.modeladmin.read_csv_file(make_csv_file('町'), 'importer', 'lot2')
+        self.assertEqual(self.history_inserts(context.captured_queries), 1)
+        self.assertEqual(Shikuchoson.history.filter(history_type='~').count(), 5)
+
+    def test_history_per_row(self):
+        """is_bulk_history = Falseの場合は従来通り行ごとに作成する"""
+        self.modeladmin.is_bulk_history = False
+        self.addCleanup(setattr, self.modeladmin, 'is_bulk_history', True)
+        lot_date = timezone.now()
+        with CaptureQueriesContext(connection) as context:
+            self.modeladmin.read_csv_file(make_csv_file('市'), 'importer', 'lot1', lot_date)
+        self.assertEqual(self.history_inserts(context.captured_queries), 5)
+        self.assertEqual(set(Shikuchoson.history.values_list('history_date', flat=True)), {lot_date})
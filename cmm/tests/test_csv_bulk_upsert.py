@@ -0,0 +1,68 @@
+import io
+from django.test import TestCase
+
+from cmm.admin.site import cmmSite
+from cmm.csv import CsvLog
+from cmm.models import Shikuchoson, ZipCode
+
+
+class CsvFile(io.BytesIO):
+    """アップロードファイルの代わり"""
+    name = 'zipcode.csv'
+
+def make_csv_file(machiikimei_kana: str, row_cnt: int = 10) -> CsvFile:
+    """日本郵便の郵便番号データ形式のCSVファイル"""
+    lines = ['shikuchoson,old_zipcode,zipcode,pref_name_kana,name_kana,machiikimei_kana,pref_name,name,machiikimei']
+    lines += [f'011002,,{i:07d},ﾎｯｶｲﾄﾞｳ,ｻｯﾎﾟﾛｼ,{machiikimei_kana},北海道,札幌市,町域{i}' for i in range(row_cnt)]
+    return CsvFile('\n'.join(lines).encode('cp932'))
+
+class CsvBulkUpsertTestCase(TestCase):
+    """CsvBulkUpsertMixinによる郵便番号のimport"""
+    def setUp(self) -> None:
+        Shikuchoson.objects.create(code='011002', pref_name='北海道', pref_name_kana='ﾎｯｶｲﾄﾞｳ', name='札幌市')
+        self.modeladmin = cmmSite._registry[ZipCode]
+        self.modeladmin.pre_import_processing()
+
+    def test_insert_and_update(self):
+        """新規行はinsert、変更行はupdateしてバージョン番号を上げる、変更履歴も一括作成する"""
+        self.modeladmin.read_csv_file(make_csv_file('ﾁｮｳｲｷ'), 'importer', 'lot1')
+        self.assertEqual(ZipCode.objects.count(), 10)
+        self.assertEqual(set(ZipCode.objects.values_list('version', flat=True)), {1})
+        self.assertEqual(ZipCode.history.filter(history_type='+').count(), 10)
+
+        # 変更なしの再importは保存しない
+        self.modeladmin.read_csv_file(make_csv_file('ﾁｮｳｲｷ'), 'importer', 'lot2')
+        self.assertEqual(set(ZipCode.objects.values_list('version', flat=True)), {1})
+        self.assertEqual(ZipCode.history.count(), 10)
+
+        with self.assertNumQueries(9):
+            self.modeladmin.read_csv_file(make_csv_file('ﾏﾁｲｷ'), 'importer', 'lot3')
+        self.assertEqual(ZipCode.objects.count(), 10)
+        self.assertEqual(set(ZipCode.objects.values_list('version', flat=True)), {2})
+        self.assertEqual(set(ZipCode.objects.values_list('creator', flat=True)), {'importer'})
+        self.assertEqual(ZipCode.history.filter(history_type='~').count(), 10)
+        self.assertEqual(CsvLog.objects.filter(lot_number='lot3', edit_type=CsvLog.UPDATE).count(), 10)
+
+    def test_update_with_null_unique_key(self):
+        """ユニーク・キーにNULL(町域名なし)を含む既存行も重複して作成せずに更新する"""
+        def make_null_machiikimei_csv_file(machiikimei_kana: str) -> CsvFile:
+            lines = ['shikuchoson,old_zipcode,zipcode,pref_name_kana,name_kana,machiikimei_kana,pref_name,name,'
+                     'machiikimei']
+            lines += [f'011002,,{i:07d},ﾎｯｶｲﾄﾞｳ,ｻｯﾎﾟﾛｼ,{machiikimei_kana},北海道,札幌市,' for i in range(3)]
+            return CsvFile('\n'.join(lines).encode('cp932'))
+
+        self.modeladmin.read_csv_file(make_null_machiikimei_csv_file('ｲｶﾆｹｲｻｲｶﾞﾅｲﾊﾞｱｲ'), 'importer', 'lot1')
+        self.assertEqual(ZipCode.objects.filter(machiikimei__isnull=True).count(), 3)
+
+        self.modeladmin.read_csv_file(make_null_machiikimei_csv_file('ﾁｮｳｲｷﾅｼ'), 'importer', 'lot2')
+        self.assertEqual(ZipCode.objects.count(), 3)
+        self.assertEqual(set(ZipCode.objects.values_list('version', flat=True)), {2})
+        self.assertEqual(set(ZipCode.objects.values_list('machiikimei_kana', flat=True)), {'ﾁｮｳｲｷﾅｼ'})
+
+    def test_update_null_version(self):
+        """バージョン番号がNULLの既存行も更新時に番号を振る"""
+        self.modeladmin.read_csv_file(make_csv_file('ﾁｮｳｲｷ', 3), 'importer', 'lot1')
+        ZipCode.objects.update(version=None)
+
+        self.modeladmin.read_csv_file(make_csv_file('ﾏﾁｲｷ', 3), 'importer', 'lot2')
+        self.assertEqual(set(ZipCode.objects.values_list('version', flat=True)), {1})
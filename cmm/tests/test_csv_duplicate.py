@@ -0,0 +1,68 @@
+import io
+from unittest import mock
+from django.test import TestCase
+
+from cmm.admin.site import cmmSite
+from cmm.csv import CsvLog
+from cmm.models import Person, Shikuchoson
+
+
+class CsvFile(io.BytesIO):
+    """アップロードファイルの代わり"""
+    name = 'duplicate.csv'
+
+def make_csv_file(header: str, rows) -> CsvFile:
+    """ヘッダー行と指定した行のCSVファイル"""
+    return CsvFile('\n'.join([header, *rows]).encode('utf-8'))
+
+class CsvDuplicateTestCase(TestCase):
+    """chunk内の重複行の処理、is_replace_existingで後発優先か先発優先かを選ぶ"""
+    def get_log_levels(self, lot_number: str):
+        """{行番号: ログレベル}"""
+        return dict(CsvLog.objects.filter(lot_number=lot_number).values_list('row_no', 'log_level'))
+
+    def import_shikuchoson(self, is_replace_existing: bool, lot_number: str) -> None:
+        """同じ市区町村コードの行を含むCSVをimportする"""
+        modeladmin = cmmSite._registry[Shikuchoson]
+        csv_file = make_csv_file('code,pref_name,name,pref_name_kana,name_kana',
+                                 ['011002,北海道,先発,ﾎｯｶｲﾄﾞｳ,ｾﾝﾊﾟﾂ',
+                                  '012025,北海道,函館市,ﾎｯｶｲﾄﾞｳ,ﾊｺﾀﾞﾃｼ',
+                                  '011002,北海道,後発,ﾎｯｶｲﾄﾞｳ,ｺｳﾊﾂ'])
+        with mock.patch.object(modeladmin, 'is_replace_existing', is_replace_existing):
+            modeladmin.read_csv_file(csv_file, 'importer', lot_number)
+
+    def test_replace_by_unique_key(self):
+        """後発優先: ユニーク・キーが同じ行は先の行をスキップし、後の行を保存する"""
+        self.import_shikuchoson(True, 'lot1')
+        self.assertEqual(self.get_log_levels('lot1'), {2: CsvLog.WARN, 3: CsvLog.INFO, 4: CsvLog.INFO})
+        self.assertEqual(Shikuchoson.objects.get(code='01100').name, '後発')
+        self.assertEqual(Shikuchoson.objects.count(), 2)
+
+    def test_keep_by_unique_key(self):
+        """先発優先: ユニーク・キーが同じ行は後の行をスキップし、先の行を保存する"""
+        self.import_shikuchoson(False, 'lot1')
+        self.assertEqual(self.get_log_levels('lot1'), {2: CsvLog.INFO, 3: CsvLog.INFO, 4: CsvLog.WARN})
+        self.assertEqual(Shikuchoson.objects.get(code='01100').name, '先発')
+        self.assertEqual(Shikuchoson.objects.count(), 2)
+
+    def test_duplicate_by_row_content(self):
+        """ユニーク・キーを解決できないModelは、行の内容がすべて同じ行を重複とする"""
+        modeladmin = cmmSite._registry[Person]
+        header = 'last_name,first_name,last_name_kana,first_name_kana,年齢,birthday,sex,email,phone_number,' \
+                 'mobile,zipcode,address,my_number'
+        rows = ['山田,太郎,ﾔﾏﾀﾞ,ﾀﾛｳ,,2000/04/01,,,,,,,',
+                '山田,太郎,ﾔﾏﾀﾞ,ﾀﾛｳ,,2000/04/02,,,,,,,',
+                '山田,太郎,ﾔﾏﾀﾞ,ﾀﾛｳ,,2000/04/01,,,,,,,']
+
+        for is_replace_existing, lot_number, expected in ((True, 'lot1', {2: CsvLog.WARN, 3: CsvLog.INFO,
+                                                                          4: CsvLog.INFO}),
+                                                          (False, 'lot2', {2: CsvLog.INFO, 3: CsvLog.INFO,
+                                                                           4: CsvLog.WARN})):
+            with mock.patch.object(Person, 'unique_key_fields', ()), \
+                    mock.patch.object(Person, 'unique_key_attnames', ()), \
+                    mock.patch.object(modeladmin, 'is_replace_existing', is_replace_existing):
+                modeladmin.read_csv_file(make_csv_file(header, rows), 'importer', lot_number)
+            self.assertEqual(self.get_log_levels(lot_number), expected)
+            # 内容の異なる行は重複としない
+            self.assertEqual(Person.objects.filter(birthday__isnull=False).count(), 2)
+            Person.objects.all().delete()
@@ -1,10 +1,19 @@
+import gzip
+import io
+import json
+import zipfile
+from datetime import date
+from unittest import mock
 from urllib.parse import quote
 import pytest
+from django.http import FileResponse, StreamingHttpResponse
 from django.test import Client
 from django.contrib.auth.models import Permission
 from django.contrib.contenttypes.models import ContentType
 from django.urls import reverse
-from ..models import AuthUser, EXPORT_CSV
+from ..admin.site import cmmSite
+from ..csv import export_csv, export_excel, export_format_registry
+from ..models import AuthUser, EXPORT_CSV, Person, Shikuchoson
 
 @pytest.fixture(name='app_site')
 def fixture_app_site() -> str:
@@ -91,3 +100,122 @@ def test_export_csv_post_exporter(export_client, changelist_url):
     assert response.status_code == 200
     assert response.headers.get('Content-Type') == "text/csv; charset=UTF-8"
     # assert response.headers.get('Content-Disposition') == "attachment; filename=" + quote('市区町村.csv')
+
+@pytest.fixture(name='shikuchoson_queryset')
+def fixture_shikuchoson_queryset():
+    """export対象"""
+    for i in range(5):
+        Shikuchoson.objects.create(code=f'{i:05d}', pref_name='北海道', name=f'市{i}',
+                                   pref_name_kana='ﾎｯｶｲﾄﾞｳ', name_kana='ｼ')
+    return Shikuchoson.objects.order_by('code')
+
+@pytest.mark.django_db()
+def test_export_csv_streaming(shikuchoson_queryset, rf):
+    """StreamingHttpResponseで一行ずつ出力する"""
+    modeladmin = cmmSite._registry[Shikuchoson]
+    response = export_csv(modeladmin, rf.get('/'), shikuchoson_queryset)
+    assert isinstance(response, StreamingHttpResponse)
+    lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+    assert lines[0] == ','.join(modeladmin.get_export_titles())
+    assert len(lines) == 6
+    assert lines[1].startswith('00000,北海道,市0')
+
+@pytest.mark.django_db()
+def test_export_csv_buffered(shikuchoson_queryset, rf, monkeypatch):
+    """csv_streaming = Falseの場合も同じ内容を出力する"""
+    modeladmin = cmmSite._registry[Shikuchoson]
+    streamed = b''.join(export_csv(modeladmin, rf.get('/'), shikuchoson_queryset).streaming_content)
+    monkeypatch.setattr(modeladmin, 'csv_streaming', False)
+    assert export_csv(modeladmin, rf.get('/'), shikuchoson_queryset).content == streamed
+
+@pytest.mark.django_db()
+def test_export_excel_constant_memory(shikuchoson_queryset, rf):
+    """constant_memoryモードで一時ファイルに書き出し、FileResponseで返す"""
+    modeladmin = cmmSite._registry[Shikuchoson]
+    response = export_excel(modeladmin, rf.get('/'), shikuchoson_queryset)
+    assert isinstance(response, FileResponse)
+    with zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content))) as xlsx:
+        sheet = xlsx.read('xl/worksheets/sheet1.xml').decode('utf-8')
+    # constant_memoryモードでは文字列はセルに直接書き込まれる
+    assert '市4' in sheet
+    assert sheet.count('<row ') == 6
+
+@pytest.mark.django_db()
+def test_export_jsonl(shikuchoson_queryset, admin_user, changelist_url):
+    """JSON Lines形式でexportする"""
+    client = Client()
+    client.force_login(admin_user)
+    selected = [str(pk) for pk in shikuchoson_queryset.values_list('pk', flat=True)]
+    response = client.post(changelist_url, {'action': 'export_jsonl', '_selected_action': selected})
+    assert response.status_code == 200
+    rows = [json.loads(line) for line in b''.join(response.streaming_content).decode('utf-8').splitlines()]
+    assert len(rows) == 5
+    assert rows[0]['name'] == '市0'
+
+@pytest.mark.django_db()
+def test_export_csv_gzip(shikuchoson_queryset, rf):
+    """gzip圧縮したCSVはCSV exportと同じ内容になる"""
+    modeladmin = cmmSite._registry[Shikuchoson]
+    compressed = b''.join(export_format_registry['export_csv_gzip'](modeladmin, rf.get('/'),
+                                                                    shikuchoson_queryset).streaming_content)
+    streamed = b''.join(export_csv(modeladmin, rf.get('/'), shikuchoson_queryset).streaming_content)
+    assert gzip.decompress(compressed) == streamed
+
+@pytest.mark.django_db()
+def test_export_formats_in_actions(admin_user, rf):
+    """利用可能なexport形式だけがactionに追加される"""
+    request = rf.get('/')
+    request.user = admin_user
+    actions = cmmSite._registry[Shikuchoson].get_actions(request)
+    assert 'export_jsonl' in actions
+    assert 'export_csv_gzip' in actions
+    assert ('export_parquet' in actions) == export_format_registry['export_parquet'].is_available()
+
+@pytest.mark.django_db()
+def test_export_formats_without_csv_export(admin_user, rf):
+    """csv_export = FalseのModelAdminにはgzip CSVを追加しない"""
+    request = rf.get('/')
+    request.user = admin_user
+    modeladmin = cmmSite._registry[Shikuchoson]
+    with mock.patch.object(modeladmin, 'csv_export', False):
+        actions = modeladmin.get_actions(request)
+    assert 'export_csv_gzip' not in actions
+    assert 'export_jsonl' in actions
+
+@pytest.mark.django_db()
+def test_export_parquet(shikuchoson_queryset, rf):
+    """Parquet形式でexportする、pyarrowがなければスキップ"""
+    parquet = pytest.importorskip('pyarrow.parquet')
+    modeladmin = cmmSite._registry[Shikuchoson]
+    # chunkごとのrow groupを順に出力する
+    with mock.patch.object(modeladmin, 'export_chunk_size', 2):
+        response = export_format_registry['export_parquet'](modeladmin, rf.get('/'), shikuchoson_queryset)
+        content = b''.join(response.streaming_content)
+    assert parquet.ParquetFile(io.BytesIO(content)).num_row_groups == 3
+    table = parquet.read_table(io.BytesIO(content))
+    assert table.num_rows == 5
+    assert table.column('name').to_pylist()[0] == '市0'
+
+def test_export_column_plan():
+    """日付型の列はdate_formatで変換し、export_transformsの列はその関数で変換する"""
+    modeladmin = cmmSite._registry[Person]
+    plan = modeladmin.get_export_column_plan()
+    row = ('山田', '太郎', 'ヤマダ', 'タロウ', date(2000, 4, 1), 1, 'a@example.com', None, None, 2, '住所', None)
+    assert plan.format_rows([row]) == [['山田', '太郎', 'ヤマダ', 'タロウ', '2000/04/01', 1, 'a@example.com', None, None,
+                                        2, '住所', None]]
+
+    modeladmin.export_transforms = {'last_name': str.upper, 'birthday': date.isoformat}
+    try:
+        plan = modeladmin.get_export_column_plan()
+    finally:
+        del modeladmin.export_transforms
+    assert plan.format_rows([('yamada', *row[1:])])[0][:5] == ['YAMADA', '太郎', 'ヤマダ', 'タロウ', '2000-04-01']
+
+def test_export_column_plan_model2csv(monkeypatch):
+    """model2csvをOverrideしている場合は行ごとにmodel2csvで変換する"""
+    modeladmin = cmmSite._registry[Person]
+    monkeypatch.setattr(type(modeladmin), 'model2csv', lambda self, model: {'birthday': model['birthday']},
+                        raising=False)
+    plan = modeladmin.get_export_column_plan()
+    row = ('山田', '太郎', 'ヤマダ', 'タロウ', date(2000, 4, 1), 1, 'a@example.com', None, None, 2, '住所', None)
+    assert plan.format_rows([row]) == [['2000/04/01']]
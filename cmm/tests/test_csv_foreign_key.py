@@ -0,0 +1,71 @@
+from django.core.exceptions import ValidationError
+from django.test import TestCase
+
+from cmm.csv import CsvForeignKey, CsvModelChoiceField, ForeignKeyCache
+from cmm.models import Category, Code, Person
+
+
+class ForeignKeyCacheTestCase(TestCase):
+    """CSV importのForeign Key一括解決"""
+    def setUp(self) -> None:
+        self.category = Category.objects.create(category='sex', name='sex')
+        for code, abbr in (('1', 'M'), ('2', 'F')):
+            Code.objects.create(category=self.category, code=code, name=code, abbr=abbr)
+        self.fk_cache = ForeignKeyCache({
+            'sex': CsvForeignKey(Code, 'abbr', filters={'category__category': 'sex'}),
+            'category': CsvForeignKey(Category, 'category', csv_column='category__category'),
+        })
+        self.rows = [{'sex': 'M', 'category__category': 'sex'},
+                     {'sex': 'F', 'category__category': 'sex'},
+                     {'sex': 'X', 'category__category': ''}]
+
+    def test_prefetch_once_per_foreign_key(self):
+        """chunk全体の自然キーを一回の検索で取得する"""
+        with self.assertNumQueries(2):
+            self.fk_cache.prefetch(self.rows)
+
+        with self.assertNumQueries(0):
+            resolved = [self.fk_cache.resolve(row) for row in self.rows]
+
+        self.assertEqual(resolved[0]['sex'].code, '1')
+        self.assertEqual(resolved[1]['sex'].code, '2')
+        self.assertEqual(resolved[0]['category'], self.category)
+        self.assertIsNone(resolved[2]['sex'])
+        self.assertIsNone(resolved[2]['category'])
+
+    def test_resolve_without_prefetch(self):
+        """prefetchされていないキーは一件ずつ検索してキャッシュする"""
+        with self.assertNumQueries(2):
+            self.fk_cache.resolve(self.rows[0])
+        with self.assertNumQueries(0):
+            self.fk_cache.resolve(self.rows[0])
+
+    def test_bounded_cache(self):
+        """上限を超えたら古いキーから捨てる"""
+        fk_cache = ForeignKeyCache({'sex': CsvForeignKey(Code, 'abbr')}, max_size=1)
+        fk_cache.resolve(self.rows[0])
+        fk_cache.resolve(self.rows[1])
+        with self.assertNumQueries(1):
+            fk_cache.resolve(self.rows[0])
+
+    def test_limit_choices_to(self):
+        """limit_choices_toを満たさない参照先はpkで返し、ModelChoiceFieldで選択肢外のエラーとする"""
+        other = Category.objects.create(category='blood', name='blood')
+        wrong = Code.objects.create(category=other, code='A', name='A', abbr='A')
+        fk_cache = ForeignKeyCache({'sex': CsvForeignKey(Code, 'abbr')}, model=Person)
+        rows = [{'sex': 'M'}, {'sex': 'A'}]
+
+        # 自然キーの検索とlimit_choices_toの確認をそれぞれ一回で行う
+        with self.assertNumQueries(2):
+            fk_cache.prefetch(rows)
+        with self.assertNumQueries(0):
+            resolved = [fk_cache.resolve(row) for row in rows]
+        self.assertEqual(resolved[0]['sex'].code, '1')
+        self.assertEqual(resolved[1]['sex'], wrong.pk)
+
+        field = Person._meta.get_field('sex').formfield(form_class=CsvModelChoiceField)
+        field.queryset = field.queryset.complex_filter(Person._meta.get_field('sex').get_limit_choices_to())
+        with self.assertNumQueries(0):
+            self.assertEqual(field.clean(resolved[0]['sex']), resolved[0]['sex'])
+        with self.assertRaises(ValidationError):
+            field.clean(resolved[1]['sex'])
@@ -0,0 +1,157 @@
+import os
+import tempfile
+from datetime import timedelta
+from unittest import mock
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from cmm.admin.site import cmmSite
+from cmm.csv import CsvImportJob, fail_stale_jobs, run_import_job
+from cmm.models import AuthUser, Shikuchoson
+
+
+def make_csv_content(row_cnt: int = 5, error_cnt: int = 0) -> bytes:
+    """市区町村コードのCSV、error_cnt行は都道府県名を空にする"""
+    lines = ['code,pref_name,name,pref_name_kana,name_kana']
+    lines += [f'{i:05d}0,{"" if i < error_cnt else "北海道"},市{i},ﾎｯｶｲﾄﾞｳ,ｼ' for i in range(row_cnt)]
+    return '\n'.join(lines).encode('utf-8')
+
+class CsvImportJobTestCase(TestCase):
+    """バックグラウンドCSV importと進捗確認"""
+    def setUp(self) -> None:
+        self.user = AuthUser.objects.create_superuser(username='importer', password='importer')
+        self.client.force_login(self.user)
+        self.modeladmin = cmmSite._registry[Shikuchoson]
+
+    def url(self, name: str, *args) -> str:
+        """CSV import関連のURL"""
+        return reverse(f'admin:cmm_shikuchoson_{name}', args=args, current_app=cmmSite.name)
+
+    def upload(self, content: bytes) -> CsvImportJob:
+        """アップロードしてジョブを登録する、ジョブはまだ実行しない"""
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post(self.url('csv_import'),
+                                        {'import_file': SimpleUploadedFile('shikuchoson.csv', content)})
+        self.assertEqual(len(callbacks), 1)
+        job = CsvImportJob.objects.get()
+        self.assertRedirects(response, self.url('csv_import_progress', job.lot_number))
+        self.addCleanup(lambda: os.path.exists(job.spool_path) and os.remove(job.spool_path))
+        return job
+
+    def test_background_import(self):
+        """アップロードはディスクに書き出してジョブとして登録し、進捗をJSONで確認できる"""
+        job = self.upload(make_csv_content())
+        self.assertEqual(job.status, CsvImportJob.QUEUED)
+        self.assertEqual(job.total_rows, 5)
+        self.assertTrue(os.path.exists(job.spool_path))
+        self.assertEqual(Shikuchoson.objects.count(), 0)
+
+        response = self.client.get(self.url('csv_import_progress', job.lot_number))
+        self.assertContains(response, self.url('csv_import_status', job.lot_number))
+        self.assertRedirects(self.client.get(self.url('csv_import_result', job.lot_number)),
+                             self.url('csv_import_progress', job.lot_number))
+
+        run_import_job(self.modeladmin, job.pk)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, CsvImportJob.DONE)
+        self.assertFalse(os.path.exists(job.spool_path))
+        self.assertEqual(Shikuchoson.objects.count(), 5)
+
+        progress = self.client.get(self.url('csv_import_status', job.lot_number)).json()
+        self.assertTrue(progress['finished'])
+        self.assertEqual((progress['total'], progress['processed'], progress['imported']), (5, 5, 5))
+
+        self.assertRedirects(self.client.get(self.url('csv_import_result', job.lot_number)),
+                             self.url('changelist'))
+
+    def test_history_of_job(self):
+        """ワーカースレッドにはリクエストがないので、変更履歴の日時はジョブの開始日時、ユーザーはジョブの登録者とする"""
+        job = self.upload(make_csv_content())
+        run_import_job(self.modeladmin, job.pk)
+
+        job.refresh_from_db()
+        self.assertEqual(set(Shikuchoson.history.values_list('history_user', 'history_date')),
+                         {(self.user.pk, job.start_time)})
+
+    def test_stale_job(self):
+        """タイムアウトを過ぎても終了していないジョブは、進捗確認時に失敗として終了してファイルを削除する"""
+        job = self.upload(make_csv_content())
+        CsvImportJob.objects.filter(pk=job.pk).update(status=CsvImportJob.RUNNING,
+                                                      start_time=timezone.now() - timedelta(hours=1))
+        self.assertFalse(self.client.get(self.url('csv_import_status', job.lot_number)).json()['finished'])
+
+        with override_settings(CSV_IMPORT_JOB_TIMEOUT=60):
+            progress = self.client.get(self.url('csv_import_status', job.lot_number)).json()
+        self.assertEqual((progress['status'], progress['finished']), (CsvImportJob.FAILED, True))
+        self.assertFalse(os.path.exists(job.spool_path))
+
+    def test_job_failed_while_running(self):
+        """実行中に失敗として終了したジョブは、ワーカーの終了時に完了で上書きしない"""
+        job = self.upload(make_csv_content())
+
+        def read_csv_file(*args, **kwargs):
+            # 実行中に進捗確認でタイムアウトとされた場合
+            CsvImportJob.objects.filter(pk=job.pk).update(status=CsvImportJob.FAILED, message='interrupted')
+            return 5
+
+        with mock.patch.object(self.modeladmin, 'read_csv_file', side_effect=read_csv_file):
+            run_import_job(self.modeladmin, job.pk)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.message), (CsvImportJob.FAILED, 'interrupted'))
+        self.assertFalse(os.path.exists(job.spool_path))
+
+    def test_failed_job_is_not_run(self):
+        """実行待ちの間に失敗として終了したジョブは実行しない"""
+        job = self.upload(make_csv_content())
+        CsvImportJob.objects.filter(pk=job.pk).update(status=CsvImportJob.FAILED)
+        run_import_job(self.modeladmin, job.pk)
+        self.assertEqual(CsvImportJob.objects.get(pk=job.pk).status, CsvImportJob.FAILED)
+        self.assertEqual(Shikuchoson.objects.count(), 0)
+
+    def test_fail_stale_jobs(self):
+        """残ったジョブと、どのジョブからも参照されない古いファイルを片付ける"""
+        stale = self.upload(make_csv_content())
+        CsvImportJob.objects.filter(pk=stale.pk).update(create_time=timezone.now() - timedelta(hours=1))
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(stale.spool_path), delete=False) as orphan:
+            pass
+        self.addCleanup(lambda: os.path.exists(orphan.name) and os.remove(orphan.name))
+        os.utime(orphan.name, (0, 0))
+
+        with override_settings(CSV_IMPORT_JOB_TIMEOUT=60):
+            self.assertEqual(fail_stale_jobs(), 1)
+        self.assertEqual(CsvImportJob.objects.get(pk=stale.pk).status, CsvImportJob.FAILED)
+        self.assertFalse(os.path.exists(stale.spool_path))
+        self.assertFalse(os.path.exists(orphan.name))
+
+    def test_import_errors(self):
+        """エラー行があれば結果画面に一覧を表示する"""
+        job = self.upload(make_csv_content(error_cnt=1))
+        run_import_job(self.modeladmin, job.pk)
+
+        progress = self.client.get(self.url('csv_import_status', job.lot_number)).json()
+        self.assertEqual((progress['imported'], progress['discarded']), (4, 1))
+        response = self.client.get(self.url('csv_import_result', job.lot_number))
+        self.assertTemplateUsed(response, 'cmm/csv_import_error.html')
+
+    def test_failed_job(self):
+        """例外で終了したジョブは失敗として記録する"""
+        job = self.upload(make_csv_content())
+        os.remove(job.spool_path)
+        run_import_job(self.modeladmin, job.pk)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, CsvImportJob.FAILED)
+        self.assertTrue(self.client.get(self.url('csv_import_status', job.lot_number)).json()['message'])
+
+    def test_foreground_import(self):
+        """is_background_import = Falseの場合はリクエスト内でimportする"""
+        self.modeladmin.is_background_import = False
+        self.addCleanup(setattr, self.modeladmin, 'is_background_import', True)
+        response = self.client.post(self.url('csv_import'),
+                                    {'import_file': SimpleUploadedFile('shikuchoson.csv', make_csv_content())})
+        self.assertRedirects(response, self.url('changelist'))
+        self.assertEqual(Shikuchoson.objects.count(), 5)
+        self.assertFalse(CsvImportJob.objects.exists())
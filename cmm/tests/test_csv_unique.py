@@ -0,0 +1,65 @@
+from unittest import mock
+from django.test import TestCase
+
+from cmm.csv import UniqueKeyResolver
+from cmm.models import Category, City, Code
+
+
+class UniqueKeyResolverTestCase(TestCase):
+    """CSV importのユニーク・キー一括検索"""
+    def setUp(self) -> None:
+        self.category = Category.objects.create(category='sex', name='sex')
+        self.codes = [Code.objects.create(category=self.category, code=code, name=code) for code in ('1', '2')]
+
+    def test_retrieve_in_one_query(self):
+        """複数項目のユニーク・キーでも一回の検索で既存レコードを取得する"""
+        resolver = UniqueKeyResolver(Code)
+        instances = [Code(category=self.category, code=code) for code in ('1', '2', '3')]
+        with self.assertNumQueries(1):
+            existing = resolver.retrieve(instances)
+
+        self.assertEqual(existing.get(resolver.get_key(instances[0])), self.codes[0])
+        self.assertEqual(existing.get(resolver.get_key(instances[1])), self.codes[1])
+        self.assertIsNone(existing.get(resolver.get_key(instances[2])))
+
+    def test_skip_unique_validation(self):
+        """一括検索済みの場合、full_clean()でユニーク制約のチェックを行わない"""
+        code = Code(category=self.category, code='1', name='1')
+        code.skip_unique_validation = True
+        with self.assertNumQueries(0):
+            code.validate_constraints()
+
+    def test_unique_key_record(self):
+        """一括検索済みの既存レコードがあればsave時に再検索しない"""
+        code = Code(category=self.category, code='1', name='1')
+        code.set_unique_key_record(self.codes[0])
+        with self.assertNumQueries(0):
+            self.assertEqual(code.retrieve_by_unique_key(), self.codes[0])
+
+        code.code = '2'
+        with self.assertNumQueries(1):
+            self.assertEqual(code.retrieve_by_unique_key(), self.codes[1])
+
+    def test_retrieve_many_composite_keys(self):
+        """複数項目のキーはor_clause_size件ずつ検索する（SQLiteの式の深さの上限を超えない）"""
+        resolver = UniqueKeyResolver(Code)
+        instances = [Code(category=self.category, code=str(i)) for i in range(1, resolver.or_clause_size + 2)]
+        with self.assertNumQueries(2):
+            existing = resolver.retrieve(instances)
+        self.assertEqual(len(existing), 2)
+
+    def test_unique_key_metadata(self):
+        """ユニーク・キーはready()でModelごとに解決済み、呼び出しごとに解決しない"""
+        self.assertEqual(Code.unique_key_fields, ('category', 'code'))
+        self.assertEqual(Code.unique_key_attnames, ('category_id', 'code'))
+        self.assertEqual(City.broadly_unique_key_fields, ('code',))
+        with mock.patch.object(Code, 'resolve_unique_key') as resolve_unique_key:
+            self.assertEqual(Code(category=self.category, code='1').get_unique_key_values(), (self.category.id, '1'))
+        resolve_unique_key.assert_not_called()
+
+    def test_retrieve_many_by_unique_key(self):
+        """ModelのクラスメソッドでもUniqueKeyResolverと同じ結果になる"""
+        instances = [Code(category=self.category, code=code) for code in ('1', '3')]
+        with self.assertNumQueries(1):
+            existing = Code.retrieve_many_by_unique_key(instances)
+        self.assertEqual(existing, {(self.category.id, '1'): self.codes[0]})
@@ -0,0 +1,52 @@
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from cmm.models import Employee, Organization, OrgMember
+from cmm.models.base import AuthUser
+
+
+class EmployeeChangeListTestCase(TestCase):
+    """職員一覧画面の本務組織列"""
+    url = '/commonsite/cmm/employee/'
+
+    def setUp(self) -> None:
+        self.client.force_login(AuthUser.objects.create_superuser(username='admin', password='admin'))
+        self.main_org = Organization.objects.create(code='1', name='本務組織')
+        self.sub_org = Organization.objects.create(code='2', name='兼務組織')
+
+    def create_employee(self, code: str) -> Employee:
+        """本務と兼務の組織を持つ職員"""
+        employee = Employee.objects.create(code=code, name='職員' + code)
+        OrgMember.objects.create(employee=employee, organization=self.sub_org, is_main_duty=False)
+        OrgMember.objects.create(employee=employee, organization=self.main_org, is_main_duty=True)
+        return employee
+
+    def count_queries(self) -> int:
+        """一覧画面の検索回数"""
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def test_main_duty_organization(self):
+        """本務組織名を表示する"""
+        self.create_employee('001')
+        Employee.objects.create(code='002', name='無所属')
+        response = self.client.get(self.url)
+        self.assertContains(response, '本務組織')
+        self.assertNotContains(response, '兼務組織</td>')
+
+    def test_query_count_independent_of_rows(self):
+        """行数が増えても検索回数は変わらない"""
+        self.create_employee('001')
+        query_count = self.count_queries()
+        for i in range(2, 12):
+            self.create_employee(f'{i:03}')
+        self.assertEqual(self.count_queries(), query_count)
+
+    def test_ordering(self):
+        """本務組織列で並び替えられる"""
+        self.create_employee('001')
+        response = self.client.get(self.url, {'o': '3'})
+        self.assertEqual(response.status_code, 200)
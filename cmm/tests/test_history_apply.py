@@ -0,0 +1,86 @@
+import os
+from datetime import date, timedelta
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from cmm.admin.site import cmmSite
+from cmm.models.base import DEFAULT_valid_from, DEFAULT_valid_through
+from cmm.models.city import City
+from cmm.utils.benchmark import CityBenchmarkAdmin, iter_city_rows, write_csv_file
+
+
+class ApplyHistoryTestCase(TestCase):
+    """HistoryTable.apply_historyによる一括保存"""
+    def setUp(self) -> None:
+        self.today = date.today()
+        self.future_date = self.today + timedelta(days=10)
+
+    def make(self, code: str, name: str, valid_from: date) -> City:
+        """新しい版"""
+        return City(code=code, name=name, pref_name='北海道', pref_name_kana='ホッカイドウ', valid_from=valid_from)
+
+    def get_timeline(self, code: str):
+        """(有効開始日, 有効終了日, 名称)のリスト"""
+        return list(City.objects.filter(code=code).order_by('valid_from')
+                                .values_list('valid_from', 'valid_through', 'name'))
+
+    def get_operations(self, code: str):
+        """新規、未来の版の追加、基準日以前の版の変更、未来の版の変更、間への版の追加"""
+        return [self.make(code, '初版', DEFAULT_valid_from),
+                self.make(code, '未来', self.future_date + timedelta(days=10)),
+                self.make(code, '変更', DEFAULT_valid_from),
+                self.make(code, '未来変更', self.future_date + timedelta(days=10)),
+                self.make(code, '追加', self.future_date)]
+
+    def test_same_result_as_save(self):
+        """行ごとのsave()と同じタイムラインになる"""
+        for obj in self.get_operations('000001'):
+            obj.save()
+        City.apply_history(self.get_operations('000002'))
+
+        self.assertEqual(self.get_timeline('000002'), self.get_timeline('000001'))
+        self.assertEqual(self.get_timeline('000002'), [
+            (DEFAULT_valid_from, self.today, '初版'),
+            (self.today + timedelta(days=1), self.future_date - timedelta(days=1), '変更'),
+            (self.future_date, self.future_date + timedelta(days=9), '追加'),
+            (self.future_date + timedelta(days=10), DEFAULT_valid_through, '未来変更'),
+        ])
+
+    def test_apply_to_existing_timelines(self):
+        """既存のタイムラインに適用する、変更のない版は保存しない"""
+        City.apply_history([self.make('000001', '初版', DEFAULT_valid_from),
+                            self.make('000002', '初版', DEFAULT_valid_from)])
+        created, updated = City.apply_history([self.make('000001', '初版', DEFAULT_valid_from),
+                                               self.make('000002', '未来', self.future_date)])
+        self.assertEqual([obj.name for obj in created], ['未来'])
+        self.assertEqual(updated, [])
+        self.assertEqual(self.get_timeline('000001'), [(DEFAULT_valid_from, DEFAULT_valid_through, '初版')])
+        self.assertEqual(self.get_timeline('000002'), [
+            (DEFAULT_valid_from, self.future_date - timedelta(days=1), '初版'),
+            (self.future_date, DEFAULT_valid_through, '未来'),
+        ])
+        self.assertEqual(City.objects.get(code='000002', valid_from=DEFAULT_valid_from).version, 2)
+
+    def test_query_count(self):
+        """件数によらず、一括検索と一括保存の検索回数で済む"""
+        City.apply_history([self.make(f'{i:06}', '初版', DEFAULT_valid_from) for i in range(100)])
+        with CaptureQueriesContext(connection) as queries:
+            City.apply_history([self.make(f'{i:06}', '未来', self.future_date) for i in range(100)])
+        # 検索、bulk_update(前の版の有効終了日)、bulk_create(DBのパラメータ数上限で分割される)、savepoint
+        self.assertLessEqual(len(queries), 8)
+        self.assertEqual(City.objects.filter(valid_through=self.future_date - timedelta(days=1)).count(), 100)
+
+    def test_csv_bulk_upsert(self):
+        """CsvBulkUpsertMixinのHistoryTableはapply_historyで保存する"""
+        modeladmin = CityBenchmarkAdmin(City, cmmSite)
+        path = write_csv_file(modeladmin, iter_city_rows(20))
+        try:
+            modeladmin.pre_import_processing()
+            with open(path, 'rb') as csv_file:
+                modeladmin.read_csv_file(csv_file, 'importer', 'lot1')
+        finally:
+            os.remove(path)
+        self.assertEqual(City.objects.count(), 20)
+        self.assertEqual(set(City.objects.values_list('valid_through', flat=True)), {DEFAULT_valid_through})
+        self.assertEqual(set(City.objects.values_list('creator', flat=True)), {'importer'})
@@ -0,0 +1,84 @@
+from datetime import date, timedelta
+from django.core import checks
+from django.test import RequestFactory, TestCase
+from django.test.utils import isolate_apps
+
+from cmm.admin.base import ValidAtFilter
+from cmm.models.base import DEFAULT_valid_from, DEFAULT_valid_through, HistoryTable
+from cmm.models.city import City
+
+
+class HistoryTableQuerySetTestCase(TestCase):
+    """HistoryTableの有効期間による絞り込み"""
+    def setUp(self) -> None:
+        self.today = date.today()
+        self.future_date = self.today + timedelta(days=10)
+        City.apply_history([
+            City(code='000001', name='初版', pref_name='北海道', pref_name_kana='ﾎｯｶｲﾄﾞｳ', valid_from=DEFAULT_valid_from),
+            City(code='000001', name='未来', pref_name='北海道', pref_name_kana='ﾎｯｶｲﾄﾞｳ', valid_from=self.future_date),
+            City(code='000002', name='初版', pref_name='北海道', pref_name_kana='ﾎｯｶｲﾄﾞｳ', valid_from=DEFAULT_valid_from,
+                 valid_through=self.today - timedelta(days=1)),
+        ])
+
+    def get_names(self, queryset):
+        return sorted(queryset.values_list('code', 'name'))
+
+    def test_as_of(self):
+        self.assertEqual(self.get_names(City.objects.as_of(self.today)), [('000001', '初版')])
+        self.assertEqual(self.get_names(City.objects.as_of(self.future_date)), [('000001', '未来')])
+        self.assertEqual(self.get_names(City.objects.as_of(DEFAULT_valid_from)),
+                         [('000001', '初版'), ('000002', '初版')])
+        self.assertEqual(self.get_names(City.objects.current()), self.get_names(City.objects.as_of(self.today)))
+
+    def test_between(self):
+        self.assertEqual(self.get_names(City.objects.between(self.today, self.future_date)),
+                         [('000001', '初版'), ('000001', '未来')])
+        self.assertEqual(self.get_names(City.objects.between(self.future_date, DEFAULT_valid_through)),
+                         [('000001', '未来')])
+
+    def test_expired_and_future(self):
+        self.assertEqual(self.get_names(City.objects.expired()), [('000002', '初版')])
+        self.assertEqual(self.get_names(City.objects.future()), [('000001', '未来')])
+        self.assertEqual(self.get_names(City.objects.not_expired()), [('000001', '初版'), ('000001', '未来')])
+
+    def test_get_at(self):
+        obj = City.objects.get(code='000001', valid_from=DEFAULT_valid_from)
+        self.assertEqual(obj.get_at(self.future_date).name, '未来')
+
+    def test_predicates_without_functions(self):
+        """有効期間の項目に関数をかけない範囲条件"""
+        sql = str(City.objects.filter(code='000001').as_of(self.today).query)
+        self.assertIn('"valid_from" <=', sql)
+        self.assertIn('"valid_through" >=', sql)
+
+    @isolate_apps('cmm')
+    def test_valid_at_filter(self):
+        """基準日はModelの基準日を使う"""
+        class FutureCity(City):
+            class Meta:
+                proxy = True
+                app_label = 'cmm'
+
+            def get_reference_date(self) -> date:
+                return date.today() + timedelta(days=10)
+
+        request = RequestFactory().get('/')
+        list_filter = ValidAtFilter(request, {'reference_date': ['valid']}, FutureCity, None)
+        self.assertEqual(self.get_names(list_filter.queryset(request, FutureCity.objects.all())),
+                         [('000001', '未来')])
+
+    @isolate_apps('cmm')
+    def test_history_index_check(self):
+        """有効期間検索用の複合インデックスがなければ警告する"""
+        self.assertEqual([e for e in City.check() if e.id == 'cmm.W001'], [])
+
+        class NoIndexCity(HistoryTable):
+            code = City._meta.get_field('code').clone()
+
+            class Meta:
+                app_label = 'cmm'
+                constraints = City._meta.constraints
+
+        warnings = [e for e in NoIndexCity.check() if e.id == 'cmm.W001']
+        self.assertEqual(len(warnings), 1)
+        self.assertIsInstance(warnings[0], checks.Warning)
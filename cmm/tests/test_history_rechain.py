@@ -0,0 +1,77 @@
+import os
+from datetime import date, timedelta
+from unittest import skipUnless
+from django.db import connection
+from django.test import TestCase
+
+from cmm.admin.site import cmmSite
+from cmm.csv import CsvBulkImportMixin
+from cmm.models.base import DEFAULT_valid_through
+from cmm.models.city import City
+from cmm.tests.test_timeline import make_city
+from cmm.utils.benchmark import CityBenchmarkAdmin, write_csv_file
+
+
+class CityBulkImportAdmin(CsvBulkImportMixin, CityBenchmarkAdmin):
+    """valid_fromを含めてbulk insertする市区町村のAdmin"""
+    fields = ['code', 'name', 'name_kana', 'pref_name', 'pref_name_kana', 'valid_from']
+
+class RechainTestCase(TestCase):
+    """HistoryTable.rechainによる有効終了日の再計算"""
+    def setUp(self) -> None:
+        City.objects.bulk_create([
+            make_city('000001', date(2000, 1, 1), date(2000, 12, 31)),
+            make_city('000001', date(2010, 1, 1), None),
+            make_city('000001', date(2020, 1, 1), date(2030, 1, 1)),
+            make_city('000002', date(2000, 1, 1), date(2030, 1, 1)),
+            make_city('000003', date(2000, 1, 1), DEFAULT_valid_through),
+        ])
+
+    def get_timeline(self):
+        return list(City.objects.order_by('code', 'valid_from').values_list('code', 'valid_through', 'version'))
+
+    def test_rechain_all(self):
+        self.assertEqual(City.rechain(), 4)
+        self.assertEqual(self.get_timeline(), [
+            ('000001', date(2009, 12, 31), 2),
+            ('000001', date(2019, 12, 31), 2),
+            ('000001', DEFAULT_valid_through, 2),
+            ('000002', DEFAULT_valid_through, 2),
+            ('000003', DEFAULT_valid_through, 1),
+        ])
+        self.assertEqual(City.rechain(), 0)
+
+    def test_rechain_keys(self):
+        """指定したキーのタイムラインのみ再計算する"""
+        self.assertEqual(City.rechain([City(code='000002')]), 1)
+        self.assertEqual(City.objects.get(code='000001', valid_from=date(2000, 1, 1)).valid_through,
+                         date(2000, 12, 31))
+        self.assertEqual(City.rechain([]), 0)
+
+    def test_rechain_null_version(self):
+        """バージョン番号が未設定のレコードも1として更新する"""
+        City.objects.filter(code='000002').update(version=None)
+        self.assertEqual(City.rechain([City(code='000002')]), 1)
+        self.assertEqual(City.objects.get(code='000002').version, 1)
+
+    @skipUnless(connection.vendor in ('postgresql', 'oracle'), 'LEAD() update is used on PostgreSQL and Oracle.')
+    def test_rechain_by_sql(self):
+        with self.assertNumQueries(1 + 2):     # savepoint
+            self.assertEqual(City.rechain(), 4)
+        self.assertEqual(City.objects.get(code='000001', valid_from=date(2010, 1, 1)).valid_through,
+                         date(2019, 12, 31))
+
+    def test_bulk_import(self):
+        """CsvBulkImportMixinはinsert後にタイムラインを再計算する"""
+        modeladmin = CityBulkImportAdmin(City, cmmSite)
+        future_date = date.today() + timedelta(days=30)
+        path = write_csv_file(modeladmin, [('000003', '新', '', '北海道', 'ﾎｯｶｲﾄﾞｳ', future_date.isoformat())])
+        try:
+            modeladmin.pre_import_processing()
+            with open(path, 'rb') as csv_file:
+                modeladmin.read_csv_file(csv_file, 'importer', 'lot1')
+        finally:
+            os.remove(path)
+        self.assertEqual(list(City.objects.filter(code='000003').order_by('valid_from')
+                                          .values_list('valid_through', flat=True)),
+                         [future_date - timedelta(days=1), DEFAULT_valid_through])
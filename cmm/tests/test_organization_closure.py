@@ -0,0 +1,113 @@
+import io
+from django.test import TestCase
+
+from cmm.admin.site import cmmSite
+from cmm.csv import CsvLog
+from cmm.exception import RecursiveParenthoodError
+from cmm.models import (Organization, OrganizationRel, OrganizationClosure, compute_organization_closure,
+                        find_recursive_parenthood, get_ancestors, get_descendants, get_descendant_ids,
+                        rebuild_organization_closure)
+
+
+class OrganizationClosureTestCase(TestCase):
+    """組織階層の閉包テーブル"""
+    def setUp(self) -> None:
+        self.orgs = {}
+        for code in ('A', 'B', 'C', 'D', 'E'):
+            self.orgs[code] = Organization.objects.create(code=code, name=code)
+        # A - B - C - D, Eは独立
+        for parent, org in (('A', 'B'), ('B', 'C'), ('C', 'D')):
+            self.relate(parent, org)
+
+    def relate(self, parent: str, org: str) -> OrganizationRel:
+        """上位組織を設定する"""
+        return OrganizationRel.objects.create(parent=self.orgs[parent], org=self.orgs[org])
+
+    def closure(self) -> dict:
+        """閉包テーブルの内容{(上位組織コード, 下位組織コード): 階層差}"""
+        return {(c.ancestor.code, c.descendant.code): c.depth
+                    for c in OrganizationClosure.objects.select_related('ancestor', 'descendant')}
+
+    def assert_consistent(self):
+        """閉包テーブルがOrganizationRelから計算した結果と一致する"""
+        expected = compute_organization_closure(OrganizationRel.objects.values_list('parent_id', 'org_id'))
+        actual = {(c.ancestor_id, c.descendant_id): c.depth for c in OrganizationClosure.objects.all()}
+        self.assertEqual(actual, expected)
+
+    def test_add(self):
+        """関連の追加で全上位組織×全下位組織の行が作られる"""
+        self.assertEqual(self.closure(), {('A', 'B'): 1, ('A', 'C'): 2, ('A', 'D'): 3,
+                                          ('B', 'C'): 1, ('B', 'D'): 2, ('C', 'D'): 1})
+        self.assertEqual([org.code for org in get_ancestors(self.orgs['D'].id)], ['C', 'B', 'A'])
+        self.assertEqual(get_descendant_ids(self.orgs['B'].id), {self.orgs['C'].id, self.orgs['D'].id})
+        self.assertEqual(len(get_descendants(self.orgs['A'].id)), 3)
+
+    def test_lookup_without_recursion(self):
+        """下位組織の検索は閉包テーブルの一回の検索"""
+        with self.assertNumQueries(1):
+            get_descendant_ids(self.orgs['A'].id)
+
+    def test_multiple_parents(self):
+        """複数の上位組織を持つ場合は短い方の階層差になり、片方を外しても残る"""
+        rel = self.relate('A', 'C')
+        self.assertEqual(self.closure()[('A', 'D')], 2)
+        self.assert_consistent()
+
+        rel.delete()
+        self.assertEqual(self.closure()[('A', 'D')], 3)
+        self.assert_consistent()
+
+    def test_delete(self):
+        """関連の削除(QuerySet.delete()を含む)で経路がなくなった行は削除される"""
+        OrganizationRel.objects.filter(parent=self.orgs['B'], org=self.orgs['C']).delete()
+        self.assertEqual(self.closure(), {('A', 'B'): 1, ('C', 'D'): 1})
+        self.assert_consistent()
+
+    def test_change_parent(self):
+        """上位組織の変更"""
+        rel = OrganizationRel.objects.get(parent=self.orgs['B'], org=self.orgs['C'])
+        rel.parent = self.orgs['E']
+        rel.save()
+        self.assertEqual(get_descendant_ids(self.orgs['E'].id), {self.orgs['C'].id, self.orgs['D'].id})
+        self.assertEqual(get_descendant_ids(self.orgs['A'].id), {self.orgs['B'].id})
+        self.assert_consistent()
+
+    def test_recursive_parenthood(self):
+        """自分自身や下位組織を上位組織にはできない"""
+        self.assertRaises(RecursiveParenthoodError, self.relate, 'D', 'A')
+        self.assertRaises(RecursiveParenthoodError, self.relate, 'E', 'E')
+        self.assert_consistent()
+
+    def test_rebuild(self):
+        """作り直しても同じ内容になる"""
+        self.relate('E', 'C')
+        before = self.closure()
+        OrganizationClosure.objects.all().delete()
+        rebuild_organization_closure()
+        self.assertEqual(self.closure(), before)
+
+class RecursiveParenthoodTestCase(TestCase):
+    """組織階層のCSV importでの循環チェック"""
+    def test_find_recursive_parenthood(self):
+        """循環している関連だけを返す、循環の下位にある関連は含まない"""
+        edges = [(1, 2), (2, 3), (3, 1), (3, 4), (4, 5), (6, 6), (7, 8)]
+        self.assertEqual(find_recursive_parenthood(edges), {(1, 2), (2, 3), (3, 1), (6, 6)})
+        self.assertEqual(find_recursive_parenthood([(1, 2), (2, 3), (None, 1)]), set())
+
+    def test_import(self):
+        """既存の関連とchunkの関連をまとめてチェックし、循環している行をエラーとして記録する"""
+        orgs = {code: Organization.objects.create(code=code, name=code) for code in ('A', 'B', 'C', 'D', 'E')}
+        OrganizationRel.objects.create(parent=orgs['A'], org=orgs['B'])
+
+        lines = ['code,abbr,parent_code,name,rank',
+                 'C,,B,C,',     # A - B - C
+                 'A,,C,A,',     # 循環: A - B - C - A
+                 'E,,D,E,',
+                 'D,,E,D,']     # 循環: D - E - D
+        csv_file = io.BytesIO('\n'.join(lines).encode('utf-8'))
+        csv_file.name = 'organization_rel.csv'
+        cmmSite._registry[OrganizationRel].read_csv_file(csv_file, 'importer', 'lot1')
+
+        errors = CsvLog.objects.filter(lot_number='lot1', log_level=CsvLog.ERROR).order_by('row_no')
+        self.assertEqual([log.row_no for log in errors], [2, 3, 4, 5])
+        self.assertEqual(OrganizationRel.objects.count(), 1)
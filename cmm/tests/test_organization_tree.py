@@ -0,0 +1,59 @@
+from django.test import TestCase
+
+from cmm.const import ORG_RANK
+from cmm.models import Category, Code, Organization, OrganizationRel, get_organization_tree
+
+
+class OrganizationTreeTestCase(TestCase):
+    """組織階層キャッシュ"""
+    def setUp(self) -> None:
+        category = Category.objects.create(category=ORG_RANK, name=ORG_RANK)
+        self.ranks = {code: Code.objects.create(category=category, code=code, name=code) for code in ('0', '1', '2')}
+        with self.captureOnCommitCallbacks(execute=True):
+            self.head = Organization.objects.create(code='0', name='本部', abbr='本部', rank=self.ranks['0'])
+            self.dept = Organization.objects.create(code='1', name='部', abbr='部', rank=self.ranks['1'])
+            self.section = Organization.objects.create(code='2', name='課', abbr='課', rank=self.ranks['2'])
+            OrganizationRel.objects.create(parent=self.head, org=self.dept)
+            OrganizationRel.objects.create(parent=self.dept, org=self.section)
+
+    def test_upper_organization_choices(self):
+        """下位組織を持つ組織をランクに応じて字下げする"""
+        self.assertEqual(get_organization_tree().get_upper_organization_choices(),
+                         [(self.head.id, '|本部'), (self.dept.id, '|-部')])
+
+    def test_cached(self):
+        """二回目以降はDBを検索しない"""
+        get_organization_tree()
+        with self.assertNumQueries(0):
+            tree = get_organization_tree()
+            tree.get_upper_organization_choices()
+            self.assertEqual(tree.get_rank_code(self.section.id), '2')
+            self.assertEqual(tree.parents[self.section.id], {self.dept.id})
+            self.assertEqual(tree.children[self.head.id], {self.dept.id})
+
+    def test_invalidate(self):
+        """組織、組織階層、コードが更新されたら読み込み直す"""
+        get_organization_tree()
+        with self.captureOnCommitCallbacks(execute=True):
+            OrganizationRel.objects.create(parent=self.dept, org=Organization.objects.create(code='3', name='係'))
+        with self.assertNumQueries(2):
+            tree = get_organization_tree()
+        self.assertEqual(len(tree.children[self.dept.id]), 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.dept.abbr = '事業部'
+            self.dept.save()
+        self.assertEqual(get_organization_tree().get_upper_organization_choices()[1], (self.dept.id, '|-事業部'))
+
+    def test_filter_lookups(self):
+        """changelistのフィルターはキャッシュから作る"""
+        get_organization_tree()
+        self.client.force_login(self.create_superuser())
+        response = self.client.get('/commonsite/cmm/organization/')
+        self.assertContains(response, '|-部')
+
+    def create_superuser(self):
+        """管理者"""
+        # pylint: disable = import-outside-toplevel
+        from cmm.models.base import AuthUser
+        return AuthUser.objects.create_superuser(username='admin', password='admin')
@@ -1,6 +1,6 @@
 from datetime import date
 import pytest
-from cmm.utils.date import Period, flat_overlap
+from cmm.utils.date import Period, count_overlaps, flat_overlap
 
 
 @pytest.fixture(name='test_period')
@@ -77,3 +77,26 @@ def test_sort(test_period):
         Period(date(2000, 2, 1), date(2000, 2, 15)),]
     
     
+
+def test_ordinals(test_period):
+    """日付は序数で保持する"""
+    assert (test_period.start, test_period.end) == (date(2000, 1, 1).toordinal(), date(2000, 2, 15).toordinal())
+    assert test_period.valid_through == date(2000, 2, 15)
+    assert not hasattr(test_period, '__dict__')
+    assert test_period != Period(date(2000, 1, 1), date(2000, 2, 14))
+
+def test_flat_overlap_gap(test_period):
+    """どの期間にも含まれない区間は返さない"""
+    assert flat_overlap([test_period, Period(date(2000, 3, 1), date(2000, 3, 15))]) == \
+        [test_period, Period(date(2000, 3, 1), date(2000, 3, 15))]
+
+def test_count_overlaps(test_period):
+    """区間ごとの有効な期間の数と重みの合計"""
+    periods = [test_period, Period(date(2000, 1, 10), date(2000, 3, 1)), Period(date(2000, 2, 1), date(2000, 2, 10))]
+    assert count_overlaps(periods, [1, 0, 1]) == [
+        (Period(date(2000, 1, 1), date(2000, 1, 9)), 1, 1),
+        (Period(date(2000, 1, 10), date(2000, 1, 31)), 2, 1),
+        (Period(date(2000, 2, 1), date(2000, 2, 10)), 3, 2),
+        (Period(date(2000, 2, 11), date(2000, 2, 15)), 2, 1),
+        (Period(date(2000, 2, 16), date(2000, 3, 1)), 1, 0),
+    ]
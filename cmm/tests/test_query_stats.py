@@ -0,0 +1,92 @@
+import logging
+from unittest import mock
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+from django.test import TestCase, override_settings
+
+from cmm.exception import QueryBudgetExceededError
+from cmm.models import Organization
+from cmm.models.base import AuthUser
+from cmm.utils.logging import LoggingRequestAttributesFilter
+from cmm.utils.query_stats import QueryStats, assert_max_queries, get_current_query_stats, record_queries, \
+    unavailable_aliases
+
+MIDDLEWARE = [*settings.MIDDLEWARE, 'cmm.utils.query_stats.QueryStatsMiddleware']
+CHANGELIST = 'cmmSite:cmm_organization_changelist'
+
+
+def test_query_stats_keeps_slowest():
+    """遅いSQLをslow_count件まで長い順に保持する"""
+    stats = QueryStats(slow_count=2)
+    for duration, sql in ((0.1, 'a'), (0.3, 'b'), (0.2, 'c'), (0.05, 'd')):
+        stats.record(sql, duration)
+    assert stats.count == 4
+    assert round(stats.total_time, 2) == 0.65
+    assert stats.slowest == [(0.3, 'b'), (0.2, 'c')]
+
+
+class QueryStatsTestCase(TestCase):
+    """SQLの実行回数の記録と上限"""
+    def setUp(self) -> None:
+        self.client.force_login(AuthUser.objects.create_superuser(username='admin', password='admin'))
+
+    def test_record_queries(self):
+        """ブロック内のSQLを記録し、ログレコードに設定する"""
+        record = logging.LogRecord('test', logging.INFO, __file__, 0, 'message', (), None)
+        with record_queries() as stats:
+            list(Organization.objects.all())
+            list(Organization.objects.filter(code='1'))
+            self.assertIs(get_current_query_stats(), stats)
+            LoggingRequestAttributesFilter().filter(record)
+        self.assertEqual(stats.count, 2)
+        self.assertEqual(record.query_count, 2)
+        self.assertIsNone(get_current_query_stats())
+
+    def test_record_queries_without_driver(self):
+        """DBドライバを読み込めないaliasは記録の対象外とし、他のaliasは記録する"""
+        class Handler:
+            def __iter__(self):
+                return iter(['default', 'oracle'])
+
+            def __getitem__(self, alias):
+                if alias == 'oracle':
+                    raise ImproperlyConfigured('Error loading cx_Oracle module')
+                return connections[alias]
+
+        self.addCleanup(unavailable_aliases.discard, 'oracle')
+        with mock.patch('cmm.utils.query_stats.connections', Handler()):
+            with record_queries() as stats:
+                list(Organization.objects.all())
+        self.assertEqual(stats.count, 1)
+        self.assertIn('oracle', unavailable_aliases)
+
+    def test_assert_max_queries(self):
+        """上限を超えたらエラー"""
+        with assert_max_queries(1):
+            list(Organization.objects.all())
+        with self.assertRaises(QueryBudgetExceededError):
+            with assert_max_queries(1, 'organizations'):
+                list(Organization.objects.all())
+                list(Organization.objects.all())
+
+    @override_settings(MIDDLEWARE=MIDDLEWARE)
+    def test_middleware_logs_query_count(self):
+        """リクエストごとにSQLの実行回数をログに出力する"""
+        with self.assertLogs('cmm.utils.query_stats', level='INFO') as logs:
+            self.client.get('/commonsite/cmm/organization/')
+        self.assertIn(CHANGELIST, logs.output[0])
+
+    @override_settings(MIDDLEWARE=MIDDLEWARE, QUERY_BUDGETS={CHANGELIST: 1}, QUERY_BUDGET_STRICT=True)
+    def test_middleware_enforces_budget(self):
+        """上限を超えたviewはエラー"""
+        with self.assertRaises(QueryBudgetExceededError):
+            self.client.get('/commonsite/cmm/organization/')
+
+    @override_settings(MIDDLEWARE=MIDDLEWARE, QUERY_BUDGETS={CHANGELIST: 1})
+    def test_middleware_warns_budget(self):
+        """STRICTでなければ警告ログのみ"""
+        with self.assertLogs('cmm.utils.query_stats', level='WARNING'):
+            response = self.client.get('/commonsite/cmm/organization/')
+        self.assertEqual(response.status_code, 200)
@@ -0,0 +1,78 @@
+from datetime import date
+from io import StringIO
+from unittest import mock
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import TestCase
+
+from cmm.models.base import DEFAULT_valid_through
+from cmm.models.city import City
+from cmm.utils.timeline import DUPLICATE, GAP, INVERTED, OPEN, OVERLAP, get_history_models, iter_timeline_issues, \
+    repair_timelines
+
+
+def make_city(code: str, valid_from: date, valid_through: date) -> City:
+    return City(code=code, name=code, pref_name='北海道', pref_name_kana='ﾎｯｶｲﾄﾞｳ', version=1,
+                valid_from=valid_from, valid_through=valid_through)
+
+class TimelineCheckTestCase(TestCase):
+    """HistoryTableのタイムライン検査"""
+    def setUp(self) -> None:
+        City.objects.bulk_create([
+            # 正常
+            make_city('000001', date(2000, 1, 1), date(2009, 12, 31)),
+            make_city('000001', date(2010, 1, 1), DEFAULT_valid_through),
+            # 空白と重複
+            make_city('000002', date(2000, 1, 1), date(2009, 12, 30)),
+            make_city('000002', date(2010, 1, 1), date(2020, 1, 1)),
+            make_city('000002', date(2020, 1, 1), None),
+            # 逆転
+            make_city('000003', date(2000, 1, 2), date(2000, 1, 1)),
+        ])
+
+    def get_issues(self):
+        return sorted((issue.key, issue.valid_from, issue.expected, issue.kind)
+                      for issue in iter_timeline_issues(City, chunk_size=2))
+
+    def test_issues(self):
+        expected = [
+            (('000002',), date(2000, 1, 1), date(2009, 12, 31), GAP),
+            (('000002',), date(2010, 1, 1), date(2019, 12, 31), OVERLAP),
+            (('000002',), date(2020, 1, 1), DEFAULT_valid_through, OPEN),
+            (('000003',), date(2000, 1, 2), None, INVERTED),
+        ]
+        self.assertEqual(self.get_issues(), expected)
+
+        # ウィンドウ関数に非対応のDBは前後の行を比較する
+        with mock.patch.object(connection.features, 'supports_over_clause', False):
+            self.assertEqual(self.get_issues(), expected)
+
+    def test_command(self):
+        self.assertIn(City, get_history_models())
+
+        out = StringIO()
+        with self.assertRaises(CommandError):
+            call_command('cmm_check_timelines', '--models', 'cmm.City', '--fail', stdout=out)
+        self.assertIn('cmm.City: 4 issues', out.getvalue())
+
+        with self.assertNumQueries(4):
+            # 検索、savepoint、bulk_update、savepoint解放
+            call_command('cmm_check_timelines', '--models', 'cmm.City', '--repair', stdout=StringIO())
+        self.assertEqual([issue.kind for issue in iter_timeline_issues(City)], [INVERTED])
+        self.assertEqual(City.objects.get(code='000002', valid_from=date(2010, 1, 1)).version, 2)
+
+    def test_duplicate(self):
+        """同じキーで有効開始日が同じ版は、あるべき有効終了日が逆転するので修復対象としない"""
+        # Cityは(code, valid_from)のユニーク制約があるので、DBの検索結果の代わりに行を渡す
+        rows = [(1, ('000004',), 1, date(2000, 1, 1), date(2009, 12, 31), date(2000, 1, 1)),
+                (2, ('000004',), 1, date(2000, 1, 1), DEFAULT_valid_through, None)]
+        with mock.patch('cmm.utils.timeline.iter_timeline_rows', return_value=rows):
+            issues = list(iter_timeline_issues(City))
+        self.assertEqual([(issue.pk, issue.expected, issue.kind) for issue in issues], [(1, None, DUPLICATE)])
+        with self.assertNumQueries(0):
+            self.assertEqual(repair_timelines(City, issues), 0)
+
+    def test_unknown_model(self):
+        with self.assertRaises(CommandError):
+            call_command('cmm_check_timelines', '--models', 'cmm.Code', stdout=StringIO())
@@ -0,0 +1,69 @@
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.test import TestCase
+
+from cmm.models import Shikuchoson
+
+
+class OptimisticLockTestCase(TestCase):
+    """VersionedTableの条件付きUPDATEによる楽観的排他"""
+    def setUp(self) -> None:
+        self.objs = [Shikuchoson.objects.create(code=f'{i:05d}', name=f'市区町村{i}', pref_name='北海道',
+                                                pref_name_kana='ﾎｯｶｲﾄﾞｳ') for i in range(3)]
+
+    def test_save_in_one_query(self):
+        """既存レコードの保存は検索せず、一つのUPDATEで済む"""
+        obj = Shikuchoson.objects.get(pk=self.objs[0].pk)
+        obj.name = '変更'
+        obj.skip_history_when_saving = True
+        with self.assertNumQueries(1):
+            obj.save()
+        self.assertEqual(obj.version, 2)
+        self.assertEqual(Shikuchoson.objects.get(pk=obj.pk).version, 2)
+
+    def test_race_condition(self):
+        """保存前のversionが一致しない場合は更新せず、versionを戻す"""
+        obj_a = Shikuchoson.objects.get(pk=self.objs[0].pk)
+        obj_b = Shikuchoson.objects.get(pk=self.objs[0].pk)
+        obj_a.name = '変更A'
+        obj_a.save()
+        obj_b.name = '変更B'
+        with self.assertRaises(ValidationError), transaction.atomic():
+            obj_b.save()
+        self.assertEqual(obj_b.version, 1)
+        self.assertEqual(Shikuchoson.objects.get(pk=obj_a.pk).name, '変更A')
+
+    def test_deleted(self):
+        """削除済みのレコードはINSERTせず競合とする"""
+        obj = Shikuchoson.objects.get(pk=self.objs[0].pk)
+        Shikuchoson.objects.filter(pk=obj.pk).delete()
+        with self.assertRaises(ValidationError), transaction.atomic():
+            obj.save()
+        self.assertFalse(Shikuchoson.objects.filter(pk=obj.pk).exists())
+
+    def test_update_fields(self):
+        """update_fieldsを指定してもversionは更新する"""
+        obj = Shikuchoson.objects.get(pk=self.objs[0].pk)
+        obj.name = '変更'
+        obj.save(update_fields=['name'])
+        self.assertEqual(Shikuchoson.objects.get(pk=obj.pk).version, 2)
+
+    def test_bulk_update_versioned(self):
+        for obj in self.objs:
+            obj.name += '変更'
+        with self.assertNumQueries(3):
+            # savepoint、UPDATE、savepoint解放
+            self.assertEqual(Shikuchoson.bulk_update_versioned(self.objs, ['name']), 3)
+        self.assertEqual([obj.version for obj in self.objs], [2, 2, 2])
+        self.assertEqual(list(Shikuchoson.objects.order_by('code').values_list('name', 'version')),
+                         [(f'市区町村{i}変更', 2) for i in range(3)])
+
+    def test_bulk_update_versioned_race_condition(self):
+        """一件でも競合があれば全件をロールバックする"""
+        Shikuchoson.objects.filter(pk=self.objs[1].pk).update(version=5)
+        for obj in self.objs:
+            obj.name = '変更'
+        with self.assertRaises(ValidationError):
+            Shikuchoson.bulk_update_versioned(self.objs, ['name'])
+        self.assertEqual([obj.version for obj in self.objs], [1, 1, 1])
+        self.assertFalse(Shikuchoson.objects.filter(name='変更').exists())
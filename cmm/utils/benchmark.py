@@ -0,0 +1,234 @@
+import csv
+import logging
+import os
+import tempfile
+import time
+import tracemalloc
+from datetime import date, timedelta
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Tuple
+from django.contrib import admin
+from django.db import connection, transaction
+from cmm.admin.base import CommonBaseTableAminMixin
+from cmm.admin.site import cmmSite
+from cmm.const import ORG_RANK, UTF8
+from cmm.csv import CsvBulkUpsertMixin, CsvLog, iter_csv_batches
+from cmm.models import Category, City, Code, Organization, Person, Shikuchoson, ZipCode
+from cmm.utils.query_stats import record_queries
+
+
+_logger = logging.getLogger(__name__)
+
+BENCHMARK_USER = 'benchmark'
+BENCHMARK_CATEGORY = 'benchmark'
+SHIKUCHOSON_COUNT = 100
+
+class BenchmarkResult(NamedTuple):
+    """ベンチマーク一回分の計測結果"""
+    model: str
+    operation: str
+    rows: int
+    seconds: float
+    queries: int
+    peak_memory: int            # tracemallocで計測したピーク時のメモリ使用量(byte)、計測しない場合はNone
+
+    @property
+    def rows_per_sec(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+class CityBenchmarkAdmin(CsvBulkUpsertMixin, CommonBaseTableAminMixin, admin.ModelAdmin):
+    """ベンチマーク用の市区町村(HistoryTable)のAdmin、adminSiteには登録しない、HistoryTable.apply_historyで保存する"""
+    fields = ['code', 'name', 'name_kana', 'pref_name', 'pref_name_kana']
+
+def measure(model_name: str, operation: str, rows: int, func: Callable[[], None],
+            trace_memory: bool = True) -> BenchmarkResult:
+    """funcの処理時間、SQL実行回数とピーク時のメモリ使用量を計測する"""
+    # pylint: disable = too-many-arguments
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        with record_queries(slow_count=0) as stats:
+            start = time.perf_counter()
+            func()
+            seconds = time.perf_counter() - start
+        peak_memory = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    return BenchmarkResult(model_name, operation, rows, seconds, stats.count, peak_memory)
+
+def iter_code_rows(rows: int) -> Iterator[Tuple]:
+    """コードマスタのCSV行"""
+    for i in range(rows):
+        yield (BENCHMARK_CATEGORY, f'{i:08d}', f'コード{i}', f'略{i}', i, 'True')
+
+def iter_organization_rows(rows: int) -> Iterator[Tuple]:
+    """組織のCSV行、ランクは0～4を順に割り当てる"""
+    for i in range(rows):
+        yield (f'{i:08d}', f'組織{i}', '', f'組織名{i}', str(i % 5))
+
+def iter_zipcode_rows(rows: int) -> Iterator[Tuple]:
+    """郵便番号のCSV行、市区町村はSHIKUCHOSON_COUNT件に振り分ける"""
+    for i in range(rows):
+        yield (f'{i % SHIKUCHOSON_COUNT:05d}', '', f'{i % 10000000:07d}', 'ﾍﾞﾝﾁﾏｰｸ', 'ｼｸﾁｮｳｿﾝ', f'ﾁｮｳｲｷ{i}',
+               'ベンチマーク', '市区町村', f'町域{i}')
+
+def iter_city_rows(rows: int) -> Iterator[Tuple]:
+    """市区町村(HistoryTable)のCSV行"""
+    for i in range(rows):
+        yield (f'{i:06d}', f'市区町村{i}', f'ｼｸﾁｮｳｿﾝ{i}', 'ベンチマーク', 'ﾍﾞﾝﾁﾏｰｸ')
+
+def prepare_codes() -> None:
+    """コードマスタのベンチマーク用カテゴリ"""
+    Category.objects.get_or_create(category=BENCHMARK_CATEGORY, defaults={'name': BENCHMARK_CATEGORY})
+
+def prepare_organizations() -> None:
+    """組織のランク"""
+    category, _ = Category.objects.get_or_create(category=ORG_RANK, defaults={'name': ORG_RANK})
+    for rank in range(5):
+        Code.objects.get_or_create(category=category, code=str(rank), defaults={'name': str(rank)})
+
+def prepare_zipcodes() -> None:
+    """郵便番号が参照する市区町村"""
+    Shikuchoson.objects.bulk_create(Shikuchoson(code=f'{i:05d}', name=f'市区町村{i}', pref_name='ベンチマーク',
+                                                pref_name_kana='ﾍﾞﾝﾁﾏｰｸ', name_kana=f'ｼｸﾁｮｳｿﾝ{i}')
+                                    for i in range(SHIKUCHOSON_COUNT))
+
+# {Model名: (Model, CSV行の生成関数, 事前準備)}
+BENCHMARK_TARGETS: Dict[str, Tuple] = {
+    'Code': (Code, iter_code_rows, prepare_codes),
+    'Organization': (Organization, iter_organization_rows, prepare_organizations),
+    'ZipCode': (ZipCode, iter_zipcode_rows, prepare_zipcodes),
+    'City': (City, iter_city_rows, None),
+}
+
+def get_modeladmin(model):
+    """ベンチマーク対象のModelAdmin"""
+    return CityBenchmarkAdmin(City, cmmSite) if model is City else cmmSite._registry[model]
+
+def write_csv_file(modeladmin, csv_rows: Iterable[Tuple]) -> str:
+    """合成データのCSVファイルを一時ファイルに作成する、呼び出し側で削除すること"""
+    fd, path = tempfile.mkstemp(suffix='.csv')
+    with open(fd, 'w', encoding=modeladmin.encoding, newline='') as csv_file:
+        writer = csv.writer(csv_file, modeladmin.dialect)
+        for _ in range(modeladmin.header_row_number):
+            writer.writerow(modeladmin.get_csv_columns())
+        writer.writerows(csv_rows)
+    return path
+
+def import_csv_file(modeladmin, path: str, lot_number: str) -> None:
+    """CSV import画面と同じ前処理、読込、後処理"""
+    modeladmin.pre_import_processing()
+    with open(path, 'rb') as csv_file:
+        modeladmin.read_csv_file(csv_file, BENCHMARK_USER, lot_number)
+    modeladmin.post_import_processing()
+
+def export_csv_rows(modeladmin) -> None:
+    """CSV exportと同じ変換を全件に行う、出力内容は捨てる"""
+    with open(os.devnull, 'w', encoding=modeladmin.csv_encoding or UTF8, newline='') as null_file:
+        writer = csv.writer(null_file, modeladmin.dialect)
+        for rows in iter_csv_batches(modeladmin, modeladmin.model.objects.order_by('pk')):
+            writer.writerows(rows)
+
+def run_benchmark(model_name: str, rows: int, trace_memory: bool = True) -> List[BenchmarkResult]:
+    """一つのModelについてimportとexportを計測する
+        DBへの変更はすべてrollbackするので、ベンチマーク用のDBでなくてもデータは残らない
+    """
+    model, iter_rows, prepare = BENCHMARK_TARGETS[model_name]
+    modeladmin = get_modeladmin(model)
+    path = write_csv_file(modeladmin, iter_rows(rows))
+    try:
+        with transaction.atomic():
+            if prepare is not None:
+                prepare()
+            lot_number = f'{BENCHMARK_USER}-{model_name}-{rows}'
+            results = [measure(model_name, 'import', rows, lambda: import_csv_file(modeladmin, path, lot_number),
+                               trace_memory)]
+            errors = CsvLog.objects.filter(lot_number=lot_number, log_level=CsvLog.ERROR).count()
+            if errors:
+                _logger.warning('%s rows of %s failed to be imported.', errors, model_name)
+
+            # exportは実際にimportされた件数で計測する
+            exported = model.objects.count()
+            results.append(measure(model_name, 'export', exported, lambda: export_csv_rows(modeladmin), trace_memory))
+            transaction.set_rollback(True)
+    finally:
+        os.remove(path)
+    return results
+
+def prepare_shikuchoson_dicts(rows: int) -> List[Dict[str, str]]:
+    """入力チェックの比較に使う市区町村のCSV行(列名をキーとするdict)"""
+    return [{'code': f'{i:06d}', 'pref_name': '北海道', 'name': f'市区町村{i}',
+             'pref_name_kana': 'ホッカイドウ', 'name_kana': f'シクチョウソン{i}'} for i in range(rows)]
+
+def prepare_persons(rows: int) -> None:
+    """exportの比較に使う個人"""
+    Person.objects.bulk_create((Person(last_name=f'姓{i}', first_name=f'名{i}', last_name_kana='セイ',
+                                       first_name_kana='メイ', birthday=date(1950, 1, 1) + timedelta(days=i % 20000),
+                                       email=f'p{i}@example.com', address='住所')
+                                for i in range(rows)), batch_size=10000)
+
+def validate_rows(modeladmin, csv_dicts: List[Dict[str, str]], is_cached: bool) -> None:
+    """ModelFormによる入力チェック
+        is_cached: True: ModelFormクラスをimport単位で作成する、False: 行ごとに作成する(改善前)
+    """
+    # pylint: disable = protected-access
+    model_fields = tuple(modeladmin.get_model_fields())
+    default_values = modeladmin.get_default_values()
+    modelform_class = modeladmin._CsvImportMixin__get_modelform_class(model_fields, default_values)
+    for csv_dict in csv_dicts:
+        if is_cached:
+            model_dict = modeladmin.csv2model(dict(csv_dict), model_fields=model_fields,
+                                              default_values=default_values)
+        else:
+            modelform_class = modeladmin._CsvImportMixin__get_modelform_class(
+                                    tuple(modeladmin.get_model_fields()), modeladmin.get_default_values())
+            model_dict = modeladmin.csv2model(dict(csv_dict))
+        modelform_class(model_dict).is_valid()
+
+def export_rows_per_row(modeladmin) -> None:
+    """行ごとの変換(改善前)、values()のdictをmodel2csvで変換し値ごとに日付型か判定する。出力内容は捨てる"""
+    queryset = modeladmin.model.objects.order_by('pk').values(*modeladmin.get_model_fields())
+    with open(os.devnull, 'w', encoding=modeladmin.csv_encoding or UTF8, newline='') as null_file:
+        writer = csv.writer(null_file, modeladmin.dialect)
+        for row_dict in queryset.iterator(chunk_size=modeladmin.export_chunk_size):
+            writer.writerow([v.strftime(modeladmin.date_format) if isinstance(v, date) else v
+                             for v in modeladmin.model2csv(row_dict).values()])
+
+# 改善前後の処理方法の比較 {比較名: (Model, 事前準備, [(処理名, 計測する処理)])}
+#   事前準備は件数を受け取り、計測する処理はModelAdminと事前準備の戻り値を受け取る
+COMPARISONS: Dict[str, Tuple[Any, Callable[[int], Any], List[Tuple[str, Callable[[Any, Any], None]]]]] = {
+    # ModelFormクラスを行ごとに作成する場合とimport単位で使いまわす場合の入力チェック
+    'modelform': (Shikuchoson, prepare_shikuchoson_dicts, [
+        ('validate/row', lambda modeladmin, csv_dicts: validate_rows(modeladmin, csv_dicts, False)),
+        ('validate/lot', lambda modeladmin, csv_dicts: validate_rows(modeladmin, csv_dicts, True)),
+    ]),
+    # 行ごとの変換と列の変換計画によるchunk単位の変換のCSV export
+    'export': (Person, prepare_persons, [
+        ('export/row', lambda modeladmin, _: export_rows_per_row(modeladmin)),
+        ('export/plan', lambda modeladmin, _: export_csv_rows(modeladmin)),
+    ]),
+}
+
+def run_comparison(name: str, rows: int, trace_memory: bool = True) -> List[BenchmarkResult]:
+    """改善前後の処理方法を同じ件数でそれぞれ計測する、DBへの変更はすべてrollbackする"""
+    model, prepare, operations = COMPARISONS[name]
+    modeladmin = cmmSite._registry[model]
+    results = []
+    with transaction.atomic():
+        prepared = prepare(rows)
+        for operation, func in operations:
+            results.append(measure(model.__name__, operation, rows,
+                                   lambda func=func: func(modeladmin, prepared), trace_memory))
+        transaction.set_rollback(True)
+    return results
+
+def format_results(results: Iterable[BenchmarkResult]) -> str:
+    """計測結果の表"""
+    lines = [f'database: {connection.vendor}',
+             f'{"model":<14}{"operation":<14}{"rows":>10}{"seconds":>10}{"rows/sec":>12}{"queries":>10}'
+             f'{"peak MiB":>10}']
+    for result in results:
+        peak = f'{result.peak_memory / 1024 / 1024:,.1f}' if result.peak_memory is not None else '-'
+        lines.append(f'{result.model:<14}{result.operation:<14}{result.rows:>10,}{result.seconds:>10.2f}'
+                     f'{result.rows_per_sec:>12,.0f}{result.queries:>10,}{peak:>10}')
+    return '\n'.join(lines)
@@ -0,0 +1,84 @@
+import logging
+import threading
+import time
+from typing import Any, Callable
+from django.core import checks
+from django.core.cache import cache, caches
+from django.db import transaction
+
+
+_logger = logging.getLogger(__name__)
+
+# プロセス間で共有されないキャッシュ・バックエンド
+PROCESS_LOCAL_CACHE_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+def check_shared_cache(app_configs, **kwargs):
+    """VersionedLocalCacheのバージョン番号を置くデフォルトのキャッシュがプロセス間で共有されない場合は警告する"""
+    # pylint: disable = unused-argument
+    backend = type(caches['default'])
+    if f'{backend.__module__}.{backend.__qualname__}' not in PROCESS_LOCAL_CACHE_BACKENDS:
+        return []
+    return [checks.Warning(
+        f'The default cache ({backend.__qualname__}) is not shared between processes, '
+        'so cached master data is not invalidated in other processes.',
+        hint='Set CACHES["default"] to a shared backend such as FileBasedCache, Memcached or Redis.',
+        id='cmm.W002',
+    )]
+
+class VersionedLocalCache:
+    """プロセス内に保持するキャッシュ、バージョン番号はDjangoのキャッシュに置いてプロセス間で無効化を共有する
+
+        name:   キャッシュ名、バージョン番号のキーになる
+        loader: キャッシュ内容を作成する関数
+        参照のたびにバージョン番号だけを確認し、変わっていればloaderで作り直す
+        LocMemCacheなどプロセスごとのキャッシュでは他のプロセスに無効化が伝わらないので、
+        settings.CACHESに共有のバックエンドを指定すること(system check cmm.W002で警告する)
+    """
+    def __init__(self, name: str, loader: Callable[[], Any]):
+        self.version_key = f'cmm:{name}:version'
+        self.loader = loader
+        self.__lock = threading.Lock()
+        self.__version = None
+        self.__value = None
+
+    def get_version(self) -> int:
+        """現在のバージョン番号、Djangoのキャッシュから消えていたら作り直す"""
+        version = cache.get(self.version_key)
+        if version is None:
+            version = self.__reset_version()
+        return version
+
+    def get(self) -> Any:
+        """キャッシュ内容、無効化されていれば作り直す"""
+        version = self.get_version()
+        with self.__lock:
+            if self.__value is None or self.__version != version:
+                _logger.debug('Loading %s of version %s.', self.version_key, version)
+                self.__value = self.loader()
+                self.__version = version
+            return self.__value
+
+    def invalidate(self) -> None:
+        """キャッシュを無効化する、トランザクション中ならcommit後に行う"""
+        transaction.on_commit(self.__increment_version)
+
+    def __increment_version(self) -> None:
+        try:
+            cache.incr(self.version_key)
+        except ValueError:
+            # バージョン番号がキャッシュから消えている
+            self.__reset_version()
+        with self.__lock:
+            self.__value = None
+
+    def __reset_version(self) -> int:
+        """消えたバージョン番号を作り直す
+            1から振り直すと、消える前に読み込んだプロセスの番号と一致して古い内容を使い続けることがあるので、
+            繰り返さない値として現在時刻(ナノ秒)を初期値にする
+        """
+        version = time.time_ns()
+        cache.add(self.version_key, version, timeout=None)
+        return cache.get(self.version_key, version)
@@ -1,6 +1,5 @@
-import fractions
-from functools import total_ordering
-from datetime import date, timedelta
+from datetime import date
+from typing import Dict, Iterable, List, Tuple
 from django.utils.formats import date_format
 
 
@@ -8,101 +7,108 @@ def format_date(date_obj):
     """format date to localized SHORT_DATE_FORMAT"""
     return date_format(date_obj, format='SHORT_DATE_FORMAT', use_l10n=True)
 
-# @total_ordering
 class Period:
-    """Period class, valid_from and valid_through are inclusive."""
+    """Period class, valid_from and valid_through are inclusive.
+        日付は序数(date.toordinal())で保持し、比較・ソートは整数で行う
+    """
+    __slots__ = ('start', 'end')
+
     def __init__(self, valid_from: date, valid_through: date):
-        self.valid_from = valid_from
-        self.valid_through = valid_through
-        if self.valid_from > self.valid_through:
-            self.valid_from, self.valid_through = self.valid_through, self.valid_from
-        
+        self.start = valid_from.toordinal()
+        self.end = valid_through.toordinal()
+        if self.start > self.end:
+            self.start, self.end = self.end, self.start
+
+    @classmethod
+    def from_ordinals(cls, start: int, end: int) -> 'Period':
+        """序数から作成する"""
+        period = cls.__new__(cls)
+        period.start, period.end = start, end
+        return period
+
+    @property
+    def valid_from(self) -> date:
+        return date.fromordinal(self.start)
+
+    @property
+    def valid_through(self) -> date:
+        return date.fromordinal(self.end)
+
     def __str__(self) -> str:
         return f'[{date_format(self.valid_from)}: {date_format(self.valid_through)}]'
 
     def __eq__(self, obj) -> bool:
-        return isinstance(obj, self.__class__) and \
-            self.valid_from == obj.valid_from and self.valid_through == obj.valid_through
+        return isinstance(obj, self.__class__) and self.start == obj.start and self.end == obj.end
 
     def __ne__(self, obj) -> bool:
-        return not isinstance(obj, self.__class__) and \
-            self.valid_from != obj.valid_from or self.valid_through != obj.valid_through
+        return not self == obj
 
     def __lt__(self, obj) -> bool:
-        return self.valid_from < obj.valid_from or \
-            self.valid_from == obj.valid_from and self.valid_through < obj.valid_through
+        return (self.start, self.end) < (obj.start, obj.end)
 
     def __le__(self, obj) -> bool:
-        return self.valid_from <= obj.valid_from or \
-            self.valid_from == obj.valid_from and self.valid_through <= obj.valid_through
+        return (self.start, self.end) <= (obj.start, obj.end)
 
     def __gt__(self, obj) -> bool:
-        return self.valid_from > obj.valid_from or \
-            self.valid_from == obj.valid_from and self.valid_through > obj.valid_through
+        return (self.start, self.end) > (obj.start, obj.end)
 
     def __ge__(self, obj) -> bool:
-        return self.valid_from >= obj.valid_from or \
-            self.valid_from == obj.valid_from and self.valid_through >= obj.valid_through
-    
+        return (self.start, self.end) >= (obj.start, obj.end)
+
     def __hash__(self) -> int:
-        return hash((self.valid_from, self.valid_through))
-    
+        return hash((self.start, self.end))
+
     def __repr__(self):
         return f'[{self.valid_from}:{self.valid_through}]'
-    
+
     def is_contains(self, obj):
         """ほかの期間を含んでいるのか"""
         if obj is None or not isinstance(obj, self.__class__):
             return False
-        return self.valid_from <= obj.valid_from and self.valid_through >= obj.valid_through
-    
+        return self.start <= obj.start and self.end >= obj.end
+
     def is_contained(self, obj):
         """ほかの期間に含まれているか"""
         if obj is None or not isinstance(obj, self.__class__):
             return False
-        return self.valid_from >= obj.valid_from and self.valid_through <= obj.valid_through
+        return self.start >= obj.start and self.end <= obj.end
 
     def is_joined(self, obj):
         """ほかの期間と重なっているか"""
         if obj is None or not isinstance(obj, self.__class__):
             return False
-        return self.valid_from <= obj.valid_through and self.valid_through >= obj.valid_from
-    
+        return self.start <= obj.end and self.end >= obj.start
+
     def to_dict(self):
         """Convert period to dict"""
         return({'valid_from': self.valid_from, 'valid_through': self.valid_through})
-    
-    def get_ends(self):
-        """両端をsort可能なdictに変換する"""
-        return [{'date': self.valid_from, 'type': 'start', 'sort_key': self.valid_from.strftime('%Y%m%d') + '0'},
-                {'date': self.valid_through, 'type': 'end', 'sort_key': self.valid_through.strftime('%Y%m%d') + '1'}]
-        
-def flat_overlap(periods: list[Period]) -> list[Period]:
-    """Break down overlapped periods to separated ones."""
-    converted = []
-    for period in periods:
-        converted.extend(period.get_ends())
-    converted.sort(key=lambda x: x.get('sort_key'))
-    
+
+def count_overlaps(periods: Iterable[Period], weights: Iterable[int] = None) -> List[Tuple[Period, int, int]]:
+    """重なった期間を区切り、区間ごとに(区間, 有効な期間の数, 有効な期間の重みの合計)を返す
+        期間の開始日と終了日の翌日を境界として走査する(sweep line)、O(N log N)
+        どの期間にも含まれない区間は返さない
+    """
+    periods = list(periods)
+    weights = [1] * len(periods) if weights is None else list(weights)
+
+    # {境界の序数: (期間数の増減, 重みの増減)}
+    deltas: Dict[int, List[int]] = {}
+    for period, weight in zip(periods, weights):
+        for ordinal, sign in ((period.start, 1), (period.end + 1, -1)):
+            delta = deltas.setdefault(ordinal, [0, 0])
+            delta[0] += sign
+            delta[1] += sign * weight
+
     fragments = []
-    start_cnt = 0
-    valid_from = None
-    for item in converted:
-        current_type = item.get('type')
-        current_date = item.get('date')
-        if current_type == 'start':
-            start_cnt += 1
-            if valid_from is None:
-                valid_from = current_date
-            elif current_date > valid_from:
-                fragments.append(Period(valid_from, current_date - timedelta(days=1)))
-                valid_from = current_date
-        else:
-            start_cnt -= 1
-            if current_date >= valid_from:
-                fragments.append(Period(valid_from, current_date))
-                if start_cnt > 0:
-                    valid_from = current_date + timedelta(days=1)
-                else:
-                    valid_from = None
+    count = total = 0
+    boundaries = sorted(deltas)
+    for ordinal, next_ordinal in zip(boundaries, boundaries[1:]):
+        count += deltas[ordinal][0]
+        total += deltas[ordinal][1]
+        if count > 0:
+            fragments.append((Period.from_ordinals(ordinal, next_ordinal - 1), count, total))
     return fragments
+
+def flat_overlap(periods: list[Period]) -> list[Period]:
+    """Break down overlapped periods to separated ones."""
+    return [fragment for fragment, _, _ in count_overlaps(periods)]
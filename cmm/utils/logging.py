@@ -39,10 +39,14 @@ class LoggingRequestAttributesMiddleware:
         return response
 
 class LoggingRequestAttributesFilter(Filter):
-    """IPアドレスとログインユーザー名を取得する"""
+    """IPアドレスとログインユーザー名を取得する、QueryStatsMiddleware使用時は実行中のSQL回数と合計時間(ms)も取得する"""
     def filter(self, record):
         record.username = getattr(local, 'log_username', None)
         record.ip_address = getattr(local, 'log_ip_address', None)
         record.session_key = getattr(local, 'log_session_key', None)
 
+        query_stats = getattr(local, 'log_query_stats', None)
+        record.query_count = query_stats.count if query_stats is not None else None
+        record.query_time = round(query_stats.total_time * 1000, 1) if query_stats is not None else None
+
         return True
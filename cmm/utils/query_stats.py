@@ -0,0 +1,126 @@
+import heapq
+import logging
+import time
+from contextlib import ExitStack, contextmanager
+from typing import Dict, List, Set, Tuple
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+from cmm.exception import QueryBudgetExceededError
+from cmm.utils.logging import local
+
+
+_logger = logging.getLogger(__name__)
+
+# DBドライバを読み込めなかったalias、リクエストごとに読み込みを再試行しない
+unavailable_aliases: Set[str] = set()
+
+class QueryStats:
+    """一回のリクエストで発行したSQLの統計
+
+        count:          SQLの実行回数（executemanyは一回と数える）
+        total_time:     SQLの合計実行時間（秒）
+        slowest:        実行時間の長いSQL [(秒, SQL)]、長い順にslow_count件まで保持する
+    """
+    def __init__(self, slow_count: int = 5):
+        self.count = 0
+        self.total_time = 0.0
+        self.slow_count = slow_count
+        self.__slowest: List[Tuple[float, int, str]] = []       # 最小ヒープ
+
+    def record(self, sql: str, duration: float) -> None:
+        """SQLの実行を記録する"""
+        self.count += 1
+        self.total_time += duration
+        if self.slow_count <= 0:
+            return
+        item = (duration, self.count, sql)
+        if len(self.__slowest) < self.slow_count:
+            heapq.heappush(self.__slowest, item)
+        elif duration > self.__slowest[0][0]:
+            heapq.heapreplace(self.__slowest, item)
+
+    @property
+    def slowest(self) -> List[Tuple[float, str]]:
+        return [(duration, sql) for duration, _, sql in sorted(self.__slowest, reverse=True)]
+
+    def __call__(self, execute, sql, params, many, context):
+        """connection.execute_wrapperとして使う"""
+        # pylint: disable = too-many-arguments
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.record(sql, time.perf_counter() - start)
+
+@contextmanager
+def record_queries(slow_count: int = 5):
+    """ブロック内で全DB接続に発行したSQLを記録する、ログ出力時のために実行中の統計をスレッドに保持する
+        DBドライバがインストールされていないalias(開発環境のoracle等)は対象外とする
+    """
+    stats = QueryStats(slow_count)
+    previous = getattr(local, 'log_query_stats', None)
+    setattr(local, 'log_query_stats', stats)
+    try:
+        with ExitStack() as stack:
+            for alias in connections:
+                if alias in unavailable_aliases:
+                    continue
+                try:
+                    connection = connections[alias]
+                except ImproperlyConfigured as e:
+                    _logger.warning('Queries on %s are not recorded: %s', alias, e)
+                    unavailable_aliases.add(alias)
+                    continue
+                stack.enter_context(connection.execute_wrapper(stats))
+            yield stats
+    finally:
+        setattr(local, 'log_query_stats', previous)
+
+def get_current_query_stats() -> QueryStats:
+    """実行中のリクエストのSQL統計、リクエスト外ではNone"""
+    return getattr(local, 'log_query_stats', None)
+
+def get_query_budget(view_name: str) -> int:
+    """viewのSQL実行回数の上限、settings.QUERY_BUDGETS {view名: 上限} にない場合はQUERY_BUDGET_DEFAULT"""
+    budgets: Dict[str, int] = getattr(settings, 'QUERY_BUDGETS', {})
+    return budgets.get(view_name, getattr(settings, 'QUERY_BUDGET_DEFAULT', None))
+
+@contextmanager
+def assert_max_queries(max_queries: int, label: str = None):
+    """ブロック内のSQL実行回数がmax_queriesを超えたらQueryBudgetExceededErrorとする、テストで使う"""
+    with record_queries() as stats:
+        yield stats
+    if stats.count > max_queries:
+        raise QueryBudgetExceededError(label, stats.count, max_queries, stats.slowest)
+
+class QueryStatsMiddleware:
+    """リクエストごとにSQLの実行回数、合計時間、遅いSQLを記録してログに出力する
+
+        settings.QUERY_STATS_SLOW_COUNT:    ログに出力する遅いSQLの件数、デフォルト5
+        settings.QUERY_BUDGETS:             {view名(cmmSite:cmm_employee_changelist等): SQL実行回数の上限}
+        settings.QUERY_BUDGET_DEFAULT:      QUERY_BUDGETSにないviewの上限、デフォルトは上限なし
+        settings.QUERY_BUDGET_STRICT:       Trueなら上限を超えたらQueryBudgetExceededErrorとする(テスト用)、Falseなら警告ログのみ
+        統計はLoggingRequestAttributesFilterでログレコードのquery_count, query_timeに設定される
+        StreamingHttpResponse(CSV export等)の本体はこのMiddlewareを抜けた後に生成されるので、その間のSQLは記録されない
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with record_queries(getattr(settings, 'QUERY_STATS_SLOW_COUNT', 5)) as stats:
+            response = self.get_response(request)
+
+            # ログレコードに統計が設定されるようにブロック内で出力する
+            view_name = request.resolver_match.view_name if request.resolver_match is not None else request.path
+            _logger.info('%s issued %s queries in %.1f ms.', view_name, stats.count, stats.total_time * 1000)
+            for duration, sql in stats.slowest:
+                _logger.debug('%.1f ms: %s', duration * 1000, sql)
+
+        budget = get_query_budget(view_name)
+        if budget is not None and stats.count > budget:
+            if getattr(settings, 'QUERY_BUDGET_STRICT', False):
+                raise QueryBudgetExceededError(view_name, stats.count, budget, stats.slowest)
+            _logger.warning('%s exceeded the query budget: %s queries (budget %s).', view_name, stats.count, budget)
+
+        return response
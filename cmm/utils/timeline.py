@@ -0,0 +1,102 @@
+import logging
+from datetime import date
+from typing import Iterator, List, NamedTuple, Tuple
+from django.apps import apps
+from django.db import connections, transaction
+from django.db.models import F, Window
+from django.db.models.functions import Lead
+from cmm.models.base import HistoryTable, ONE_DAY
+
+
+_logger = logging.getLogger(__name__)
+
+GAP = 'gap'                 # 次の版の有効開始日の前日より前に失効している
+OVERLAP = 'overlap'         # 次の版の有効開始日以後まで有効
+OPEN = 'open'               # 有効終了日が未設定
+INVERTED = 'inverted'       # 有効開始日 > 有効終了日、自動修復しない
+DUPLICATE = 'duplicate'     # 次の版と有効開始日が同じ、自動修復しない
+
+UNREPAIRABLE = (INVERTED, DUPLICATE)
+
+class TimelineIssue(NamedTuple):
+    """タイムラインの不整合一件"""
+    pk: int
+    key: Tuple                  # 広義的ユニーク・キーの値
+    version: int
+    valid_from: date
+    valid_through: date
+    expected: date              # あるべき有効終了日、INVERTEDとDUPLICATEはNone
+    kind: str
+
+def get_history_models() -> List[type]:
+    """HistoryTableを継承した全Model(proxyを除く)"""
+    return [model for model in apps.get_models() if issubclass(model, HistoryTable) and not model._meta.proxy]
+
+def get_timeline_key(model) -> List[str]:
+    """タイムラインのキー、広義的ユニーク・キーの列名(Foreign Keyはid)"""
+    model.get_unique_key_fields()
+    return list(model.broadly_unique_key_attnames)
+
+def iter_timeline_rows(model, chunk_size: int = 2000) -> Iterator[Tuple]:
+    """キーと有効開始日の順に全件を一回走査し、(pk, キー, version, 有効開始日, 有効終了日, 次の版の有効開始日)を返す
+        ウィンドウ関数に対応したDBはLEAD()で次の版の有効開始日を取得し、非対応のDBは前後の行を比較する
+    """
+    key = get_timeline_key(model)
+    queryset = model._base_manager.order_by(*key, 'valid_from')
+    fields = ['pk', *key, 'version', 'valid_from', 'valid_through']
+
+    if connections[queryset.db].features.supports_over_clause:
+        queryset = queryset.annotate(next_valid_from=Window(Lead('valid_from'),
+                                                            partition_by=[F(k) for k in key] or None,
+                                                            order_by=F('valid_from').asc()))
+        for row in queryset.values_list(*fields, 'next_valid_from').iterator(chunk_size=chunk_size):
+            yield row[0], tuple(row[1:len(key) + 1]), *row[len(key) + 1:]
+        return
+
+    previous = None
+    for row in queryset.values_list(*fields).iterator(chunk_size=chunk_size):
+        current = (row[0], tuple(row[1:len(key) + 1]), *row[len(key) + 1:])
+        if previous is not None:
+            yield *previous, current[3] if previous[1] == current[1] else None
+        previous = current
+    if previous is not None:
+        yield *previous, None
+
+def iter_timeline_issues(model, chunk_size: int = 2000) -> Iterator[TimelineIssue]:
+    """タイムラインの空白、重複、未設定、逆転と同じ有効開始日の版を検出する"""
+    # pylint: disable = not-callable
+    default_valid_through = model().get_default_valid_through()
+    for pk, key, version, valid_from, valid_through, next_valid_from in iter_timeline_rows(model, chunk_size):
+        if valid_through is not None and valid_from > valid_through:
+            yield TimelineIssue(pk, key, version, valid_from, valid_through, None, INVERTED)
+            continue
+
+        if next_valid_from is None:
+            if valid_through is None:
+                yield TimelineIssue(pk, key, version, valid_from, valid_through, default_valid_through, OPEN)
+            continue
+
+        if next_valid_from == valid_from:
+            # あるべき有効終了日が有効開始日より前になるので、どちらの版を残すかの判断が必要
+            yield TimelineIssue(pk, key, version, valid_from, valid_through, None, DUPLICATE)
+            continue
+
+        expected = next_valid_from - ONE_DAY
+        if valid_through is None:
+            yield TimelineIssue(pk, key, version, valid_from, valid_through, expected, OPEN)
+        elif valid_through < expected:
+            yield TimelineIssue(pk, key, version, valid_from, valid_through, expected, GAP)
+        elif valid_through > expected:
+            yield TimelineIssue(pk, key, version, valid_from, valid_through, expected, OVERLAP)
+
+def repair_timelines(model, issues: List[TimelineIssue], batch_size: int = 1000) -> int:
+    """有効終了日をあるべき日付に一括更新してバージョン番号を上げる、修復した件数を返す
+        有効期間が逆転したレコードと有効開始日が同じ版は業務的な判断が必要なため修復しない
+    """
+    repaired = [model(pk=issue.pk, valid_through=issue.expected, version=(issue.version or 0) + 1)
+                for issue in issues if issue.kind not in UNREPAIRABLE]
+    if repaired:
+        with transaction.atomic(using=model._base_manager.db):
+            model._base_manager.bulk_update(repaired, ['valid_through', 'version'], batch_size=batch_size)
+        _logger.info('Repaired valid_through of %s records of %s.', len(repaired), model.__name__)
+    return len(repaired)
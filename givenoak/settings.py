@@ -65,6 +65,7 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'cmm.utils.logging.LoggingRequestAttributesMiddleware',
+    'cmm.utils.query_stats.QueryStatsMiddleware',
     'simple_history.middleware.HistoryRequestMiddleware',
 ]
 
@@ -112,6 +113,14 @@ DATABASES = {
 SESSION_ENGINE = 'django.contrib.sessions.backends.file'
 SESSION_FILE_PATH = path.join(BASE_DIR, 'temp')
 
+# コードマスタ等のキャッシュ無効化をプロセス間で共有するため、LocMemCacheではなく共有のバックエンドを使う
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': path.join(BASE_DIR, 'temp', 'cache'),
+    }
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 
@@ -210,6 +219,9 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 10
 }
 
+# viewごとのSQL実行回数の上限 {view名: 上限}、cmm.utils.query_stats.QueryStatsMiddlewareで確認する
+QUERY_BUDGETS = {}
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
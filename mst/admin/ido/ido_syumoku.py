@@ -6,6 +6,7 @@ from django.urls import reverse
 from django.utils.html import format_html
 
 from cmm.admin.base import CommonBaseTableAminMixin, ValidFilter
+from cmm.csv import CsvForeignKey
 from cmm.forms import SimpleModelForm
 from mst.models import IdoSyumoku, IdoType, get_ido_type_code
 from mst.admin.ido import (IdoSyumokuIdoCategoryFilter, 
@@ -25,6 +26,10 @@ class IdoSyumokuAdmin(CommonBaseTableAminMixin, admin.ModelAdmin):
     
     inlines = [IdoSyumokuScreenInline]
 
+    csv_foreign_keys = {
+        'ido_type': CsvForeignKey(IdoType, 'code', get_key=get_ido_type_code),
+    }
+
     def render_change_form(self, request, context, add=False, change=False, form_url='', obj=None):
         """Hide "save" button"""
         # pylint: disable=too-many-arguments
@@ -42,7 +47,6 @@ class IdoSyumokuAdmin(CommonBaseTableAminMixin, admin.ModelAdmin):
     def csv2model(self, csv_dict: Dict[str, str], *args, **kwargs) -> Dict[str, Any]:
         model_dict = super().csv2model(csv_dict, *args, **kwargs)
 
-        model_dict['ido_type'] = IdoType.objects.filter(code=get_ido_type_code(csv_dict)).first()
         model_dict['code'] = csv_dict.get('GRP_SEQ') + csv_dict.get('BUTTON_SEQ') \
                             + csv_dict.get('BUNKI1_SEQ') + csv_dict.get('BUNKI2_SEQ')
 